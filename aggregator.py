@@ -0,0 +1,201 @@
+#!/usr/bin/env python
+import argparse
+import json
+import os
+import socket
+import sys
+import time
+import zlib
+
+from sketches import DDSketch, WindowedSketch
+
+
+# largest datagram sent by a collector, bigger partial aggregates are split
+MAX_DATAGRAM = 60000
+# sliding window (in seconds) of the merged delay and queue quantiles
+SKETCH_WINDOW = 10
+SKETCH_SLOTS = 5
+# time in seconds between two prints of the network view
+PRINT_TIME = 5
+# collectors that sent nothing for this time (in seconds) are shown as silent
+COLLECTOR_TIMEOUT = 30
+
+
+###############################################################################
+#####################        PARTIAL AGGREGATES           #####################
+###############################################################################
+
+# A partial aggregate is what one collector learned about its switches since
+# its previous export, so merging partials is adding them:
+# {
+#   'collector' : name of the collector instance
+#   'time'      : time of the export on the collector
+#   'interval'  : seconds covered by this partial
+#   'switches'  : [{
+#     'id'     : swid,
+#     'name'   : 'sXX',
+#     'pkts'   : packets seen since the previous export,
+#     'rules'  : [[rule id, uses since the previous export], ...],
+#     'flows'  : flows active on the collector right now,
+#     'delay'  : DDSketch.encode() of the timedelta of the interval,
+#     'queue'  : DDSketch.encode() of the qdepth of the interval
+#   }, ...]
+# }
+# Datagrams carry the JSON of a partial compressed with zlib
+#
+# The controller sends register reports to stat.py in the same datagrams,
+# with the aggregation registers of mri.p4 read since its previous report:
+#   'switches'  : [{
+#     'id'     : swid,
+#     'name'   : 'sXX',
+#     'rules'  : [[rule id, packets, sum of timedelta, max qdepth], ...]
+#   }, ...]
+
+# endpoints are 'udp:host:port' or 'unix:/path/of/socket'
+def open_endpoint(target, bind=False):
+  kind, _, address = target.partition(':')
+  if kind == 'udp':
+    host, _, port = address.rpartition(':')
+    address = (host, int(port))
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+  elif kind == 'unix':
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+    if bind and os.path.exists(address):
+      os.unlink(address)
+  else:
+    raise Exception("Unknown endpoint " + target + ", use udp:host:port or unix:/path")
+  if bind:
+    sock.bind(address)
+  return sock, address
+
+def encode_partials(collector, now, interval, switches):
+  message = {'collector' : collector, 'time' : now, 'interval' : interval, 'switches' : switches}
+  datagram = zlib.compress(json.dumps(message, separators=(',', ':')))
+  if len(datagram) <= MAX_DATAGRAM or len(switches) <= 1:
+    return [datagram]
+  half = len(switches) // 2
+  return encode_partials(collector, now, interval, switches[:half]) + encode_partials(collector, now, interval, switches[half:])
+
+def decode_partial(datagram):
+  return json.loads(zlib.decompress(datagram))
+
+
+###############################################################################
+### class Exporter                                                          ###
+###  * Used by a collector to send its partial aggregates to the            ###
+###    aggregator, the socket is non blocking and failed sends are only     ###
+###    counted so exporting never stalls packet processing                  ###
+###  * Structure:                                                           ###
+###    - self.sock                                                          ###
+###    - self.address                                                       ###
+###    - self.errors                                                        ###
+###  * Methods:                                                             ###
+###    - __init__ (target)                                                  ###
+###    - send(collector, now, interval, switches)                           ###
+###############################################################################
+class Exporter:
+
+  def __init__(self, target):
+    self.sock, self.address = open_endpoint(target)
+    self.sock.setblocking(False)
+    self.errors = 0
+
+  def send(self, collector, now, interval, switches):
+    for datagram in encode_partials(collector, now, interval, switches):
+      try:
+        self.sock.sendto(datagram, self.address)
+      except socket.error:
+        self.errors += 1
+
+
+###############################################################################
+### class Aggregator                                                        ###
+###  * Merges the partial aggregates of every collector into one view of    ###
+###    the network: counters are added, flow counts are the sum of the last ###
+###    count of each collector, and the interval sketches are merged into   ###
+###    a sliding window per switch                                          ###
+###  * Structure:                                                           ###
+###    - self.switches      // {swid -> merged state of the switch}         ###
+###    - self.collectors    // {collector name -> last time heard}          ###
+###  * Methods:                                                             ###
+###    - merge(partial, now)                                                ###
+###    - format_view(now)                                                   ###
+###############################################################################
+class Aggregator:
+
+  def __init__(self):
+    self.switches = {}
+    self.collectors = {}
+
+  def switch(self, swid, name):
+    try:
+      return self.switches[swid]
+    except KeyError:
+      self.switches[swid] = {
+        'name' : name,
+        'pkts' : 0,
+        'rules' : {},
+        'flows' : {}, # {collector -> active flows}
+        'delay' : WindowedSketch(SKETCH_WINDOW, SKETCH_SLOTS),
+        'queue' : WindowedSketch(SKETCH_WINDOW, SKETCH_SLOTS)
+      }
+      return self.switches[swid]
+
+  def merge(self, partial, now):
+    collector = partial['collector']
+    self.collectors[collector] = now
+    for part in partial['switches']:
+      sw = self.switch(part['id'], part['name'])
+      sw['pkts'] += part['pkts']
+      for rule_id, uses in part['rules']:
+        sw['rules'][rule_id] = sw['rules'].get(rule_id, 0) + uses
+      sw['flows'][collector] = part['flows']
+      sw['delay'].add_sketch(DDSketch.decode(part['delay']), now)
+      sw['queue'].add_sketch(DDSketch.decode(part['queue']), now)
+
+  def format_view(self, now):
+    alive = len([c for c in self.collectors.values() if now - c <= COLLECTOR_TIMEOUT])
+    lines = ['=========================  NETWORK VIEW  =========================']
+    lines.append('%d collectors (%d silent for more than %ds)' % (len(self.collectors), len(self.collectors) - alive, COLLECTOR_TIMEOUT))
+    for swid in sorted(self.switches):
+      sw = self.switches[swid]
+      delay = sw['delay'].merged(now)
+      queue = sw['queue'].merged(now)
+      line = '%s: %d packets, %d active flows' % (sw['name'], sw['pkts'], sum(sw['flows'].values()))
+      if delay.count:
+        line += ', delay p50 %.2fms p99 %.2fms max %.2fms' % (delay.quantile(0.5)/1000.0, delay.quantile(0.99)/1000.0, delay.max/1000.0)
+      if queue.count:
+        line += ', queue p99 %.0f max %d packets' % (queue.quantile(0.99), queue.max)
+      lines.append(line)
+      uses = sorted(sw['rules'].items(), key=lambda r: int(r[0]))
+      lines.append('\tRule uses: ' + ', '.join(['%s: %d' % (rule_id, n) for rule_id, n in uses]))
+    return '\n'.join(lines) + '\n'
+
+
+def main(listen):
+  sock, address = open_endpoint(listen, bind=True)
+  sock.settimeout(PRINT_TIME)
+  aggregator = Aggregator()
+  print "aggregating partials received on %s" % listen
+  sys.stdout.flush()
+  last_print = time.time()
+  while True:
+    try:
+      datagram, sender = sock.recvfrom(MAX_DATAGRAM + 4096)
+      aggregator.merge(decode_partial(datagram), time.time())
+    except socket.timeout:
+      pass
+    except (ValueError, zlib.error, KeyError):
+      print "discarding a malformed partial aggregate"
+    if time.time() - last_print > PRINT_TIME:
+      sys.stdout.write(aggregator.format_view(time.time()))
+      sys.stdout.flush()
+      last_print = time.time()
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description='Aggregator of the partial aggregates of several stat.py collectors')
+  parser.add_argument('-l', '--listen', help='Endpoint to receive partials on: udp:host:port or unix:/path',
+                      type=str, action="store", required=True)
+  args = parser.parse_args()
+  main(args.listen)
@@ -0,0 +1,228 @@
+#!/usr/bin/env python
+import argparse
+import json
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import controller
+import p4runtime_lib.helper
+from make_topology import add_arguments, generate
+
+
+# Benchmark of the controller on generated topologies without BMv2: the
+# switch connections are replaced by FakeSwitchConnection, which keeps the
+# table of each switch in memory and answers after an artificial delay, and
+# the time spent by Topology.build_topo is split between its steps. With
+# --dry-run the rules are only computed, no connection is made
+
+
+###############################################################################
+### class FakeSwitchConnection                                              ###
+###  * Stands in for p4runtime_lib.bmv2.Bmv2SwitchConnection with the calls ###
+###    made by the controller, requests are applied on an in memory table   ###
+###  * A switch serves one write request at a time, taking UPDATE_COST      ###
+###    seconds per update, and the answer arrives RPC_LATENCY seconds after ###
+###    it is served; calls that wait for the answer sleep for that time     ###
+###  * Structure:                                                           ###
+###    - self.name, self.device_id                                          ###
+###    - self.client_stub       // client_stub.Write(request) and           ###
+###                             // client_stub.Write.future(request)        ###
+###    - self.busy_until        // time the last request will be served     ###
+###    - self.requests          // write requests received                  ###
+###    - self.updates           // {update type -> updates received}        ###
+###    - self.table             // {(table id, match) -> action} of the     ###
+###                             // entries written on the switch            ###
+###  * Methods:                                                             ###
+###    - MasterArbitrationUpdate(), SetForwardingPipelineConfig(...),       ###
+###      WriteTableEntry(entry), shutdown()                                 ###
+###    - serve(request)         // applies a WriteRequest, returns the time ###
+###                             // of its answer and the error, if any      ###
+###############################################################################
+
+RPC_LATENCY = 0
+UPDATE_COST = 0
+# every connection made, to add up the requests of all switches
+CONNECTIONS = []
+
+class FakeFuture(object):
+
+    def __init__(self, ready, error):
+        self.ready = ready
+        self.error = error
+
+    def result(self, timeout=None):
+        delay = self.ready - time.time()
+        if delay > 0:
+            time.sleep(delay)
+        if self.error is not None:
+            raise Exception(self.error)
+
+class FakeWrite(object):
+
+    def __init__(self, connection):
+        self.connection = connection
+
+    def __call__(self, request, timeout=None):
+        return self.future(request).result()
+
+    def future(self, request, timeout=None):
+        return FakeFuture(*self.connection.serve(request))
+
+class FakeStub(object):
+
+    def __init__(self, connection):
+        self.Write = FakeWrite(connection)
+
+class FakeSwitchConnection(object):
+
+    def __init__(self, name=None, address='127.0.0.1:50051', device_id=0, proto_dump_file=None):
+        self.name = name
+        self.address = address
+        self.device_id = device_id
+        self.client_stub = FakeStub(self)
+        self.lock = threading.Lock()
+        self.busy_until = 0
+        self.requests = 0
+        self.updates = {}
+        self.table = {}
+        CONNECTIONS.append(self)
+
+    # time of the answer of a call served right away
+    def answer_time(self, updates):
+        with self.lock:
+            start = max(time.time(), self.busy_until)
+            self.busy_until = start + updates * UPDATE_COST
+            return self.busy_until + RPC_LATENCY
+
+    def wait(self, updates):
+        FakeFuture(self.answer_time(updates), None).result()
+
+    def MasterArbitrationUpdate(self, *args, **kwargs):
+        self.wait(0)
+
+    def SetForwardingPipelineConfig(self, p4info=None, bmv2_json_file_path=None, *args, **kwargs):
+        with self.lock:
+            self.table = {}
+        self.wait(0)
+
+    def WriteTableEntry(self, table_entry, *args, **kwargs):
+        self.requests += 1
+        self.wait(1)
+
+    def shutdown(self):
+        pass
+
+    def serve(self, request):
+        error = None
+        with self.lock:
+            self.requests += 1
+            for update in request.updates:
+                self.updates[update.type] = self.updates.get(update.type, 0) + 1
+                entry = update.entity.table_entry
+                key = (entry.table_id, tuple([m.SerializeToString() for m in entry.match]))
+                if update.type == controller.p4runtime_pb2.Update.INSERT and key in self.table:
+                    error = error or 'INSERT of an existing entry on ' + self.name
+                elif update.type != controller.p4runtime_pb2.Update.INSERT and key not in self.table:
+                    error = error or 'MODIFY or DELETE of a missing entry on ' + self.name
+                elif update.type == controller.p4runtime_pb2.Update.DELETE:
+                    del self.table[key]
+                else:
+                    self.table[key] = entry.action.SerializeToString()
+        return self.answer_time(len(request.updates)), error
+
+
+# writes the rules of each switch as one JSON object per line
+def dump_rules(topo, file_name):
+    out = open(file_name, 'w')
+    for name in sorted(topo.nodes):
+        node = topo.nodes[name]
+        if node.type == controller.SWITCH:
+            json.dump({'switch' : name, 'rules' : node.rules, 'holes' : node.holes}, out, sort_keys=True)
+            out.write('\n')
+    out.close()
+
+def main(args):
+    global RPC_LATENCY, UPDATE_COST
+    RPC_LATENCY = args.latency / 1000.0
+    UPDATE_COST = args.update_cost / 1000000.0
+    controller.DRY_RUN = args.dry_run
+    controller.ROUTE_WORKERS = args.route_workers
+    controller.COMPRESS_ROUTES = args.compress_routes
+    controller.WRITE_BATCH_SIZE = args.batch_size
+    controller.WRITE_WINDOW = args.window
+    controller.p4runtime_lib.bmv2.Bmv2SwitchConnection = FakeSwitchConnection
+
+    work_dir = tempfile.mkdtemp(prefix='controller_bench')
+    try:
+        if args.topology:
+            topology_file = args.topology
+        else:
+            topology_file = os.path.join(work_dir, 'topology.json')
+            with open(topology_file, 'w') as f:
+                json.dump(generate(args.type, args.switches, args.hosts, args.degree, args.arity, args.seed), f)
+        controller.RULES_DIR = (args.rules_dir or work_dir) + '/'
+        p4info_helper = None if args.dry_run else p4runtime_lib.helper.P4InfoHelper(args.p4info)
+
+        start = time.time()
+        topo = controller.Topology(topology_file, p4info_helper, args.bmv2_json)
+        total = time.time() - start
+    finally:
+        shutil.rmtree(work_dir)
+
+    switches = [n for n in topo.nodes.values() if n.type == controller.SWITCH]
+    hosts = len(topo.nodes) - len(switches)
+    steps = [('routes', topo.route_time), ('tables', topo.table_time),
+             ('install', topo.install_time), ('snapshot', topo.snapshot_time)]
+    print '%d switches, %d hosts, %d switch ports' % (len(switches), hosts, len(topo.links))
+    print '%-10s %10.3f s' % ('build_topo', total)
+    for step, seconds in steps:
+        print '  %-8s %10.3f s' % (step, seconds)
+    print '  %-8s %10.3f s  (topology index, switch connections)' % ('other', total - sum([s for _, s in steps]))
+    print '%d table entries' % sum([len(sw.rules) + len(sw.holes) for sw in switches])
+    if topo.compression:
+        print 'Compressed %d forwarding rules into %d table entries' % topo.compression
+    if not args.dry_run:
+        updates = {}
+        for c in CONNECTIONS:
+            for update_type, count in c.updates.items():
+                updates[update_type] = updates.get(update_type, 0) + count
+        print '%d write requests, %d updates, %d entries on the switches' % (
+            sum([c.requests for c in CONNECTIONS]), sum(updates.values()), sum([len(c.table) for c in CONNECTIONS]))
+    if args.dump:
+        dump_rules(topo, args.dump)
+        print 'Rules written on ' + args.dump
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark of the controller with stand-in switch connections')
+    add_arguments(parser)
+    parser.add_argument('-f', '--topology', help='Topology file to use instead of a generated one',
+                        type=str, action="store", required=False, default=None)
+    parser.add_argument('--p4info', help='p4info proto in text format from p4c',
+                        type=str, action="store", required=False, default='./build/mri.p4info')
+    parser.add_argument('--bmv2-json', help='BMv2 JSON file from p4c, only passed to the stand-in switches',
+                        type=str, action="store", required=False, default='./build/mri.json')
+    parser.add_argument('-l', '--latency', help='Round trip time of each RPC in milliseconds',
+                        type=float, action="store", required=False, default=0)
+    parser.add_argument('-u', '--update-cost', help='Time a switch takes to apply one update in microseconds',
+                        type=float, action="store", required=False, default=0)
+    parser.add_argument('-b', '--batch-size', help='Updates per write request',
+                        type=int, action="store", required=False, default=controller.WRITE_BATCH_SIZE)
+    parser.add_argument('-W', '--window', help='Write requests in flight per switch',
+                        type=int, action="store", required=False, default=controller.WRITE_WINDOW)
+    parser.add_argument('-w', '--route-workers', help='Processes used to compute the routes between switches',
+                        type=int, action="store", required=False, default=0)
+    parser.add_argument('-c', '--compress-routes', help='Compress the forwarding rules of each switch',
+                        action="store_true", required=False, default=False)
+    parser.add_argument('-n', '--dry-run', help='Only compute the rules, without switch connections nor p4info',
+                        action="store_true", required=False, default=False)
+    parser.add_argument('-r', '--rules-dir', help='Directory of the rules snapshot (a temporary one by default)',
+                        type=str, action="store", required=False, default=None)
+    parser.add_argument('--dump', help='Write the rules of each switch on this file as JSON lines',
+                        type=str, action="store", required=False, default=None)
+    main(parser.parse_args())
@@ -0,0 +1,125 @@
+#!/usr/bin/env python
+import argparse
+import json
+import random
+import sys
+
+
+# Generates topology files in the format read by the controller:
+#   hosts    : [host names]
+#   switches : {switch name -> {}}
+#   links    : [[node, node, delay, bandwidth]]
+# Switches are s01, s02, ... and host K of switch SS is hSSK, the names the
+# controller derives the addresses from, so a switch has at most
+# MAX_HOSTS_PER_SWITCH hosts and the switch numbers fit on the 16 bits of
+# the switch id of the telemetry header
+
+MAX_HOSTS_PER_SWITCH = 10
+MAX_SWITCHES = 65535
+LINK_DELAY = '0'
+LINK_BANDWIDTH = 0.25
+
+
+def switch_name(num):
+    return 's%02d' % num
+
+def host_name(switch, num):
+    return 'h%02d%d' % (switch, num)
+
+# topology file of the switches 1..num_switches, with the given links between
+# switch numbers and hosts_per_switch hosts on each switch in hosted
+def build_topology(num_switches, links, hosts_per_switch, hosted=None):
+    if num_switches > MAX_SWITCHES:
+        raise Exception("At most %d switches are supported" % MAX_SWITCHES)
+    if hosts_per_switch > MAX_HOSTS_PER_SWITCH:
+        raise Exception("At most %d hosts per switch are supported" % MAX_HOSTS_PER_SWITCH)
+    if hosted is None:
+        hosted = range(1, num_switches + 1)
+    js = {'hosts' : [], 'switches' : {}, 'links' : []}
+    for s in range(1, num_switches + 1):
+        js['switches'][switch_name(s)] = {}
+    for s in hosted:
+        for h in range(hosts_per_switch):
+            js['hosts'].append(host_name(s, h))
+            js['links'].append([host_name(s, h), switch_name(s), LINK_DELAY, LINK_BANDWIDTH])
+    for a, b in sorted(links):
+        js['links'].append([switch_name(a), switch_name(b), LINK_DELAY, LINK_BANDWIDTH])
+    return js
+
+# fat tree of k pods: (k/2)^2 core switches, then on each pod k/2 aggregation
+# and k/2 edge switches, with k/2 hosts on each edge switch
+def fat_tree(k):
+    if k % 2 != 0:
+        raise Exception("The fat tree arity must be even")
+    half = k // 2
+    cores = range(1, half * half + 1)
+    links = set()
+    edges = []
+    for pod in range(k):
+        first = half * half + pod * k + 1
+        aggregation = range(first, first + half)
+        edge = range(first + half, first + k)
+        edges.extend(edge)
+        for i, a in enumerate(aggregation):
+            for e in edge:
+                links.add((a, e))
+            for c in cores[i * half:(i + 1) * half]:
+                links.add((c, a))
+    return build_topology(half * half + k * k, links, half, edges)
+
+def ring(num_switches, hosts_per_switch):
+    links = set()
+    for s in range(1, num_switches + 1):
+        links.add(tuple(sorted((s, s % num_switches + 1))))
+    return build_topology(num_switches, links, hosts_per_switch)
+
+# connected random graph: a random spanning tree plus random links until the
+# switches have on average degree links
+def random_graph(num_switches, degree, hosts_per_switch, seed):
+    rnd = random.Random(seed)
+    links = set()
+    for s in range(2, num_switches + 1):
+        links.add((rnd.randint(1, s - 1), s))
+    wanted = min(num_switches * degree // 2, num_switches * (num_switches - 1) // 2)
+    while len(links) < wanted:
+        a, b = sorted(rnd.sample(range(1, num_switches + 1), 2))
+        links.add((a, b))
+    return build_topology(num_switches, links, hosts_per_switch)
+
+def generate(kind, switches, hosts_per_switch, degree, k, seed):
+    if kind == 'fat-tree':
+        return fat_tree(k)
+    if kind == 'ring':
+        return ring(switches, hosts_per_switch)
+    return random_graph(switches, degree, hosts_per_switch, seed)
+
+def add_arguments(parser):
+    parser.add_argument('-t', '--type', help='Kind of topology',
+                        type=str, action="store", required=False, default='random',
+                        choices=['fat-tree', 'ring', 'random'])
+    parser.add_argument('-s', '--switches', help='Number of switches of the ring and random topologies',
+                        type=int, action="store", required=False, default=100)
+    parser.add_argument('-H', '--hosts', help='Hosts per switch of the ring and random topologies',
+                        type=int, action="store", required=False, default=2)
+    parser.add_argument('-d', '--degree', help='Average number of links between switches per switch of the random topology',
+                        type=int, action="store", required=False, default=4)
+    parser.add_argument('-k', '--arity', help='Number of pods of the fat tree',
+                        type=int, action="store", required=False, default=4)
+    parser.add_argument('--seed', help='Seed of the random topology',
+                        type=int, action="store", required=False, default=1)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Generates topology files for the controller')
+    add_arguments(parser)
+    parser.add_argument('-o', '--output', help='Topology file to write, - for the standard output',
+                        type=str, action="store", required=False, default='-')
+    args = parser.parse_args()
+    js = generate(args.type, args.switches, args.hosts, args.degree, args.arity, args.seed)
+    out = sys.stdout if args.output == '-' else open(args.output, 'w')
+    json.dump(js, out, indent=1, sort_keys=True)
+    out.write('\n')
+    if out is not sys.stdout:
+        out.close()
+        print '%d switches, %d hosts and %d links written on %s' % (
+            len(js['switches']), len(js['hosts']), len(js['links']), args.output)
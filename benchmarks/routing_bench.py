@@ -0,0 +1,125 @@
+#!/usr/bin/env python
+import argparse
+import multiprocessing
+import os
+import random
+import sys
+import time
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from routing import RouteTable, all_next_hops
+
+
+# Benchmark of the all pairs next hop computation of the controller on random
+# topologies: a ring of switches with random extra links between switches and
+# HOSTS_PER_SWITCH hosts on each switch
+
+HOSTS_PER_SWITCH = 2
+# the linear scan routing the controller used before is only run up to this
+# number of switches, it grows roughly with the cube of it
+LEGACY_LIMIT = 300
+
+
+def random_topology(num_switches, degree, seed):
+    rnd = random.Random(seed)
+    switches = ['s%d' % i for i in range(1, num_switches + 1)]
+    links = set()
+    for i in range(num_switches):
+        links.add((switches[i], switches[(i + 1) % num_switches]))
+    for i in range(num_switches * max(degree - 2, 0) // 2):
+        a, b = rnd.sample(switches, 2)
+        links.add((a, b))
+    adjacency = dict((s, []) for s in switches)
+    for a, b in sorted(links):
+        if b not in adjacency[a]:
+            adjacency[a].append(b)
+            adjacency[b].append(a)
+    for s in switches:
+        for h in range(HOSTS_PER_SWITCH):
+            host = 'h%s_%d' % (s[1:], h)
+            adjacency[host] = [s]
+            adjacency[s].append(host)
+    return adjacency, set(switches)
+
+# routing as done by the controller before the adjacency index, kept to measure
+# the speedup: a list of links scanned on every BFS step and list based queues
+def legacy_next_hops(adjacency, switches):
+    links = [(a, b) for a in adjacency for b in adjacency[a] if a in switches]
+    answer = {}
+    for sw in switches:
+        next_hop = dict((s, None) for s in switches if s != sw)
+        queue = [sw]
+        while len(queue) > 0:
+            current = queue[0]
+            queue = queue[1:]
+            for link in [l for l in links if l[0] == current]:
+                other = link[1]
+                if other != sw and other in switches and next_hop[other] == None:
+                    next_hop[other] = other if current == sw else next_hop[current]
+                    queue.append(other)
+        answer[sw] = next_hop
+    return answer
+
+# time to converge after one link between switches goes down, with the
+# sources of the RouteTable whose next hops may have changed, and how many
+# sources those were
+def link_down(adjacency, switches, seed):
+    routes = RouteTable()
+    for s in sorted(switches):
+        routes.add_switch(s)
+    for s in sorted(switches):
+        for n in adjacency[s]:
+            if n in switches:
+                routes.add_link(s, n)
+    routes.recompute()
+    a = random.Random(seed).choice(sorted(switches))
+    b = [n for n in adjacency[a] if n in switches][0]
+    start = time.time()
+    routes.remove_link(a, b)
+    routes.remove_link(b, a)
+    sources = routes.recompute()
+    return time.time() - start, len(sources)
+
+def timed(function, *args):
+    start = time.time()
+    result = function(*args)
+    return result, time.time() - start
+
+
+def main(sizes, degree, workers, seed):
+    print '%8s %8s %12s %12s %12s %16s' % ('switches', 'links', 'legacy (s)', 'bfs (s)', 'bfs x%d (s)' % workers, 'link down (s)')
+    for size in sizes:
+        adjacency, switches = random_topology(size, degree, seed)
+        links = sum([len([n for n in adjacency[s] if n in switches]) for s in switches]) // 2
+        hops, serial = timed(all_next_hops, adjacency, switches)
+        if workers > 1:
+            parallel_hops, parallel = timed(all_next_hops, adjacency, switches, workers)
+            if parallel_hops != hops:
+                raise Exception("Parallel and serial next hops differ")
+            parallel = '%12.3f' % parallel
+        else:
+            parallel = '%12s' % '-'
+        if size <= LEGACY_LIMIT:
+            legacy, old = timed(legacy_next_hops, adjacency, switches)
+            if legacy != dict((s, dict((d, hops[s].get(d)) for d in switches if d != s)) for s in switches):
+                raise Exception("Legacy and new next hops differ")
+            old = '%12.3f' % old
+        else:
+            old = '%12s' % '-'
+        down, sources = link_down(adjacency, switches, seed)
+        print '%8d %8d %s %12.3f %s %9.3f (%4d)' % (size, links, old, serial, parallel, down, sources)
+        sys.stdout.flush()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark of the controller routing on random topologies')
+    parser.add_argument('-s', '--sizes', help='Comma separated numbers of switches',
+                        type=str, action="store", required=False, default='50,100,300,1000,2000')
+    parser.add_argument('-d', '--degree', help='Average number of links between switches per switch',
+                        type=int, action="store", required=False, default=4)
+    parser.add_argument('-w', '--workers', help='Processes of the parallel run, 0 or 1 skips it',
+                        type=int, action="store", required=False, default=multiprocessing.cpu_count())
+    parser.add_argument('--seed', help='Seed of the random topologies',
+                        type=int, action="store", required=False, default=1)
+    args = parser.parse_args()
+    main([int(s) for s in args.sizes.split(',')], args.degree, args.workers, args.seed)
@@ -0,0 +1,304 @@
+import ctypes
+import fcntl
+import mmap
+import select
+import socket
+import struct
+
+
+###############################################################################
+#####################        LINUX PACKET CONSTANTS       #####################
+###############################################################################
+
+SOL_PACKET = 263
+SO_ATTACH_FILTER = 26
+PACKET_ADD_MEMBERSHIP = 1
+PACKET_RX_RING = 5
+PACKET_STATISTICS = 6
+PACKET_VERSION = 10
+PACKET_MR_PROMISC = 1
+TPACKET_V3 = 2
+ETH_P_ALL = 0x0003
+SIOCGIFINDEX = 0x8933
+
+TP_STATUS_KERNEL = 0
+TP_STATUS_USER = 1
+
+# struct tpacket_req3
+TPACKET_REQ3 = struct.Struct('=IIIIIII')
+# struct tpacket_block_desc, fields of tpacket_hdr_v1 used here start at 8:
+# block_status, num_pkts, offset_to_first_pkt
+BLOCK_STATUS_OFFSET = 8
+BLOCK_STATUS = struct.Struct('=I')
+BLOCK_HDR = struct.Struct('=II')
+BLOCK_HDR_OFFSET = 12
+# struct tpacket3_hdr up to tp_mac: tp_next_offset, tp_sec, tp_nsec,
+# tp_snaplen, tp_len, tp_status, tp_mac
+TPACKET3_HDR = struct.Struct('=IIIIIIH')
+# struct tpacket_stats: tp_packets, tp_drops (tpacket_stats_v3 adds
+# tp_freeze_q_cnt, not read here)
+TPACKET_STATS = struct.Struct('=II')
+
+# ring geometry, block_size must be a multiple of the page size
+RING_BLOCK_SIZE = 1 << 20
+RING_BLOCK_NR = 64
+RING_FRAME_SIZE = 2048
+# time (in ms) after which the kernel hands a block that is not full to user
+# space, bounds the latency of the reports under low traffic
+RING_BLOCK_TIMEOUT = 10
+POLL_TIMEOUT = 100 # ms
+
+try:
+  # python 2: mmap objects only expose the old buffer interface
+  _view = buffer
+except NameError:
+  def _view(obj, offset, size):
+    return memoryview(obj)[offset:offset + size]
+
+
+# classic BPF program accepting only frames whose ethertype is ether_type:
+#   ldh [12]; jeq #ether_type jt 0 jf 1; ret #0x40000; ret #0
+def ether_type_filter(ether_type):
+  return [(0x28, 0, 0, 12),
+          (0x15, 0, 1, ether_type),
+          (0x06, 0, 0, 0x40000),
+          (0x06, 0, 0, 0)]
+
+def if_index(sock, iface):
+  ifreq = fcntl.ioctl(sock.fileno(), SIOCGIFINDEX, struct.pack('16sI', iface.encode(), 0))
+  return struct.unpack('16sI', ifreq)[1]
+
+# frames that reached a packet socket and frames the kernel dropped because
+# its buffer or ring was full, since the previous call (reading the counters
+# resets them); the packets include the drops
+def packet_statistics(sock):
+  return TPACKET_STATS.unpack(sock.getsockopt(SOL_PACKET, PACKET_STATISTICS, TPACKET_STATS.size))
+
+
+###############################################################################
+### class RingCapture                                                       ###
+###  * Capture backend reading frames from a PACKET_MMAP (TPACKET_V3) ring  ###
+###    of a raw AF_PACKET socket, so frames are never copied to build a     ###
+###    python object per packet like scapy sniff does                       ###
+###  * A BPF filter attached to the socket drops every frame whose          ###
+###    ethertype is not ether_type inside the kernel                        ###
+###  * Frames are handed to the callback one ring block at a time as a list ###
+###    of zero copy views, which are only valid during the callback         ###
+###  * Structure:                                                           ###
+###    - self.sock                                                          ###
+###    - self.ring          // mmap of the rx ring                          ###
+###    - self.block_size                                                    ###
+###    - self.block_nr                                                      ###
+###    - self.block         // next block to be read                        ###
+###  * Methods:                                                             ###
+###    - __init__ (iface, ether_type)                                       ###
+###    - fileno()                                                           ###
+###    - read_blocks(callback)      // calls callback(frames) for the       ###
+###                                 // blocks ready, never waits            ###
+###    - run(callback)              // calls callback(frames) forever       ###
+###    - statistics()               // see packet_statistics                ###
+###    - close()                                                            ###
+###############################################################################
+class RingCapture:
+
+  def __init__(self, iface, ether_type, block_size=RING_BLOCK_SIZE, block_nr=RING_BLOCK_NR):
+    self.block_size = block_size
+    self.block_nr = block_nr
+    self.block = 0 # next block to be read
+    self.sock = socket.socket(socket.AF_PACKET, socket.SOCK_RAW, socket.htons(ETH_P_ALL))
+    try:
+      self.attach_filter(ether_type_filter(ether_type))
+      self.sock.setsockopt(SOL_PACKET, PACKET_VERSION, TPACKET_V3)
+      req = TPACKET_REQ3.pack(block_size, block_nr, RING_FRAME_SIZE,
+                              (block_size * block_nr) // RING_FRAME_SIZE,
+                              RING_BLOCK_TIMEOUT, 0, 0)
+      self.sock.setsockopt(SOL_PACKET, PACKET_RX_RING, req)
+      self.ring = mmap.mmap(self.sock.fileno(), block_size * block_nr,
+                            mmap.MAP_SHARED, mmap.PROT_READ | mmap.PROT_WRITE)
+      self.sock.bind((iface, 0))
+      mreq = struct.pack('iHH8s', if_index(self.sock, iface), PACKET_MR_PROMISC, 0, b'')
+      self.sock.setsockopt(SOL_PACKET, PACKET_ADD_MEMBERSHIP, mreq)
+    except Exception:
+      self.sock.close()
+      raise
+
+  def attach_filter(self, program):
+    insns = b''.join([struct.pack('HBBI', *i) for i in program])
+    buf = ctypes.create_string_buffer(insns, len(insns))
+    fprog = struct.pack('HL', len(program), ctypes.addressof(buf))
+    self.sock.setsockopt(socket.SOL_SOCKET, SO_ATTACH_FILTER, fprog)
+
+  def fileno(self):
+    return self.sock.fileno()
+
+  # hands every block already retired by the kernel to callback without
+  # waiting, returns how many blocks were read
+  def read_blocks(self, callback, max_blocks=None):
+    ring = self.ring
+    blocks = 0
+    while max_blocks is None or blocks < max_blocks:
+      offset = self.block * self.block_size
+      if not BLOCK_STATUS.unpack_from(ring, offset + BLOCK_STATUS_OFFSET)[0] & TP_STATUS_USER:
+        break
+
+      num_pkts, pkt = BLOCK_HDR.unpack_from(ring, offset + BLOCK_HDR_OFFSET)
+      pkt += offset
+      frames = []
+      for i in range(num_pkts):
+        next_offset, sec, nsec, snaplen, length, status, mac = TPACKET3_HDR.unpack_from(ring, pkt)
+        frames.append(_view(ring, pkt + mac, snaplen))
+        pkt += next_offset
+      callback(frames)
+      del frames
+
+      # gives the block back to the kernel
+      BLOCK_STATUS.pack_into(ring, offset + BLOCK_STATUS_OFFSET, TP_STATUS_KERNEL)
+      self.block = (self.block + 1) % self.block_nr
+      blocks += 1
+    return blocks
+
+  def run(self, callback):
+    poller = select.poll()
+    poller.register(self.sock.fileno(), select.POLLIN | select.POLLERR)
+    while True:
+      if not self.read_blocks(callback):
+        poller.poll(POLL_TIMEOUT)
+
+  def statistics(self):
+    return packet_statistics(self.sock)
+
+  def close(self):
+    self.ring.close()
+    self.sock.close()
+
+
+###############################################################################
+#####################          PCAP FILE CONSTANTS        #####################
+###############################################################################
+
+PCAP_MAGIC_USEC = 0xa1b2c3d4
+PCAP_MAGIC_NSEC = 0xa1b23c4d
+PCAPNG_SHB = 0x0a0d0d0a
+PCAPNG_BYTE_ORDER_MAGIC = 0x1a2b3c4d
+PCAPNG_IDB = 0x00000001
+PCAPNG_SPB = 0x00000003
+PCAPNG_EPB = 0x00000006
+PCAPNG_OPT_TSRESOL = 9
+LINKTYPE_ETHERNET = 1
+
+
+###############################################################################
+### class PcapReader                                                        ###
+###  * Reads a pcap or pcapng file (either byte order) through a read only  ###
+###    mmap, iterating (timestamp, frame) where frame is a zero copy view   ###
+###    of the record and timestamp the capture time in seconds              ###
+###  * Only ethernet captures are accepted, since the collector decodes the ###
+###    frames from the ethernet header                                      ###
+###  * Structure:                                                           ###
+###    - self.file                                                          ###
+###    - self.data          // mmap of the whole file                       ###
+###    - self.skipped       // packet blocks skipped, their interface has   ###
+###                         // no description block                         ###
+###  * Methods:                                                             ###
+###    - __init__ (path)                                                    ###
+###    - __iter__()                                                         ###
+###    - close()                                                            ###
+###############################################################################
+class PcapReader:
+
+  def __init__(self, path):
+    self.file = open(path, 'rb')
+    self.skipped = 0
+    try:
+      self.data = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+    except ValueError:
+      # empty file, nothing to map
+      self.data = b''
+
+  def __iter__(self):
+    data = self.data
+    if len(data) < 24:
+      return iter([])
+    if struct.unpack_from('=I', data, 0)[0] == PCAPNG_SHB:
+      return self.pcapng_records()
+    return self.pcap_records()
+
+  def pcap_records(self):
+    data = self.data
+    for order in '<>':
+      magic = struct.unpack_from(order + 'I', data, 0)[0]
+      if magic in (PCAP_MAGIC_USEC, PCAP_MAGIC_NSEC):
+        break
+    else:
+      raise Exception("Not a pcap or pcapng file")
+    scale = 1e-6 if magic == PCAP_MAGIC_USEC else 1e-9
+    linktype = struct.unpack_from(order + 'I', data, 20)[0] & 0x0fffffff
+    if linktype != LINKTYPE_ETHERNET:
+      raise Exception("Unsupported link type %d, only ethernet captures can be replayed" % linktype)
+
+    record = struct.Struct(order + 'IIII')
+    offset = 24
+    end = len(data)
+    while offset + record.size <= end:
+      sec, frac, incl_len, orig_len = record.unpack_from(data, offset)
+      offset += record.size
+      if offset + incl_len > end:
+        break # truncated capture
+      yield sec + frac * scale, _view(data, offset, incl_len)
+      offset += incl_len
+
+  def pcapng_records(self):
+    data = self.data
+    end = len(data)
+    offset = 0
+    order = '<'
+    resolutions = [] # timestamp unit of each interface of the current section
+    ts = 0.0
+    while offset + 12 <= end:
+      block_type = struct.unpack_from(order + 'I', data, offset)[0]
+      if block_type == PCAPNG_SHB:
+        order = '<' if struct.unpack_from('<I', data, offset + 8)[0] == PCAPNG_BYTE_ORDER_MAGIC else '>'
+        resolutions = []
+      block_len = struct.unpack_from(order + 'I', data, offset + 4)[0]
+      if block_len < 12 or offset + block_len > end:
+        break # truncated capture
+
+      if block_type == PCAPNG_IDB:
+        linktype = struct.unpack_from(order + 'H', data, offset + 8)[0]
+        if linktype != LINKTYPE_ETHERNET:
+          raise Exception("Unsupported link type %d, only ethernet captures can be replayed" % linktype)
+        resolutions.append(self.pcapng_tsresol(order, offset + 16, offset + block_len - 4))
+      elif block_type == PCAPNG_EPB:
+        iface, ts_high, ts_low, captured = struct.unpack_from(order + 'IIII', data, offset + 8)
+        if iface < len(resolutions):
+          ts = ((ts_high << 32) | ts_low) * resolutions[iface]
+          yield ts, _view(data, offset + 28, captured)
+        else:
+          self.skipped += 1
+      elif block_type == PCAPNG_SPB:
+        # simple packets carry no timestamp, the last one seen is used
+        packet_len = struct.unpack_from(order + 'I', data, offset + 8)[0]
+        yield ts, _view(data, offset + 12, min(packet_len, block_len - 16))
+
+      offset += block_len
+
+  # timestamp unit (in seconds) from the if_tsresol option of an IDB, the
+  # default is microseconds
+  def pcapng_tsresol(self, order, offset, end):
+    data = self.data
+    while offset + 4 <= end:
+      code, length = struct.unpack_from(order + 'HH', data, offset)
+      if code == 0:
+        break
+      if code == PCAPNG_OPT_TSRESOL and length >= 1:
+        value = struct.unpack_from('B', data, offset + 4)[0]
+        if value & 0x80:
+          return 2.0 ** -(value & 0x7f)
+        return 10.0 ** -value
+      offset += 4 + ((length + 3) & ~3)
+    return 1e-6
+
+  def close(self):
+    if not isinstance(self.data, bytes):
+      self.data.close()
+    self.file.close()
@@ -1,9 +1,15 @@
 #!/usr/bin/env python2
 import argparse
+import binascii
+import bisect
 import grpc
+import heapq
 import os
+import socket
 import sys
 import json
+import threading
+import time
 from time import sleep
 
 # Import P4Runtime lib from parent utils dir
@@ -14,6 +20,11 @@ sys.path.append(
 import p4runtime_lib.bmv2
 from p4runtime_lib.switch import ShutdownAllSwitchConnections
 import p4runtime_lib.helper
+from p4.v1 import p4runtime_pb2
+
+from aggregator import open_endpoint, encode_partials
+from routing import RouteTable, compress_routes
+from rule_snapshot import SNAPSHOT_FILE, read_version, write_snapshot
 
 ###############################################################################
 #######################        CONSTANTS        ###############################
@@ -26,6 +37,9 @@ HOST = 1
 # Incremental counter to identify the device, used to initialize a behavioral 
 # model to a switch
 CURRENT_DEVICE_ID = 0
+# Device id given to each switch name, a switch that goes down and comes back
+# is reached on the same device id and port
+DEVICE_IDS = {}
 
 # Base port where each switch is connected, the real port is obtained by the 
 # sum of this value with
@@ -35,10 +49,59 @@ BASE_PORT = 50051
 FORWARD_TABLE_NAME = 'MyIngress.ipv4_lpm'
 FORWARD_MATCH_FIELD = 'hdr.ipv4.dstAddr'
 FORWARD_ACTION = 'MyIngress.ipv4_forward'
+NO_ROUTE_ACTION = 'NoAction'
 BITS_PER_SWITCH = 8 # number of bits to identify a host on a switch
 
+# Telemetry sampling: the switch where a packet leaves the network clones 1 in
+# SAMPLE_RATE of the telemetry reports to the statistical controller, either
+# counting packets or, with SAMPLE_FLOWS, by the hash of the flow. A switch
+# of the topology file can override the rate with {"sample_rate": N}
+SAMPLING_TABLE_NAME = 'MyEgress.telemetry_sampling'
+SAMPLING_ACTION = 'MyEgress.set_sampling'
+SAMPLE_RATE = 1
+SAMPLE_FLOWS = False
+
+# Aggregation registers of mri.p4, per rule id: with AGGREGATE_TARGET the
+# controller reads them every AGGREGATE_TIME seconds and sends the register
+# reports (see aggregator.py) to the statistical controller listening there.
+# With AGGREGATE_ONLY the switches only keep the registers and clone no
+# telemetry report
+AGGREGATE_REGISTERS = ['MyEgress.aggregate_pkts', 'MyEgress.aggregate_delay_sum', 'MyEgress.aggregate_max_qdepth']
+AGGREGATE_ACTION = 'MyEgress.aggregate_only'
+# size of the aggregation registers (RULE_SLOTS of mri.p4): BMv2 drops the
+# accesses past it, so a switch with a rule id at or above it is left cloning
+# its reports
+AGGREGATE_SLOTS = 1024
+AGGREGATE_TARGET = None
+AGGREGATE_TIME = 1
+AGGREGATE_ONLY = False
+
+# Forwarding rules are installed with WriteRequests of up to WRITE_BATCH_SIZE
+# updates, keeping at most WRITE_WINDOW requests in flight on each switch
+WRITE_BATCH_SIZE = 500
+WRITE_WINDOW = 4
+
+# Processes used to compute the next hops between switches, 0 computes them on
+# the controller process
+ROUTE_WORKERS = 0
+
+# Replace the forwarding rules of each switch by the smallest equivalent LPM
+# table before installing them
+COMPRESS_ROUTES = False
+
 #file constants
+# the rules of every switch are written on the snapshot SNAPSHOT_FILE of
+# RULES_DIR, which is read by the statistical controller
 RULES_DIR = 'rules'
+TOPOLOGY_FILE = 'topology.json'
+
+# With DRY_RUN the rules are computed and written on the rules snapshot but
+# the controller does not connect to the switches
+DRY_RUN = False
+
+# With WATCH_TIME > 0 the controller keeps running after the install and
+# checks the topology file every WATCH_TIME seconds, applying its changes
+WATCH_TIME = 0
 
 
 
@@ -96,29 +159,53 @@ class Host(Node):
 ###    - self.switch        // represents an object of                      ###
 ###                         // p4runtime_lib.bmv2.Bmv2SwitchConnection      ###
 ###    - self.rules         // forwarding rules of the switch               ###
+###    - self.holes         // (address, prefix size) installed with the    ###
+###                         // default action after a compression           ###
+###    - self.installed     // {match field -> (action, rule id)} of the    ###
+###                         // entries on the switch, action is None for    ###
+###                         // the holes                                    ###
+###    - self.free_ids      // heap of the rule ids no longer used          ###
+###    - self.sample_rate   // 1 in sample_rate telemetry reports is cloned ###
+###    - self.aggregate_only   // only the aggregation registers are kept   ###
+###    - self.last_pkts, self.last_delay_sum   // aggregation registers on  ###
+###                         // the last read, {rule id -> value}            ###
 ###  * Methods:                                                             ###
 ###    - __init__ (name, p4info_helper, bmv2_file_path)                     ###
 ###    - install_telemetry_rule()                                           ###
+###    - set_sampling(rate)         // True if the rate changed             ###
+###    - set_aggregate_only(enabled)   // True if the mode changed          ###
+###    - max_rule_id()              // -1 without rules                     ###
+###    - read_aggregates()          // register report of the rules used    ###
+###                                 // since the last read                  ###
 ###    - get_IPv4 ()                                                        ###
 ###    - init_switch ()             // self.switch object                   ###
-###    - add_rule(rule)             // forwarding rule                      ###
+###    - add_rule(rule)             // forwarding rule, only queued         ###
+###    - compress_rules()           // smallest equivalent set of rules     ###
+###    - write_rules()              // brings the table to the queued rules ###
+###                                 // with INSERT/MODIFY/DELETE updates    ###
 ###    - get_switch()               // self.switch                          ###
-###    - write_rule_on_file(rule)   // writes a rule on a file so that it   ###
-###                                 // can be readed by the statistical     ###
-###                                 // controller                           ###
-###    - clear_rule_file()                                                  ###
 ###############################################################################
 class Switch(Node):
     def __init__(self, name, p4info_helper, bmv2_file_path):
         global SWITCH
         Node.__init__(self, name, SWITCH)
         self.rules = []
+        self.holes = []
+        self.installed = {}
+        self.free_ids = []
+        self.next_id = 0
+        self.sample_rate = 1 # no entry on telemetry_sampling clones all
+        self.aggregate_only = False
+        self.last_pkts = {}
+        self.last_delay_sum = {}
         self.p4info_helper = p4info_helper
+        self.switch = None
+        if DRY_RUN:
+            return
         self.init_switch()
         self.switch.SetForwardingPipelineConfig(p4info=p4info_helper.p4info,
                                        bmv2_json_file_path=bmv2_file_path)
         self.install_telemetry_rule()
-        self.clear_rule_file()
         
 
     def install_telemetry_rule(self):
@@ -130,25 +217,106 @@ class Switch(Node):
         )
         self.switch.WriteTableEntry(table_entry)
 
-    
-    def clear_rule_file(self):
-        global RULES_DIR
-        file_name = RULES_DIR + self.name
-        file = open(file_name, 'w')
-        file.close()
+    def set_sampling(self, rate):
+        global SAMPLE_FLOWS
+        rate = max(1, int(rate))
+        if rate == self.sample_rate:
+            return False
+        self.sample_rate = rate
+        if not DRY_RUN and not self.aggregate_only:
+            self.write_sampling()
+        return True
+
+    # the sampling action and the aggregate only one share the default entry
+    # of the telemetry_sampling table
+    def write_sampling(self):
+        global SAMPLE_FLOWS
+        if self.aggregate_only:
+            table_entry = self.p4info_helper.buildTableEntry(
+                table_name=SAMPLING_TABLE_NAME,
+                default_action=True,
+                action_name=AGGREGATE_ACTION
+            )
+        else:
+            table_entry = self.p4info_helper.buildTableEntry(
+                table_name=SAMPLING_TABLE_NAME,
+                default_action=True,
+                action_name=SAMPLING_ACTION,
+                action_params={'rate': self.sample_rate, 'perFlow': int(SAMPLE_FLOWS)}
+            )
+        self.switch.WriteTableEntry(table_entry)
+
+    def set_aggregate_only(self, enabled):
+        if enabled == self.aggregate_only:
+            return False
+        self.aggregate_only = enabled
+        if not DRY_RUN:
+            self.write_sampling()
+        return True
+
+    def max_rule_id(self):
+        return max([rule_id for action, rule_id in self.installed.values() if rule_id is not None] or [-1])
+
+    # The three registers are read with one ReadRequest, packets and sums
+    # only grow (modulo their width) so the report has their difference with
+    # the last read, and the max qdepth of the rules in the report is reset
+    # with one WriteRequest. Returns [[rule id, packets, sum of timedelta,
+    # max qdepth]]
+    def read_aggregates(self):
+        global AGGREGATE_REGISTERS
+        ids = [self.p4info_helper.get_registers_id(name) for name in AGGREGATE_REGISTERS]
+        request = p4runtime_pb2.ReadRequest()
+        request.device_id = self.switch.device_id
+        for register_id in ids:
+            request.entities.add().register_entry.register_id = register_id
+        values = dict((register_id, {}) for register_id in ids)
+        for response in self.switch.client_stub.Read(request):
+            for entity in response.entities:
+                entry = entity.register_entry
+                data = entry.data.bitstring
+                values[entry.register_id][entry.index.index] = int(binascii.hexlify(data), 16) if data else 0
+        pkts, delay_sum, max_qdepth = [values[register_id] for register_id in ids]
+
+        rules = []
+        for index in sorted(pkts):
+            count = (pkts[index] - self.last_pkts.get(index, 0)) & 0xffffffff
+            if count:
+                delay = (delay_sum.get(index, 0) - self.last_delay_sum.get(index, 0)) & 0xffffffffffffffff
+                rules.append([index, count, delay, max_qdepth.get(index, 0)])
+        self.last_pkts = pkts
+        self.last_delay_sum = delay_sum
+
+        if rules:
+            request = p4runtime_pb2.WriteRequest()
+            request.device_id = self.switch.device_id
+            request.election_id.low = 1
+            for rule in rules:
+                update = request.updates.add()
+                update.type = p4runtime_pb2.Update.MODIFY
+                update.entity.register_entry.register_id = ids[2]
+                update.entity.register_entry.index.index = rule[0]
+                update.entity.register_entry.data.bitstring = '\0'
+            self.switch.client_stub.Write(request)
+        return rules
 
+    
+    # switches above 255 take the second byte of the address
     def get_IPv4(self):
-        return '10.0.%d.0' % (int(self.name[1:])) # IPv4 table match
+        num = int(self.name[1:])
+        return '10.%d.%d.0' % (num >> 8, num & 0xff) # IPv4 table match
 
 
     def init_switch(self):
-        global CURRENT_DEVICE_ID, BASE_PORT
+        global CURRENT_DEVICE_ID, BASE_PORT, DEVICE_IDS
+        if self.name not in DEVICE_IDS:
+            DEVICE_IDS[self.name] = CURRENT_DEVICE_ID
+            CURRENT_DEVICE_ID += 1
+        device_id = DEVICE_IDS[self.name]
         self.switch = p4runtime_lib.bmv2.Bmv2SwitchConnection(
             name=self.name,
-            address='127.0.0.1:'+str(BASE_PORT + CURRENT_DEVICE_ID),
-            device_id=CURRENT_DEVICE_ID,
+            address='127.0.0.1:'+str(BASE_PORT + device_id),
+            device_id=device_id,
             proto_dump_file='logs/'+str(self.name)+'-p4runtime-requests.txt')
-        CURRENT_DEVICE_ID += 1
         # Send master arbitration update message to establish this controller as
         # master (required by P4Runtime before performing any other write operation)
         self.switch.MasterArbitrationUpdate()
@@ -163,28 +331,129 @@ class Switch(Node):
     #   'last_hop'    : boolean that identify if this is a last hop action
     #   'id'          : identifier of the rule to statistical use
     #}
+    # The rule is only queued, write_rules() gives it an id and sends it to
+    # the switch
     def add_rule(self, rule):
-        global FORWARD_ACTION, FORWARD_TABLE_NAME, FORWARD_MATCH_FIELD
         #self.print_rule(rule)
-        rule['id'] = len(self.rules)
         self.rules.append(rule)
 
-        table_entry = self.p4info_helper.buildTableEntry(
+    # Rules with the same forwarding address, port and last hop flag are
+    # aggregated with ORTC, the new rules are the ones written on the rules
+    # file, so the statistical controller resolves them as usual
+    def compress_rules(self):
+        routes = [(r['match_field'][0], r['match_field'][1], (r['dstAddr'], r['port'], r['last_hop'])) for r in self.rules]
+        self.rules = []
+        self.holes = []
+        for address, size, hop in compress_routes(routes):
+            if hop is None:
+                self.holes.append((address, size))
+            else:
+                self.add_rule({
+                    'match_field' : (address, size),
+                    'dstAddr' : hop[0],
+                    'port' : hop[1],
+                    'last_hop' : hop[2]
+                })
+
+    def build_table_entry(self, match_field, action, rule_id):
+        global FORWARD_ACTION, FORWARD_TABLE_NAME, FORWARD_MATCH_FIELD, NO_ROUTE_ACTION
+        if action is None:
+            return self.p4info_helper.buildTableEntry(
+                table_name=FORWARD_TABLE_NAME,
+                match_fields={FORWARD_MATCH_FIELD: match_field},
+                action_name=NO_ROUTE_ACTION
+            )
+        dstAddr, port, last_hop = action
+        return self.p4info_helper.buildTableEntry(
             table_name=FORWARD_TABLE_NAME,
-            match_fields={FORWARD_MATCH_FIELD: rule['match_field']},
+            match_fields={FORWARD_MATCH_FIELD: match_field},
             action_name=FORWARD_ACTION,
-            action_params={'dstAddr': rule['dstAddr'], 'port': rule['port'], 'ruleId': rule['id'], 'lastHop': int(rule['last_hop'])}   
+            action_params={'dstAddr': dstAddr, 'port': port, 'ruleId': rule_id, 'lastHop': int(last_hop)}
         )
-        
-        self.write_rule_on_file(rule)
-        self.switch.WriteTableEntry(table_entry)
-    
-    def write_rule_on_file(self, rule):
-        global RULES_DIR
-        file_name = RULES_DIR+self.name
-        file = open(file_name, 'a')
-        file.write(str(rule) + '\n')
-        file.close()
+
+    # entry of a DELETE update, only the match is needed
+    def build_match_entry(self, match_field):
+        global FORWARD_TABLE_NAME, FORWARD_MATCH_FIELD
+        return self.p4info_helper.buildTableEntry(
+            table_name=FORWARD_TABLE_NAME,
+            match_fields={FORWARD_MATCH_FIELD: match_field}
+        )
+
+    def new_rule_id(self):
+        if self.free_ids:
+            return heapq.heappop(self.free_ids)
+        self.next_id += 1
+        return self.next_id - 1
+
+    # Sends the entries as WriteRequests of WRITE_BATCH_SIZE updates, each
+    # request is sent without waiting for the previous ones to be answered,
+    # up to WRITE_WINDOW requests in flight
+    def send_updates(self, update_type, entries):
+        global WRITE_BATCH_SIZE, WRITE_WINDOW
+        in_flight = []
+        for start in range(0, len(entries), WRITE_BATCH_SIZE):
+            request = p4runtime_pb2.WriteRequest()
+            request.device_id = self.switch.device_id
+            request.election_id.low = 1
+            for table_entry in entries[start:start + WRITE_BATCH_SIZE]:
+                update = request.updates.add()
+                update.type = update_type
+                update.entity.table_entry.CopyFrom(table_entry)
+            if len(in_flight) == WRITE_WINDOW:
+                in_flight.pop(0).result()
+            in_flight.append(self.switch.client_stub.Write.future(request))
+        for future in in_flight:
+            future.result()
+
+    # Compares the queued rules with the installed entries: a match already
+    # installed keeps its rule id and is only modified when its action changed,
+    # new matches are inserted and the missing ones deleted. Inserts are sent
+    # first and deletes last, so no destination is left without a route while
+    # the table changes. The ids of deleted rules are only reused by later
+    # calls. Returns the number of updates, with DRY_RUN they are not sent
+    def write_rules(self):
+        wanted = []
+        for rule in self.rules:
+            wanted.append((rule['match_field'], (rule['dstAddr'], rule['port'], rule['last_hop']), rule))
+        for hole in self.holes:
+            wanted.append((hole, None, None))
+
+        installed = {}
+        inserts = []
+        modifies = []
+        deletes = []
+        freed = []
+        for match_field, action, rule in wanted:
+            if match_field in self.installed:
+                old_action, rule_id = self.installed[match_field]
+                if rule_id is None and action is not None:
+                    rule_id = self.new_rule_id()
+                elif rule_id is not None and action is None:
+                    freed.append(rule_id)
+                    rule_id = None
+                if old_action != action:
+                    modifies.append((match_field, action, rule_id))
+            else:
+                rule_id = None if action is None else self.new_rule_id()
+                inserts.append((match_field, action, rule_id))
+            if rule is not None:
+                rule['id'] = rule_id
+            installed[match_field] = (action, rule_id)
+
+        for match_field in self.installed:
+            if match_field not in installed:
+                deletes.append(match_field)
+                if self.installed[match_field][1] is not None:
+                    freed.append(self.installed[match_field][1])
+
+        if not DRY_RUN:
+            self.send_updates(p4runtime_pb2.Update.INSERT, [self.build_table_entry(*u) for u in inserts])
+            self.send_updates(p4runtime_pb2.Update.MODIFY, [self.build_table_entry(*u) for u in modifies])
+            self.send_updates(p4runtime_pb2.Update.DELETE, [self.build_match_entry(m) for m in deletes])
+        self.installed = installed
+        for rule_id in freed:
+            heapq.heappush(self.free_ids, rule_id)
+        return len(inserts) + len(modifies) + len(deletes)
 
 
     def print_rule(self, rule):
@@ -209,20 +478,41 @@ class Switch(Node):
 ###  * Used to add nodes and links to the network, create rules to be       ###
 ###    installed on switch tables and determine the next hop between        ###
 ###    distant switches to reduce the number of hops.                       ###
+###  * The topology can be updated with a new version of the topology file, ###
+###    only the switches whose links or next hops changed get their rules   ###
+###    rebuilt, and only the entries that differ are written on them        ###
 ###  * Structure:                                                           ###
 ###    - self.nodes         // dictionary {node_name -> node}               ###
 ###    - self.links         // list of tuples (src, dst, fw_rule)           ###
+###    - self.adjacency     // dictionary {node_name -> sorted neighbors}   ###
+###    - self.link_rules    // dictionary {(src, dst) -> fw_rule}           ###
+###    - self.ports         // dictionary {(src, dst) -> port}, kept when   ###
+###                         // the link goes down                           ###
+###    - self.routes        // RouteTable of the switches                   ###
+###    - self.rules_version // version of the last rules snapshot           ###
+###    - self.route_time, self.table_time, self.install_time,               ###
+###      self.snapshot_time // seconds spent by the last update computing   ###
+###                         // routes, filling the tables, writing them on  ###
+###                         // the switches and writing the snapshot        ###
 ###  * Methods:                                                             ###
 ###    - __init__ (file, p4info_helper, bmv2_file_path)                     ###
 ###    - add_node (node)                                                    ###
+###    - remove_node (name)                                                 ###
 ###    - make_rule (n1, n2, port)                                           ###
 ###    - has_link (node1, node2)                                            ###
 ###    - add_link(node1, node2, port)                                       ###
+###    - remove_link(node1, node2)                                          ###
 ###    - get_next_hop_for_all_sw(sw)                                        ###
 ###    - adjust_rule(rule, sw)                                              ###
-###    - fill_switch_tables()                                               ###
+###    - fill_switch_tables(names)                                          ###
+###    - compress_tables(names)     // compress_rules() of the switches     ###
+###    - install_rules(names)       // writes the rules of the switches     ###
+###                                 // concurrently                         ###
+###    - write_rules_snapshot()     // rules of all switches, in one write  ###
 ###    - build_host_ip(host)                                                ###
 ###    - build_topo(file, p4info_helper, bmv2_file_path)                    ###
+###    - read_topo(js)              // switches, hosts and links of a file  ###
+###    - update(js)                 // applies a new version of the file    ###
 ###############################################################################
 class Topology:
     # represents topology nodes
@@ -230,49 +520,121 @@ class Topology:
     def __init__(self, file, p4info_helper, bmv2_file_path):
         self.nodes = {}
         self.links = []
+        self.adjacency = {}
+        self.link_rules = {}
+        self.ports = {}
+        self.last_port = {}
+        self.routes = RouteTable()
+        self.p4info_helper = p4info_helper
+        self.bmv2_file_path = bmv2_file_path
+        self.route_time = 0
+        self.table_time = 0
+        self.install_time = 0
+        self.snapshot_time = 0
+        self.compression = None
+        self.rules_version = read_version(RULES_DIR + SNAPSHOT_FILE)
         self.build_topo(open(file), p4info_helper, bmv2_file_path)
 
+    # the host hSSK is host K of switch SS, the last byte wraps so that it
+    # stays valid on switches above 25
     def build_host_ip(self, host):
-        return '10.0.%d.%d' % (int(host[1:(len(host)-1)]) , int(host[1:]))
+        num = int(host[1:(len(host)-1)])
+        return '10.%d.%d.%d' % (num >> 8, num & 0xff, int(host[1:]) & 0xff)
 
     # Construction of the topology
     def build_topo(self, file, p4info_helper, bmv2_file_path):
         js = json.load(file)
-        
-        sw = [str(s) for s in js["switches"]]
-
-        sw_links = {}
-        sw.sort()
-        for s in sw:
-            self.add_node(Switch(s, p4info_helper, bmv2_file_path))
-            sw_links[s] = []
-
-        ht = [str(h) for h in js["hosts"]]
-        for h in ht:
-            self.add_node(Host(h, self.build_host_ip(h)))
-
-        lk = [[str(l[0]), str(l[1])] for l in js["links"]]
-
-        for (e1, e2) in lk:
+        file.close()
+        self.update(js)
+
+    # returns the sets of switches, hosts and links of a topology file, a link
+    # is a tuple (switch, neighbor) and each link between two switches appears
+    # once for each direction
+    def read_topo(self, js):
+        switches = set([str(s) for s in js["switches"]])
+        hosts = set([str(h) for h in js["hosts"]])
+        links = set()
+        for l in js["links"]:
+            e1, e2 = str(l[0]), str(l[1])
+            if e1 not in switches and e1 not in hosts or e2 not in switches and e2 not in hosts:
+                raise Exception("Link between unknown nodes " + e1 + " and " + e2)
             if e1[0] == 's':
-                sw_links[e1].append(e2)
+                links.add((e1, e2))
             if e2[0] == 's':
-                sw_links[e2].append(e1)
-
-        for sl in sw_links:
-            sw_links[sl].sort()
-            port = 1
-            for n in sw_links[sl]:
-                self.add_link(sl, n, port)
-                port += 1
-
-
-        file.close()
-        self.fill_switch_tables()
+                links.add((e2, e1))
+        return switches, hosts, links
+
+    # Applies the differences between the current topology and the topology
+    # file js: the links and nodes that are gone are removed first, then the
+    # new ones are added; a link that comes back gets its old port and a new
+    # link the port after the last one of its switch (ports are given in name
+    # order to the links of a new switch). Returns the number of changes and
+    # the number of updates written on the switches
+    def update(self, js):
+        global SWITCH, HOST, COMPRESS_ROUTES, ROUTE_WORKERS, SAMPLE_RATE
+        switches, hosts, links = self.read_topo(js)
+        current_switches = set([s for s in self.nodes if self.nodes[s].type == SWITCH])
+        current_hosts = set([h for h in self.nodes if self.nodes[h].type == HOST])
+        current_links = set(self.link_rules)
+        changed = set()
+
+        for (n1, n2) in sorted(current_links - links):
+            self.remove_link(n1, n2)
+            changed.add(n1)
+        for name in sorted((current_hosts - hosts) | (current_switches - switches)):
+            self.remove_node(name)
+            changed.discard(name)
+        for s in sorted(switches - current_switches):
+            self.add_node(Switch(s, self.p4info_helper, self.bmv2_file_path))
+            changed.add(s)
+        for h in sorted(hosts - current_hosts):
+            self.add_node(Host(h, self.build_host_ip(h)))
+        sampling = 0
+        for s in sorted(switches):
+            if self.nodes[s].set_sampling(js["switches"][s].get("sample_rate", SAMPLE_RATE)):
+                sampling += 1
+        for (n1, n2) in sorted(links - current_links):
+            port = self.ports.get((n1, n2))
+            if port is None:
+                port = self.last_port.get(n1, 0) + 1
+            self.add_link(n1, n2, port)
+            changed.add(n1)
+
+        start = time.time()
+        changed |= self.routes.recompute(ROUTE_WORKERS)
+        self.route_time = time.time() - start
+        start = time.time()
+        self.fill_switch_tables(changed)
+        if COMPRESS_ROUTES:
+            self.compression = self.compress_tables(changed)
+        self.table_time = time.time() - start
+        self.install_time, updates = self.install_rules(changed)
+        updates += self.check_aggregate_slots()
+        start = time.time()
+        self.write_rules_snapshot()
+        self.snapshot_time = time.time() - start
+        changes = len(links ^ current_links) + len(switches ^ current_switches) + len(hosts ^ current_hosts)
+        return changes, updates + sampling
 
 
     def add_node(self, node):
+        global SWITCH
         self.nodes[node.name] = node
+        self.adjacency[node.name] = []
+        if node.type == SWITCH:
+            self.routes.add_switch(node.name)
+
+    # the links of the node must have been removed before
+    def remove_node(self, name):
+        global SWITCH
+        node = self.nodes.pop(name)
+        del self.adjacency[name]
+        if node.type == SWITCH:
+            self.routes.remove_switch(name)
+            try:
+                node.get_switch().shutdown()
+            except Exception:
+                pass
 
     
     def make_rule(self, n1, n2, port):
@@ -283,23 +645,20 @@ class Topology:
         if n2.type == SWITCH:
             return {
                 'match_field' : (n2.get_IPv4(), 24), 
-                'dstAddr': '00:00:00:%02x:%02x:00' % (n2_num, n2_num),
+                'dstAddr': '00:00:%02x:%02x:%02x:00' % (n2_num >> 8, n2_num & 0xff, n2_num & 0xff),
                 'port' : port,
                 'last_hop' : False
             }    
         elif n2.type == HOST:
             return {
                 'match_field' : (n2.get_IPv4(), 32), 
-                'dstAddr': '00:00:00:00:%02x:%02x' % (n1_num, n2_num),
+                'dstAddr': '00:00:00:%02x:%02x:%02x' % (n1_num >> 8, n1_num & 0xff, n2_num & 0xff),
                 'port' : port,
                 'last_hop' : True
             }
 
     def has_link(self, node1, node2):
-        for link in self.links:
-            if (link[0] == node1 and link[1] == node2):
-                return True
-        return False
+        return (node1, node2) in self.link_rules
 
 
     def add_link(self, node1, node2, port):
@@ -315,34 +674,31 @@ class Topology:
         
         if n1.type == SWITCH:
             rule = self.make_rule(n1, n2, port)
-            n1.add_rule(rule)
             self.links.append((node1, node2, rule))
+            bisect.insort(self.adjacency[node1], node2)
+            self.link_rules[(node1, node2)] = rule
+            self.ports[(node1, node2)] = port
+            self.last_port[node1] = max(self.last_port.get(node1, 0), port)
+            if n2.type == SWITCH:
+                self.routes.add_link(node1, node2)
+
+    def remove_link(self, node1, node2):
+        global SWITCH
+        rule = self.link_rules.pop((node1, node2))
+        self.links.remove((node1, node2, rule))
+        self.adjacency[node1].remove(node2)
+        if self.nodes[node2].type == SWITCH:
+            self.routes.remove_link(node1, node2)
         
     #returns a dictionary associating each switch to the rule that represents the next hop
-    #from the argument sw to this switch 
+    #from the argument sw to this switch, None if it can not be reached; the
+    #routes must have been computed by update()
     def get_next_hop_for_all_sw (self, sw):
         global SWITCH
-        answer = {}
-        switches = [s for s in self.nodes if self.nodes[s].type == SWITCH and s != sw]
-        
-        next_hop =  {s : None for s in switches} # will contains the next hop for all switches
-        
-        queue = [sw]
-        
-        while len(queue) > 0:
-            current = queue[0]
-            queue = queue[1:]
-
-            current_links = [l for l in self.links if l[0] == current]
-            for link in current_links:
-                other_sw = link[1] 
-                if other_sw != sw and self.nodes[other_sw].type == SWITCH and next_hop[other_sw] == None:
-                    if current == sw:
-                        next_hop[other_sw] = link[2]
-                    else:
-                        next_hop[other_sw] = next_hop[current]
-                    queue.append(other_sw)
-
+        assert not self.routes.dirty, "routes changed since update() computed them"
+        next_hop = {s : None for s in self.nodes if self.nodes[s].type == SWITCH and s != sw}
+        for dst, hop in self.routes.next_hops_of(sw).items():
+            next_hop[dst] = self.link_rules[(sw, hop)]
         return next_hop
         
     # Modify an existing rule changing the match fields to map for other switch to the same
@@ -356,15 +712,114 @@ class Topology:
             }    
 
     # create entries on tables switches to represent each switch that are not connected with it so that they can route to each other
-    def fill_switch_tables(self):
+    # only the switches in names are filled, all of them by default
+    def fill_switch_tables(self, names=None):
         global SWITCH
         switches = [self.nodes[s] for s in self.nodes if self.nodes[s].type == SWITCH]
         for s1 in range(len(switches)):
+            if names is not None and switches[s1].name not in names:
+                continue
+            switches[s1].rules = []
+            switches[s1].holes = []
+            for n in self.adjacency[switches[s1].name]:
+                switches[s1].add_rule(dict(self.link_rules[(switches[s1].name, n)]))
             next_hops = self.get_next_hop_for_all_sw(switches[s1].name)
             for s2 in range(len(switches)):
-                if s1!=s2 and not self.has_link(switches[s1].name, switches[s2].name):
+                if s1!=s2 and not self.has_link(switches[s1].name, switches[s2].name) and next_hops[switches[s2].name] is not None:
                     switches[s1].add_rule(self.adjust_rule(next_hops[switches[s2].name], switches[s2]))
 
+    # returns the number of table entries before and after the compression
+    def compress_tables(self, names=None):
+        global SWITCH
+        before = 0
+        after = 0
+        for s in self.nodes:
+            if self.nodes[s].type == SWITCH and (names is None or s in names):
+                before += len(self.nodes[s].rules)
+                self.nodes[s].compress_rules()
+                after += len(self.nodes[s].rules) + len(self.nodes[s].holes)
+        return before, after
+
+    # write the queued rules of each switch on its own thread, so the requests
+    # to different switches are in flight at the same time; returns the time
+    # spent and the number of updates sent
+    def install_rules(self, names=None):
+        global SWITCH
+        switches = [self.nodes[s] for s in self.nodes if self.nodes[s].type == SWITCH and (names is None or s in names)]
+        errors = []
+        updates = []
+        def write(sw):
+            try:
+                updates.append(sw.write_rules())
+            except Exception as e:
+                errors.append((sw.name, e))
+
+        start = time.time()
+        threads = [threading.Thread(target=write, args=(sw,)) for sw in switches]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        if errors:
+            raise Exception("Failed to install rules on " + ', '.join(['%s (%s)' % e for e in errors]))
+        return time.time() - start, sum(updates)
+
+    # Rules with an id at or above AGGREGATE_SLOTS have no aggregation
+    # register: they are reported, and with AGGREGATE_ONLY their switch goes
+    # back to cloning telemetry reports until its rule ids fit again.
+    # Returns the number of sampling entries written
+    def check_aggregate_slots(self):
+        global SWITCH, AGGREGATE_TARGET, AGGREGATE_ONLY, AGGREGATE_SLOTS
+        if not AGGREGATE_TARGET and not AGGREGATE_ONLY:
+            return 0
+        updates = 0
+        over = []
+        for name in sorted(self.nodes):
+            sw = self.nodes[name]
+            if sw.type != SWITCH:
+                continue
+            fits = sw.max_rule_id() < AGGREGATE_SLOTS
+            if not fits:
+                over.append(name)
+            if AGGREGATE_ONLY and sw.set_aggregate_only(fits):
+                updates += 1
+        if over:
+            print 'Warning: rule ids of %s reach the %d aggregation register slots, their rules past it are not aggregated%s' % (
+                ', '.join(over), AGGREGATE_SLOTS, ' and they keep cloning telemetry reports' if AGGREGATE_ONLY else '')
+        return updates
+
+    # reads the aggregation registers of every switch, each on its own thread;
+    # returns the switches of the register report and the read errors
+    def read_aggregates(self):
+        global SWITCH
+        switches = [n for n in self.nodes.values() if n.type == SWITCH]
+        reports = []
+        errors = []
+        def read(sw):
+            try:
+                rules = sw.read_aggregates()
+                if rules:
+                    reports.append({'id' : int(sw.name[1:]), 'name' : sw.name, 'rules' : rules})
+            except Exception as e:
+                errors.append((sw.name, e))
+
+        threads = [threading.Thread(target=read, args=(sw,)) for sw in switches]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        return reports, errors
+
+    # the snapshot has a new version each time, so the statistical controller
+    # only reloads it when it changed
+    def write_rules_snapshot(self):
+        global SWITCH, RULES_DIR
+        self.rules_version += 1
+        switches = [s for s in self.nodes if self.nodes[s].type == SWITCH]
+        write_snapshot(RULES_DIR + SNAPSHOT_FILE, self.rules_version,
+                       dict((int(s[1:]), self.nodes[s].rules) for s in switches),
+                       dict((int(s[1:]), self.nodes[s].sample_rate) for s in switches))
+
 
 
 ###############################################################################
@@ -372,12 +827,30 @@ class Topology:
 ###############################################################################  
 
 
+# sends a register report of the switches of topo to AGGREGATE_TARGET every
+# AGGREGATE_TIME seconds, runs on its own thread next to the topology watch
+def poll_registers(topo):
+    global AGGREGATE_TARGET, AGGREGATE_TIME
+    sock, address = open_endpoint(AGGREGATE_TARGET)
+    last = time.time()
+    while True:
+        sleep(max(0, last + AGGREGATE_TIME - time.time()))
+        current = time.time()
+        switches, errors = topo.read_aggregates()
+        if errors:
+            print 'Failed to read the registers of ' + ', '.join(['%s (%s)' % e for e in errors])
+        for datagram in encode_partials('controller', current, current - last, switches):
+            try:
+                sock.sendto(datagram, address)
+            except socket.error:
+                pass
+        last = current
 
 
 def main(p4info_file_path, bmv2_file_path):
-    global RULES_DIR
+    global RULES_DIR, TOPOLOGY_FILE, WATCH_TIME, DRY_RUN, AGGREGATE_TARGET
     # Instantiate a P4Runtime helper from the p4info file
-    p4info_helper = p4runtime_lib.helper.P4InfoHelper(p4info_file_path)
+    p4info_helper = None if DRY_RUN else p4runtime_lib.helper.P4InfoHelper(p4info_file_path)
 
     try:
         print '####################################'
@@ -393,7 +866,41 @@ def main(p4info_file_path, bmv2_file_path):
         RULES_DIR = RULES_DIR + '/'
         
         
-        topo = Topology('topology.json', p4info_helper, bmv2_file_path)
+        topo = Topology(TOPOLOGY_FILE, p4info_helper, bmv2_file_path)
+        switches = [n for n in topo.nodes.values() if n.type == SWITCH]
+        if topo.compression:
+            print 'Compressed %d forwarding rules into %d table entries' % topo.compression
+        if DRY_RUN:
+            print 'Computed %d table entries for %d switches, written on %s' % (
+                sum([len(sw.rules) + len(sw.holes) for sw in switches]), len(switches), RULES_DIR + SNAPSHOT_FILE)
+        else:
+            print 'Installed %d table entries on %d switches in %.3f seconds' % (
+                sum([len(sw.rules) + len(sw.holes) for sw in switches]), len(switches), topo.install_time)
+
+        poller = None
+        if AGGREGATE_TARGET and not DRY_RUN:
+            poller = threading.Thread(target=poll_registers, args=(topo,))
+            poller.daemon = True
+            poller.start()
+            print 'Sending the aggregation registers to %s every %g seconds' % (AGGREGATE_TARGET, AGGREGATE_TIME)
+
+        last_change = os.stat(TOPOLOGY_FILE).st_mtime
+        while WATCH_TIME > 0:
+            sleep(WATCH_TIME)
+            if os.stat(TOPOLOGY_FILE).st_mtime == last_change:
+                continue
+            last_change = os.stat(TOPOLOGY_FILE).st_mtime
+            try:
+                js = json.load(open(TOPOLOGY_FILE))
+            except ValueError:
+                print 'Invalid topology file, waiting for the next change'
+                continue
+            start = time.time()
+            changes, updates = topo.update(js)
+            print 'Applied %d topology changes with %d table updates in %.3f seconds' % (
+                changes, updates, time.time() - start)
+        while poller is not None and poller.is_alive():
+            poller.join(1)
         
         
         ## THE END
@@ -412,13 +919,41 @@ if __name__ == '__main__':
     parser.add_argument('--bmv2-json', help='BMv2 JSON file from p4c',
                         type=str, action="store", required=False,
                         default='./build/mri.json')
+    parser.add_argument('--route-workers', help='Processes used to compute the routes between switches',
+                        type=int, action="store", required=False,
+                        default=0)
+    parser.add_argument('--compress-routes', help='Install the smallest LPM table equivalent to the forwarding rules of each switch',
+                        action="store_true", required=False, default=False)
+    parser.add_argument('--dry-run', help='Only compute the rules and write them on the rules snapshot, without connecting to the switches',
+                        action="store_true", required=False, default=False)
+    parser.add_argument('--sample-rate', help='Clone 1 in SAMPLE_RATE telemetry reports to the statistical controller, unless the switch sets sample_rate on the topology file',
+                        type=int, action="store", required=False, default=1)
+    parser.add_argument('--sample-flows', help='Sample the telemetry reports by the hash of the flow instead of counting packets',
+                        action="store_true", required=False, default=False)
+    parser.add_argument('--aggregate-to', help='Read the aggregation registers of the switches and send them to stat.py --registers at udp:host:port or unix:/path',
+                        type=str, action="store", required=False, default=None)
+    parser.add_argument('--aggregate-time', help='Seconds between two reads of the aggregation registers',
+                        type=float, action="store", required=False, default=1)
+    parser.add_argument('--aggregate-only', help='Switches only keep the aggregation registers, no telemetry report is cloned',
+                        action="store_true", required=False, default=False)
+    parser.add_argument('--watch', help='Keep running and apply the changes of the topology file, checking it every WATCH seconds',
+                        type=float, action="store", required=False, default=0)
     args = parser.parse_args()
-
-    if not os.path.exists(args.p4info):
+    ROUTE_WORKERS = args.route_workers
+    COMPRESS_ROUTES = args.compress_routes
+    WATCH_TIME = args.watch
+    DRY_RUN = args.dry_run
+    SAMPLE_RATE = args.sample_rate
+    SAMPLE_FLOWS = args.sample_flows
+    AGGREGATE_TARGET = args.aggregate_to
+    AGGREGATE_TIME = args.aggregate_time
+    AGGREGATE_ONLY = args.aggregate_only
+
+    if not DRY_RUN and not os.path.exists(args.p4info):
         parser.print_help()
         print "\np4info file not found: %s\nHave you run 'make'?" % args.p4info
         parser.exit(1)
-    if not os.path.exists(args.bmv2_json):
+    if not DRY_RUN and not os.path.exists(args.bmv2_json):
         parser.print_help()
         print "\nBMv2 JSON file not found: %s\nHave you run 'make'?" % args.bmv2_json
         parser.exit(1)
@@ -0,0 +1,215 @@
+import errno
+import fcntl
+import heapq
+import os
+import select
+import time
+from collections import deque
+
+
+# longest time (in seconds) the loop sleeps on select when there is no timer
+LOOP_TIMEOUT = 0.1
+# bytes written at once by an AsyncWriter
+WRITE_CHUNK = 1 << 16
+
+
+###############################################################################
+### class EventLoop                                                         ###
+###  * Single threaded, select based loop running three kinds of callbacks: ###
+###    readers/writers of file descriptors, tasks and periodic timers       ###
+###  * A task is a callable run on every iteration that returns True while  ###
+###    it has more work queued, so the loop only sleeps on select when no   ###
+###    task is busy                                                         ###
+###  * Structure:                                                           ###
+###    - self.readers       // {fd -> callback}                             ###
+###    - self.writers       // {fd -> callback}                             ###
+###    - self.tasks                                                         ###
+###    - self.timers        // heap of (deadline, interval, callback)       ###
+###  * Methods:                                                             ###
+###    - add_reader(fd, callback), remove_reader(fd)                        ###
+###    - add_writer(fd, callback), remove_writer(fd)                        ###
+###    - add_task(task)                                                     ###
+###    - call_every(interval, callback)                                     ###
+###    - run(), stop()                                                      ###
+###############################################################################
+class EventLoop:
+
+  def __init__(self):
+    self.readers = {}
+    self.writers = {}
+    self.tasks = []
+    self.timers = []
+    self.running = False
+    self.busy = False
+
+  def add_reader(self, fd, callback):
+    self.readers[fd] = callback
+
+  def remove_reader(self, fd):
+    self.readers.pop(fd, None)
+
+  def add_writer(self, fd, callback):
+    self.writers[fd] = callback
+
+  def remove_writer(self, fd):
+    self.writers.pop(fd, None)
+
+  def add_task(self, task):
+    self.tasks.append(task)
+
+  def call_every(self, interval, callback):
+    heapq.heappush(self.timers, (time.time() + interval, interval, callback))
+
+  def stop(self):
+    self.running = False
+
+  def run_once(self):
+    if self.busy:
+      timeout = 0
+    elif self.timers:
+      timeout = min(max(self.timers[0][0] - time.time(), 0), LOOP_TIMEOUT)
+    else:
+      timeout = LOOP_TIMEOUT
+
+    if self.readers or self.writers:
+      readable, writable, _ = select.select(list(self.readers), list(self.writers), [], timeout)
+    else:
+      readable, writable = [], []
+      time.sleep(timeout)
+    for fd in readable:
+      if fd in self.readers:
+        self.readers[fd]()
+    for fd in writable:
+      if fd in self.writers:
+        self.writers[fd]()
+
+    busy = False
+    for task in self.tasks:
+      if task():
+        busy = True
+    self.busy = busy
+
+    current = time.time()
+    while self.timers and self.timers[0][0] <= current:
+      deadline, interval, callback = heapq.heappop(self.timers)
+      callback()
+      heapq.heappush(self.timers, (max(deadline + interval, current), interval, callback))
+
+  def run(self):
+    self.running = True
+    while self.running:
+      self.run_once()
+
+
+###############################################################################
+### class BoundedQueue                                                      ###
+###  * FIFO between two stages of the loop that never grows past limit:     ###
+###    items offered to a full queue are dropped and counted, so a slow     ###
+###    stage can not make the previous one wait                             ###
+###  * Structure:                                                           ###
+###    - self.items                                                         ###
+###    - self.limit                                                         ###
+###    - self.dropped                                                       ###
+###    - self.high_water    // largest length seen                          ###
+###  * Methods:                                                             ###
+###    - put_many(items)            // returns how many were accepted       ###
+###    - get_many(max_items)                                                ###
+###############################################################################
+class BoundedQueue:
+
+  def __init__(self, limit):
+    self.items = deque()
+    self.limit = limit
+    self.dropped = 0
+    self.high_water = 0
+
+  def __len__(self):
+    return len(self.items)
+
+  def put_many(self, items):
+    room = self.limit - len(self.items)
+    if room < len(items):
+      self.dropped += len(items) - max(room, 0)
+      items = items[:max(room, 0)]
+    self.items.extend(items)
+    self.high_water = max(self.high_water, len(self.items))
+    return len(items)
+
+  def get_many(self, max_items):
+    items = self.items
+    return [items.popleft() for i in range(min(max_items, len(items)))]
+
+
+###############################################################################
+### class AsyncWriter                                                       ###
+###  * Writes text to a file descriptor set to non blocking mode, only when ###
+###    the loop reports it as writable, buffering at most limit bytes;      ###
+###    texts that do not fit are dropped and counted                        ###
+###  * Structure:                                                           ###
+###    - self.loop                                                          ###
+###    - self.fd                                                            ###
+###    - self.chunks        // texts waiting to be written                  ###
+###    - self.size          // bytes on self.chunks                         ###
+###    - self.limit                                                         ###
+###    - self.dropped                                                       ###
+###    - self.flags         // flags of fd before it was made non blocking  ###
+###  * Methods:                                                             ###
+###    - write(text)                // returns False if the text was dropped###
+###    - on_writable()              // called by the loop                   ###
+###    - close(drain)               // drain writes the buffered texts      ###
+###############################################################################
+class AsyncWriter:
+
+  def __init__(self, loop, fd, limit):
+    self.loop = loop
+    self.fd = fd
+    self.chunks = deque()
+    self.size = 0
+    self.limit = limit
+    self.dropped = 0
+    self.flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+    fcntl.fcntl(fd, fcntl.F_SETFL, self.flags | os.O_NONBLOCK)
+
+  def write(self, text):
+    if self.size + len(text) > self.limit:
+      self.dropped += 1
+      return False
+    if not self.chunks:
+      self.loop.add_writer(self.fd, self.on_writable)
+    self.chunks.append(text)
+    self.size += len(text)
+    return True
+
+  def on_writable(self):
+    data = ''
+    while self.chunks and len(data) < WRITE_CHUNK:
+      data += self.chunks.popleft()
+    try:
+      written = os.write(self.fd, data)
+    except OSError as e:
+      if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+        raise
+      written = 0
+    if written < len(data):
+      self.chunks.appendleft(data[written:])
+    self.size -= written
+    if not self.chunks:
+      self.loop.remove_writer(self.fd)
+
+  # gives the descriptor its original flags back, the buffered texts are
+  # lost unless drain, then they are written blocking on the descriptor
+  def close(self, drain=False):
+    self.loop.remove_writer(self.fd)
+    fcntl.fcntl(self.fd, fcntl.F_SETFL, self.flags)
+    while drain and self.chunks:
+      data = self.chunks.popleft()
+      while data:
+        try:
+          data = data[os.write(self.fd, data):]
+        except OSError as e:
+          if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+            raise
+          # the descriptor was non blocking before the writer took it
+          select.select([], [self.fd], [])
+    self.chunks.clear()
+    self.size = 0
@@ -0,0 +1,524 @@
+#!/usr/bin/env python
+import argparse
+import json
+import math
+import os
+import socket
+import struct
+import sys
+import time
+from array import array
+
+try:
+  import numpy as np
+except ImportError:
+  np = None
+
+
+###############################################################################
+#####################            STORE LAYOUT             #####################
+###############################################################################
+
+# A history store is a directory written by one collector:
+#   store.json                   format, partition time and index block
+#   p<start>/                    one partition per PARTITION_TIME seconds of
+#                                collector time, start is a multiple of it
+#     hops.<column>              one file per column of HOP_COLUMNS
+#     hops.index                 sparse time index: (min time, max time) of
+#                                every INDEX_BLOCK rows of the hops
+#     rollup.<column>            one file per column of ROLLUP_COLUMNS
+# Every file is append only, with the values of its column packed in little
+# endian, so row i of a table is the i-th value of each of its files and is
+# read by mapping them as NumPy arrays. A switch and second can have more
+# than one rollup row (one per append), their counters are added on queries.
+# The sharded collector writes one store per worker under the directory given
+# to stat.py, queries read every store found there
+
+STORE_FILE = 'store.json'
+STORE_FORMAT = 2
+# seconds of collector time on each partition
+PARTITION_TIME = 600
+# rows covered by each entry of the sparse time index
+INDEX_BLOCK = 4096
+# rows buffered by the writer before appending them to the files
+FLUSH_ROWS = 8192
+# longest collector time (in seconds) rows stay buffered on the writer
+FLUSH_TIME = 1
+
+# (column, array typecode, NumPy dtype)
+HOP_COLUMNS = [
+  ('time', 'd', '<f8'),         # collector time of the frame
+  ('swid', 'H', '<u2'),
+  ('rule_id', 'H', '<u2'),
+  ('src', 'I', '<u4'),          # source address of the frame
+  ('qdepth', 'I', '<u4'),
+  ('timestamp', 'I', '<u4'),
+  ('timedelta', 'I', '<u4'),    # us
+  ('weight', 'I', '<u4'),       # packets the hop stands for (sampling)
+]
+# hops of each switch on each second of collector time, weighted
+ROLLUP_COLUMNS = [
+  ('second', 'I', '<u4'),
+  ('swid', 'H', '<u2'),
+  ('pkts', 'I', '<u4'),
+  ('delay_sum', 'd', '<f8'),
+  ('delay_max', 'I', '<u4'),
+  ('queue_sum', 'd', '<f8'),
+  ('queue_max', 'I', '<u4'),
+]
+INDEX_COLUMN = ('index', 'd', '<f8')
+
+ADDR = struct.Struct('!I')
+
+for name, code, dtype in HOP_COLUMNS + ROLLUP_COLUMNS:
+  assert array(code).itemsize == int(dtype[2:])
+
+
+def column_path(partition, table, name):
+  return os.path.join(partition, '%s.%s' % (table, name))
+
+def column_rows(path, code):
+  try:
+    return os.path.getsize(path) // array(code).itemsize
+  except OSError:
+    return 0
+
+# rows of a table, the shortest of its columns (the last append may be cut)
+def table_rows(partition, table, columns):
+  return min([column_rows(column_path(partition, table, name), code) for name, code, dtype in columns])
+
+def append_column(f, values):
+  if sys.byteorder != 'little':
+    values = array(values.typecode, values)
+    values.byteswap()
+  values.tofile(f)
+
+# rows [start, stop) of a column: a NumPy array mapped on the file, or an
+# array read from it when NumPy is not available
+def read_column(path, code, dtype, start, stop):
+  if stop <= start:
+    return np.zeros(0, dtype=dtype) if np is not None else array(code)
+  if np is not None:
+    return np.memmap(path, dtype=dtype, mode='r', offset=start * np.dtype(dtype).itemsize, shape=(stop - start,))
+  values = array(code)
+  with open(path, 'rb') as f:
+    f.seek(start * values.itemsize)
+    values.fromfile(f, stop - start)
+  if sys.byteorder != 'little':
+    values.byteswap()
+  return values
+
+def format_addr(value):
+  return socket.inet_ntoa(ADDR.pack(int(value)))
+
+# the config of the store at root, created with the defaults when asked
+def open_store(root, create=False):
+  path = os.path.join(root, STORE_FILE)
+  if os.path.exists(path):
+    with open(path) as f:
+      config = json.load(f)
+    if config['format'] != STORE_FORMAT:
+      raise Exception("Unknown history store format %s on %s" % (config['format'], root))
+    return config
+  if not create:
+    raise Exception("No history store on " + root)
+  if not os.path.isdir(root):
+    os.makedirs(root)
+  config = {'format' : STORE_FORMAT, 'partition_time' : PARTITION_TIME, 'index_block' : INDEX_BLOCK}
+  with open(path + '.tmp', 'w') as f:
+    json.dump(config, f)
+  os.rename(path + '.tmp', path)
+  return config
+
+
+###############################################################################
+### class HistoryWriter                                                     ###
+###  * Appends the hops decoded by the collector to a history store, with   ###
+###    the per second rollups of each switch; rows are buffered on arrays   ###
+###    and appended every FLUSH_ROWS rows or FLUSH_TIME seconds, so the     ###
+###    packet processing path never waits on a write per hop                ###
+###  * Partitions left with a cut append (the collector was killed) are     ###
+###    truncated to their last complete row when opened again, and the      ###
+###    index entries of complete blocks whose append was lost are rebuilt   ###
+###    from the time column                                                 ###
+###  * Structure:                                                           ###
+###    - self.root, self.partition_time, self.index_block                   ###
+###    - self.partition     // start time of the open partition             ###
+###    - self.files         // {file name -> file open for appending}       ###
+###    - self.hops          // buffered rows, one array per column          ###
+###    - self.rollups       // {(second, swid) -> [pkts, delay sum, delay   ###
+###                         // max, queue sum, queue max]} buffered         ###
+###    - self.block_rows, self.block_min, self.block_max  // rows of the    ###
+###                         // last index block, not on the index yet       ###
+###  * Methods:                                                             ###
+###    - __init__ (root)                                                    ###
+###    - add(time, src, hops, weight)  // hops as returned by decode_frame  ###
+###    - flush(), close()                                                   ###
+###############################################################################
+class HistoryWriter:
+
+  def __init__(self, root):
+    config = open_store(root, create=True)
+    self.root = root
+    self.partition_time = config['partition_time']
+    self.index_block = config['index_block']
+    self.partition = None
+    self.files = {}
+    self.hops = [array(code) for name, code, dtype in HOP_COLUMNS]
+    self.rollups = {}
+    self.block_rows = 0
+    self.block_min = None
+    self.block_max = None
+    self.last_flush = None
+
+  def open_partition(self, start):
+    self.close_files()
+    self.partition = start
+    path = os.path.join(self.root, 'p%d' % start)
+    if not os.path.isdir(path):
+      os.makedirs(path)
+    rows = table_rows(path, 'hops', HOP_COLUMNS)
+    entries = rows // self.index_block
+    indexed = min(column_rows(column_path(path, 'hops', 'index'), 'd') // 2, entries)
+    rollup_rows = table_rows(path, 'rollup', ROLLUP_COLUMNS)
+    for table, columns, n in [('hops', HOP_COLUMNS, rows), ('hops', [INDEX_COLUMN], 2 * indexed),
+                              ('rollup', ROLLUP_COLUMNS, rollup_rows)]:
+      for name, code, dtype in columns:
+        f = open(column_path(path, table, name), 'ab')
+        f.truncate(n * array(code).itemsize)
+        self.files[table + '.' + name] = f
+    # the columns of these blocks were appended but not their index
+    missing = array('d')
+    for block in range(indexed, entries):
+      times = read_column(column_path(path, 'hops', 'time'), 'd', '<f8',
+                          block * self.index_block, (block + 1) * self.index_block)
+      missing.extend((float(min(times)), float(max(times))))
+    if missing:
+      append_column(self.files['hops.index'], missing)
+      self.files['hops.index'].flush()
+    self.block_rows = rows - entries * self.index_block
+    self.block_min = None
+    self.block_max = None
+    if self.block_rows:
+      times = read_column(column_path(path, 'hops', 'time'), 'd', '<f8', rows - self.block_rows, rows)
+      self.block_min = float(min(times))
+      self.block_max = float(max(times))
+
+  def add(self, t, src, hops, weight=1):
+    start = int(t // self.partition_time) * self.partition_time
+    if start != self.partition:
+      self.flush()
+      self.open_partition(start)
+      self.last_flush = t
+    addr = ADDR.unpack(socket.inet_aton(src))[0]
+    second = int(t)
+    times, swids, rule_ids, srcs, qdepths, timestamps, timedeltas, weights = self.hops
+    rollups = self.rollups
+    for swid, qdepth, timestamp, timedelta, rule_id in hops:
+      times.append(t)
+      swids.append(swid)
+      rule_ids.append(rule_id)
+      srcs.append(addr)
+      qdepths.append(qdepth)
+      timestamps.append(timestamp)
+      timedeltas.append(timedelta)
+      weights.append(weight)
+      try:
+        r = rollups[(second, swid)]
+        r[0] += weight
+        r[1] += timedelta * weight
+        if timedelta > r[2]:
+          r[2] = timedelta
+        r[3] += qdepth * weight
+        if qdepth > r[4]:
+          r[4] = qdepth
+      except KeyError:
+        rollups[(second, swid)] = [weight, timedelta * weight, timedelta, qdepth * weight, qdepth]
+    if len(times) >= FLUSH_ROWS or t - self.last_flush > FLUSH_TIME:
+      self.flush()
+      self.last_flush = t
+
+  # the index is appended after the columns and only for complete blocks, so
+  # it never points past the rows on the files
+  def flush(self):
+    if self.partition is None:
+      return
+    times = self.hops[0]
+    index = array('d')
+    done = 0
+    while done < len(times):
+      take = min(self.index_block - self.block_rows, len(times) - done)
+      assert 0 <= take, "index block past its size"
+      block = times[done:done + take]
+      low, high = min(block), max(block)
+      if self.block_min is None or low < self.block_min:
+        self.block_min = low
+      if self.block_max is None or high > self.block_max:
+        self.block_max = high
+      self.block_rows += take
+      done += take
+      if self.block_rows == self.index_block:
+        index.extend((self.block_min, self.block_max))
+        self.block_rows = 0
+        self.block_min = None
+        self.block_max = None
+
+    for (name, code, dtype), values in zip(HOP_COLUMNS, self.hops):
+      append_column(self.files['hops.' + name], values)
+    for (name, code, dtype) in HOP_COLUMNS:
+      self.files['hops.' + name].flush()
+    append_column(self.files['hops.index'], index)
+    self.files['hops.index'].flush()
+
+    rollups = [array(code) for name, code, dtype in ROLLUP_COLUMNS]
+    for (second, swid), r in sorted(self.rollups.items()):
+      for column, value in zip(rollups, (second, swid) + tuple(r)):
+        column.append(value)
+    for (name, code, dtype), values in zip(ROLLUP_COLUMNS, rollups):
+      append_column(self.files['rollup.' + name], values)
+      self.files['rollup.' + name].flush()
+
+    self.hops = [array(code) for name, code, dtype in HOP_COLUMNS]
+    self.rollups = {}
+
+  def close_files(self):
+    for f in self.files.values():
+      f.close()
+    self.files = {}
+
+  def close(self):
+    self.flush()
+    self.close_files()
+    self.partition = None
+
+
+###############################################################################
+### class HistoryReader                                                     ###
+###  * Scans the stores under a directory for the rows of a time range:     ###
+###    partitions outside the range are skipped by their name, and on the   ###
+###    hops only the index blocks that overlap the range (and the tail of   ###
+###    rows not indexed yet) are read                                       ###
+###  * Columns are NumPy arrays when NumPy is available and arrays or lists ###
+###    otherwise                                                            ###
+###  * Structure:                                                           ###
+###    - self.partitions    // [(start, end, path, index block)] of every   ###
+###                         // store, sorted by start                       ###
+###    - self.scanned       // partitions and rows read by the scans        ###
+###  * Methods:                                                             ###
+###    - __init__ (root)                                                    ###
+###    - scan(table, t1, t2, names, filters)  // {name -> values} of the    ###
+###                         // rows with t1 <= time < t2 and the values of  ###
+###                         // filters, [(column, value)]                   ###
+###############################################################################
+class HistoryReader:
+
+  def __init__(self, root):
+    if not os.path.isdir(root):
+      raise Exception("No history store on " + root)
+    stores = [os.path.join(root, d) for d in sorted(os.listdir(root))
+              if os.path.exists(os.path.join(root, d, STORE_FILE))]
+    if os.path.exists(os.path.join(root, STORE_FILE)):
+      stores.insert(0, root)
+    if not stores:
+      raise Exception("No history store on " + root)
+    self.partitions = []
+    for store in stores:
+      config = open_store(store)
+      for d in os.listdir(store):
+        if d.startswith('p') and d[1:].isdigit():
+          start = int(d[1:])
+          self.partitions.append((start, start + config['partition_time'], os.path.join(store, d), config['index_block']))
+    self.partitions.sort()
+    self.scanned = {'partitions' : 0, 'rows' : 0}
+
+  # [start, stop) row ranges of the hops of a partition that can be on the
+  # range, from its sparse index
+  def hop_ranges(self, path, index_block, rows, t1, t2):
+    entries = min(column_rows(column_path(path, 'hops', 'index'), 'd') // 2, rows // index_block)
+    index = read_column(column_path(path, 'hops', 'index'), 'd', '<f8', 0, 2 * entries)
+    if np is not None:
+      index = index.tolist()
+    ranges = []
+    for i in range(entries):
+      if index[2 * i + 1] >= t1 and index[2 * i] < t2:
+        if ranges and ranges[-1][1] == i * index_block:
+          ranges[-1][1] = (i + 1) * index_block
+        else:
+          ranges.append([i * index_block, (i + 1) * index_block])
+    if entries * index_block < rows:
+      ranges.append([entries * index_block, rows])
+    return ranges
+
+  def scan(self, table, t1, t2, names, filters=()):
+    if table == 'hops':
+      columns, time_name = HOP_COLUMNS, 'time'
+    else:
+      columns, time_name = ROLLUP_COLUMNS, 'second'
+    wanted = set(names) | set([time_name]) | set([name for name, value in filters])
+    columns = [c for c in columns if c[0] in wanted]
+    chunks = dict((name, []) for name in names)
+
+    for start, end, path, index_block in self.partitions:
+      if end <= t1 or start >= t2:
+        continue
+      rows = table_rows(path, table, columns)
+      if table == 'hops' and (start < t1 or end > t2):
+        ranges = self.hop_ranges(path, index_block, rows, t1, t2)
+      else:
+        ranges = [[0, rows]]
+      self.scanned['partitions'] += 1
+      for first, last in ranges:
+        chunk = dict((name, read_column(column_path(path, table, name), code, dtype, first, last))
+                     for name, code, dtype in columns)
+        self.scanned['rows'] += last - first
+        for name, values in select(chunk, time_name, t1, t2, filters).items():
+          if name in chunks:
+            chunks[name].append(values)
+
+    if np is not None:
+      dtypes = dict((name, dtype) for name, code, dtype in HOP_COLUMNS + ROLLUP_COLUMNS)
+      return dict((name, np.concatenate(values) if values else np.zeros(0, dtype=dtypes[name]))
+                  for name, values in chunks.items())
+    return dict((name, [v for values in chunk for v in values]) for name, chunk in chunks.items())
+
+
+# rows of chunk with t1 <= time < t2 and the values of filters
+def select(chunk, time_name, t1, t2, filters):
+  times = chunk[time_name]
+  if np is not None:
+    mask = (times >= t1) & (times < t2)
+    for name, value in filters:
+      mask &= chunk[name] == value
+    return dict((name, values[mask]) for name, values in chunk.items())
+  keep = [i for i, t in enumerate(times) if t1 <= t < t2]
+  for name, value in filters:
+    column = chunk[name]
+    keep = [i for i in keep if column[i] == value]
+  return dict((name, [values[i] for i in keep]) for name, values in chunk.items())
+
+
+###############################################################################
+#####################              QUERIES                #####################
+###############################################################################
+
+# nearest rank quantiles of values, the quantile 1 is the max
+def quantiles(values, qs):
+  values = np.sort(values) if np is not None else sorted(values)
+  n = len(values)
+  return [values[max(0, int(math.ceil(q * n)) - 1)] for q in qs]
+
+def parse_switch(name):
+  return int(name.lstrip('s'))
+
+def switch_name(args):
+  return 's%02d' % parse_switch(args.switch) if args.switch else 'all switches'
+
+def switch_filter(args):
+  return [('swid', parse_switch(args.switch))] if args.switch else []
+
+def describe_range(t1, t2):
+  def show(t):
+    return time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(t)) if not math.isinf(t) else str(t)
+  return '[%s, %s)' % (show(t1), show(t2))
+
+# over the hops kept, sampling thins them out without changing the quantiles
+def query_quantiles(reader, t1, t2, args):
+  column = {'delay' : 'timedelta', 'queue' : 'qdepth'}[args.metric]
+  filters = switch_filter(args)
+  if args.rule is not None:
+    filters.append(('rule_id', args.rule))
+  values = reader.scan('hops', t1, t2, [column], filters)[column]
+  what = ' '.join([switch_name(args)] + (['rule %d' % args.rule] if args.rule is not None else []))
+  if not len(values):
+    print 'No hops of %s on %s' % (what, describe_range(t1, t2))
+    return
+  qs = [float(q) for q in args.quantiles.split(',')]
+  found = quantiles(values, qs + [1.0])
+  if args.metric == 'delay':
+    shown = ['%.2fms' % (v / 1000.0) for v in found]
+  else:
+    shown = ['%d packets' % v for v in found]
+  print '%s %s on %s, %d hops: %s' % (what, args.metric, describe_range(t1, t2), len(values),
+    ', '.join(['p%g %s' % (q * 100, v) for q, v in zip(qs, shown[:-1])] + ['max ' + shown[-1]]))
+
+def query_top_flows(reader, t1, t2, args):
+  filters = switch_filter(args)
+  if args.rule is not None:
+    filters.append(('rule_id', args.rule))
+  found = reader.scan('hops', t1, t2, ['src', 'timedelta', 'weight'], filters)
+  src, delay, weight = found['src'], found['timedelta'], found['weight']
+  if np is not None:
+    addrs, inverse = np.unique(src, return_inverse=True)
+    counts = np.bincount(inverse, weights=weight, minlength=len(addrs))
+    sums = np.bincount(inverse, weights=delay * weight.astype(np.float64), minlength=len(addrs))
+    flows = zip(addrs.tolist(), counts.astype(np.int64).tolist(), sums.tolist())
+  else:
+    totals = {}
+    for s, d, w in zip(src, delay, weight):
+      t = totals.setdefault(s, [0, 0])
+      t[0] += w
+      t[1] += d * w
+    flows = [(s, n, total) for s, (n, total) in totals.items()]
+  flows.sort(key=lambda f: (-f[1], f[0]))
+  hops = sum([n for s, n, total in flows])
+  what = ' '.join([switch_name(args)] + (['rule %d' % args.rule] if args.rule is not None else []))
+  print 'Top flows of %s on %s, %d hops (%d sampled)' % (what, describe_range(t1, t2), hops, len(src))
+  for addr, n, total in flows[:args.top]:
+    print '\t%-15s %10d hops (%5.1f%%), mean delay %.2fms' % (format_addr(addr), n, 100.0 * n / hops, total / n / 1000.0)
+
+def query_rollup(reader, t1, t2, args):
+  names = ['second', 'pkts', 'delay_sum', 'delay_max', 'queue_sum', 'queue_max']
+  found = reader.scan('rollup', t1, t2, names, switch_filter(args))
+  if np is not None:
+    found = dict((name, values.tolist()) for name, values in found.items())
+  steps = {} # step start -> [pkts, delay sum, delay max, queue sum, queue max]
+  for second, pkts, delay_sum, delay_max, queue_sum, queue_max in zip(*[found[n] for n in names]):
+    step = steps.setdefault(second - second % args.step, [0, 0.0, 0, 0.0, 0])
+    step[0] += pkts
+    step[1] += delay_sum
+    step[2] = max(step[2], delay_max)
+    step[3] += queue_sum
+    step[4] = max(step[4], queue_max)
+  print 'Rollup of %s on %s every %ds' % (switch_name(args), describe_range(t1, t2), args.step)
+  for start in sorted(steps):
+    pkts, delay_sum, delay_max, queue_sum, queue_max = steps[start]
+    print '\t%s %10d hops, delay mean %.2fms max %.2fms, queue mean %.1f max %d packets' % (
+      time.strftime('%H:%M:%S', time.localtime(start)), pkts, delay_sum / pkts / 1000.0, delay_max / 1000.0,
+      queue_sum / pkts, queue_max)
+
+QUERIES = {'quantiles' : query_quantiles, 'top-flows' : query_top_flows, 'rollup' : query_rollup}
+
+
+def main(args):
+  reader = HistoryReader(args.store)
+  t2 = args.until if args.until is not None else (time.time() if args.last else float('inf'))
+  t1 = t2 - args.last if args.last else (args.since if args.since is not None else 0)
+  QUERIES[args.query](reader, t1, t2, args)
+  print '(read %d rows from %d of %d partitions)' % (reader.scanned['rows'], reader.scanned['partitions'], len(reader.partitions))
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description='Queries on the hop history kept by stat.py --history')
+  parser.add_argument('query', help='quantiles: delay or queue quantiles, top-flows: sources with most hops, rollup: per second rollups grouped by --step',
+                      type=str, choices=sorted(QUERIES))
+  parser.add_argument('-s', '--store', help='Directory given to stat.py --history',
+                      type=str, action="store", required=True)
+  parser.add_argument('-w', '--switch', help='Only hops of this switch (s08 or 8)',
+                      type=str, action="store", required=False, default=None)
+  parser.add_argument('-r', '--rule', help='Only hops forwarded by this rule id',
+                      type=int, action="store", required=False, default=None)
+  parser.add_argument('-f', '--since', help='Start of the time range (seconds since the epoch)',
+                      type=float, action="store", required=False, default=None)
+  parser.add_argument('-t', '--until', help='End of the time range (seconds since the epoch)',
+                      type=float, action="store", required=False, default=None)
+  parser.add_argument('-l', '--last', help='Range of this many seconds ending at --until or now',
+                      type=float, action="store", required=False, default=None)
+  parser.add_argument('-m', '--metric', help='Metric of quantiles: delay (timedelta) or queue (qdepth)',
+                      type=str, action="store", required=False, default='delay', choices=['delay', 'queue'])
+  parser.add_argument('-q', '--quantiles', help='Comma separated quantiles to compute',
+                      type=str, action="store", required=False, default='0.5,0.99')
+  parser.add_argument('-k', '--top', help='Flows shown by top-flows',
+                      type=int, action="store", required=False, default=10)
+  parser.add_argument('-S', '--step', help='Seconds grouped on each line of rollup',
+                      type=int, action="store", required=False, default=60)
+  main(parser.parse_args())
@@ -0,0 +1,154 @@
+import BaseHTTPServer
+import SocketServer
+import json
+import threading
+
+
+# A metrics snapshot is (time, switches), where each switch is a dict:
+#   name, pkts, delay, queue_ocupacy, active_flows  // as kept by stat.py
+#   delay_p50, delay_p99, queue_p50, queue_p99      // on the sketch window
+#   rules : [(rule id, match, port, uses)]
+#   flows : [(source, packets, active)]
+# Delays are in microseconds. Snapshots are built by the collector and never
+# changed afterwards
+
+# (name, type, help, key of the switch dict)
+SWITCH_METRICS = [
+  ('mri_switch_packets_total', 'counter', 'Telemetry hops received from the switch', 'pkts'),
+  ('mri_switch_delay_estimate_us', 'gauge', 'Moving average of the hop delay', 'delay'),
+  ('mri_switch_queue_estimate_packets', 'gauge', 'Moving average of the queue ocupacy', 'queue_ocupacy'),
+  ('mri_switch_active_flows', 'gauge', 'Flows active on the switch', 'active_flows'),
+]
+# (name, help, key of the p50, key of the p99)
+SWITCH_QUANTILES = [
+  ('mri_switch_delay_us', 'Hop delay quantiles on the sketch window', 'delay_p50', 'delay_p99'),
+  ('mri_switch_queue_packets', 'Queue ocupacy quantiles on the sketch window', 'queue_p50', 'queue_p99'),
+]
+
+def escape_label(value):
+  return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+# Prometheus text exposition format 0.0.4
+def format_prometheus(time, switches):
+  lines = []
+  for name, kind, help, key in SWITCH_METRICS:
+    lines.append('# HELP %s %s' % (name, help))
+    lines.append('# TYPE %s %s' % (name, kind))
+    for sw in switches:
+      lines.append('%s{switch="%s"} %s' % (name, sw['name'], repr(float(sw[key]))))
+  for name, help, p50, p99 in SWITCH_QUANTILES:
+    lines.append('# HELP %s %s' % (name, help))
+    lines.append('# TYPE %s gauge' % name)
+    for sw in switches:
+      lines.append('%s{switch="%s",quantile="0.5"} %s' % (name, sw['name'], repr(float(sw[p50]))))
+      lines.append('%s{switch="%s",quantile="0.99"} %s' % (name, sw['name'], repr(float(sw[p99]))))
+  lines.append('# HELP mri_rule_uses_total Packets forwarded by the rule')
+  lines.append('# TYPE mri_rule_uses_total counter')
+  for sw in switches:
+    for rule_id, match, port, uses in sw['rules']:
+      lines.append('mri_rule_uses_total{switch="%s",rule="%d",match="%s",port="%d"} %d' % (
+        sw['name'], rule_id, escape_label(match), port, uses))
+  lines.append('# HELP mri_flow_packets_total Packets of the flow seen on the switch')
+  lines.append('# TYPE mri_flow_packets_total counter')
+  for sw in switches:
+    for src, pkts, active in sw['flows']:
+      lines.append('mri_flow_packets_total{switch="%s",src="%s",active="%d"} %d' % (
+        sw['name'], escape_label(src), active, pkts))
+  lines.append('# HELP mri_snapshot_timestamp_seconds Collector time of the snapshot')
+  lines.append('# TYPE mri_snapshot_timestamp_seconds gauge')
+  lines.append('mri_snapshot_timestamp_seconds %s' % repr(float(time)))
+  return '\n'.join(lines) + '\n'
+
+def format_json(time, switches):
+  view = []
+  for sw in switches:
+    sw = dict(sw)
+    sw['rules'] = [{'id' : i, 'match' : m, 'port' : p, 'uses' : u} for i, m, p, u in sw['rules']]
+    sw['flows'] = [{'src' : s, 'pkts' : n, 'active' : bool(a)} for s, n, a in sw['flows']]
+    view.append(sw)
+  return json.dumps({'time' : time, 'switches' : view}, separators=(',', ':'), sort_keys=True) + '\n'
+
+# path -> (format, content type)
+PATHS = {
+  '/metrics' : (format_prometheus, 'text/plain; version=0.0.4'),
+  '/metrics.json' : (format_json, 'application/json'),
+}
+
+
+###############################################################################
+### class MetricsServer                                                     ###
+###  * HTTP server on its own threads serving the last published snapshot   ###
+###    on /metrics (Prometheus text) and /metrics.json                      ###
+###  * Double buffered: the collector builds a new snapshot aside and       ###
+###    publish() swaps a single reference to it, a scrape takes that        ###
+###    reference once, so it needs no lock and never reads the state of     ###
+###    the collector; each format is rendered at most once per snapshot     ###
+###  * Structure:                                                           ###
+###    - self.published     // (time, switches, {path -> rendered text})    ###
+###    - self.server        // HTTP server, self.server.metrics is self     ###
+###    - self.thread                                                        ###
+###  * Methods:                                                             ###
+###    - __init__ (address, port_offset)  // [host:]port                    ###
+###    - publish(time, switches)                                            ###
+###    - render(path)               // None for unknown paths               ###
+###    - start(), close()                                                   ###
+###############################################################################
+class MetricsServer:
+
+  def __init__(self, address, port_offset=0):
+    if ':' in address:
+      host, port = address.rsplit(':', 1)
+    else:
+      host, port = '', address
+    self.published = (0, [], {})
+    self.server = ThreadingHTTPServer((host, int(port) + port_offset), MetricsHandler)
+    self.server.metrics = self
+    self.thread = None
+
+  def publish(self, time, switches):
+    self.published = (time, switches, {})
+
+  def render(self, path):
+    time, switches, rendered = self.published
+    try:
+      return rendered[path]
+    except KeyError:
+      if path not in PATHS:
+        return None
+      rendered[path] = PATHS[path][0](time, switches)
+      return rendered[path]
+
+  def start(self):
+    self.thread = threading.Thread(target=self.server.serve_forever)
+    self.thread.daemon = True
+    self.thread.start()
+
+  def close(self):
+    if self.thread is not None:
+      self.server.shutdown()
+      self.thread.join()
+      self.thread = None
+    self.server.server_close()
+
+
+class ThreadingHTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+  daemon_threads = True
+  allow_reuse_address = True
+
+class MetricsHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+  def do_GET(self):
+    path = self.path.split('?', 1)[0]
+    body = self.server.metrics.render(path)
+    if body is None:
+      self.send_error(404)
+      return
+    self.send_response(200)
+    self.send_header('Content-Type', PATHS[path][1])
+    self.send_header('Content-Length', str(len(body)))
+    self.end_headers()
+    self.wfile.write(body)
+
+  # scrapes are not logged on the collector output
+  def log_message(self, format, *args):
+    pass
@@ -0,0 +1,189 @@
+import struct
+
+try:
+  import numpy as np
+except ImportError:
+  np = None
+
+
+###############################################################################
+### MRI frame layout                                                        ###
+###  * ethernet_t (14 bytes) | mri_t (4 bytes) | switch_t * toParse         ###
+###    (16 bytes each) | ipv4_t                                             ###
+###  * mri_t.count holds how many switch_t hops are valid, mri_t.toParse    ###
+###    how many are present on the frame (the clone always restores         ###
+###    MAX_HOPS of them, see set_mri on mri.p4)                             ###
+###############################################################################
+
+#type used to identify mri on ethernet
+MRI_TYPE = 0x6041
+
+ETHERNET_SIZE = 14
+SWTRACE_SIZE = 16
+MRI_SIZE = 4
+IPV4_SIZE_BEFORE_SRC = 12
+ETHER_TYPE_OFFSET = 12
+TRACES_OFFSET = ETHERNET_SIZE + MRI_SIZE
+
+# precompiled formats, all fields are in network byte order
+ETHER_TYPE = struct.Struct('!H')
+MRI_HDR = struct.Struct('!HH')             # count, toParse
+SWITCH_T = struct.Struct('!HIIIH')         # swid, qdepth, timestamp, timedelta, rule_id
+IPV4_ADDR = struct.Struct('!BBBB')
+
+assert SWITCH_T.size == SWTRACE_SIZE
+assert MRI_HDR.size == MRI_SIZE
+
+HOP_FIELDS = ('swid', 'qdepth', 'timestamp', 'timedelta', 'rule_id')
+
+if np is not None:
+  # same 16 bytes layout of switch_t on mri.p4 (packed, big endian)
+  SWITCH_DTYPE = np.dtype([('swid', '>u2'),
+                           ('qdepth', '>u4'),
+                           ('timestamp', '>u4'),
+                           ('timedelta', '>u4'),
+                           ('rule_id', '>u2')])
+  assert SWITCH_DTYPE.itemsize == SWTRACE_SIZE
+else:
+  SWITCH_DTYPE = None
+
+
+def is_mri_pkt(buf):
+  return len(buf) >= TRACES_OFFSET and ETHER_TYPE.unpack_from(buf, ETHER_TYPE_OFFSET)[0] == MRI_TYPE
+
+# number of valid hops on the frame
+def num_of_traces(buf):
+  return MRI_HDR.unpack_from(buf, ETHERNET_SIZE)[0]
+
+def ipv4_start_byte(buf):
+  return TRACES_OFFSET + SWTRACE_SIZE * MRI_HDR.unpack_from(buf, ETHERNET_SIZE)[1]
+
+def get_source(buf):
+  return '%d.%d.%d.%d' % IPV4_ADDR.unpack_from(buf, ipv4_start_byte(buf) + IPV4_SIZE_BEFORE_SRC)
+
+# returns (count, source) of a MRI frame or None when the frame is not MRI or
+# is too short to contain the headers it announces
+def parse_header(buf):
+  if not is_mri_pkt(buf):
+    return None
+  count, to_parse = MRI_HDR.unpack_from(buf, ETHERNET_SIZE)
+  src_byte = TRACES_OFFSET + SWTRACE_SIZE * to_parse + IPV4_SIZE_BEFORE_SRC
+  if count > to_parse or len(buf) < src_byte + 4:
+    return None
+  return count, '%d.%d.%d.%d' % IPV4_ADDR.unpack_from(buf, src_byte)
+
+
+# decodes a single frame, returns (source, [(swid, qdepth, timestamp,
+# timedelta, rule_id), ...]) or None if it is not a valid MRI frame
+def decode_frame(buf):
+  header = parse_header(buf)
+  if header is None:
+    return None
+  count, src = header
+  unpack = SWITCH_T.unpack_from
+  return src, [unpack(buf, TRACES_OFFSET + i * SWTRACE_SIZE) for i in range(count)]
+
+
+###############################################################################
+### class HopBatch                                                          ###
+###  * Hop records of a batch of frames decoded in one pass, stored by      ###
+###    column: the i-th hop of the batch is (swid[i], qdepth[i], ...) and   ###
+###    came from the frame frame[i], whose source is sources[frame[i]]      ###
+###  * Columns are NumPy arrays when NumPy is available and lists otherwise ###
+###  * Structure:                                                           ###
+###    - self.sources       // source address of each decoded frame         ###
+###    - self.frame         // index on self.sources of each hop            ###
+###    - self.swid, self.qdepth, self.timestamp, self.timedelta,            ###
+###      self.rule_id                                                       ###
+###  * Methods:                                                             ###
+###    - rows()             // iterates (src, swid, qdepth, timestamp,      ###
+###                         // timedelta, rule_id) with python ints         ###
+###    - by_frame()         // iterates (src, [hop tuples]) per frame, the  ###
+###                         // same output of decode_frame                  ###
+###############################################################################
+class HopBatch(object):
+  __slots__ = ('sources', 'frame') + HOP_FIELDS
+
+  def __init__(self, sources, frame, swid, qdepth, timestamp, timedelta, rule_id):
+    self.sources = sources
+    self.frame = frame
+    self.swid = swid
+    self.qdepth = qdepth
+    self.timestamp = timestamp
+    self.timedelta = timedelta
+    self.rule_id = rule_id
+
+  def __len__(self):
+    return len(self.frame)
+
+  def rows(self):
+    columns = [self.frame, self.swid, self.qdepth, self.timestamp, self.timedelta, self.rule_id]
+    if np is not None:
+      columns = [c.tolist() for c in columns]
+    sources = self.sources
+    for f, swid, qdepth, timestamp, timedelta, rule_id in zip(*columns):
+      yield sources[f], swid, qdepth, timestamp, timedelta, rule_id
+
+  def by_frame(self):
+    columns = [self.frame, self.swid, self.qdepth, self.timestamp, self.timedelta, self.rule_id]
+    if np is not None:
+      columns = [c.tolist() for c in columns]
+    current = 0
+    hops = []
+    for row in zip(*columns):
+      while row[0] != current:
+        yield self.sources[current], hops
+        current += 1
+        hops = []
+      hops.append(row[1:])
+    while current < len(self.sources):
+      yield self.sources[current], hops
+      current += 1
+      hops = []
+
+
+# decodes every MRI frame of frames (any buffer: str, bytearray, memoryview,
+# mmap slices) into one HopBatch, frames that are not MRI are skipped
+def decode_batch(frames):
+  if np is not None:
+    return _decode_batch_numpy(frames)
+  return _decode_batch_struct(frames)
+
+def _decode_batch_numpy(frames):
+  sources = []
+  counts = []
+  records = []
+  for buf in frames:
+    header = parse_header(buf)
+    if header is None:
+      continue
+    count, src = header
+    sources.append(src)
+    counts.append(count)
+    if count:
+      records.append(np.frombuffer(buf, dtype=SWITCH_DTYPE, count=count, offset=TRACES_OFFSET))
+
+  if records:
+    hops = np.concatenate(records)
+  else:
+    hops = np.zeros(0, dtype=SWITCH_DTYPE)
+  frame = np.repeat(np.arange(len(sources), dtype=np.uint32), counts)
+  return HopBatch(sources, frame, *[hops[f].astype(np.uint32) for f in HOP_FIELDS])
+
+def _decode_batch_struct(frames):
+  sources = []
+  frame = []
+  columns = [[], [], [], [], []]
+  unpack = SWITCH_T.unpack_from
+  for buf in frames:
+    header = parse_header(buf)
+    if header is None:
+      continue
+    count, src = header
+    f = len(sources)
+    sources.append(src)
+    for i in range(count):
+      frame.append(f)
+      for column, value in zip(columns, unpack(buf, TRACES_OFFSET + i * SWTRACE_SIZE)):
+        column.append(value)
+  return HopBatch(sources, frame, *columns)
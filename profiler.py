@@ -0,0 +1,291 @@
+import ctypes
+import ctypes.util
+import time
+from collections import deque
+
+
+# latencies are counted in microseconds on power of two buckets: bucket 0 is
+# below 1us and bucket i in [2^(i-1), 2^i) us, the last one also holds longer
+# latencies
+LATENCY_BUCKETS = 24
+# seconds of ingest rate kept for the dump
+INGEST_SECONDS = 60
+# switches shown on the summary line, by time spent on them
+SUMMARY_SWITCHES = 3
+
+CLOCK_MONOTONIC = 1
+
+class timespec(ctypes.Structure):
+  _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+
+# seconds on CLOCK_MONOTONIC through clock_gettime, so latencies are not
+# disturbed by changes of the wall clock; time.time where it is missing
+def _monotonic_clock():
+  try:
+    libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+    clock_gettime = libc.clock_gettime
+  except (OSError, AttributeError, TypeError):
+    return time.time
+  clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(timespec)]
+  ts = timespec()
+  ref = ctypes.byref(ts)
+  def monotonic():
+    clock_gettime(CLOCK_MONOTONIC, ref)
+    return ts.tv_sec + ts.tv_nsec * 1e-9
+  return monotonic
+
+monotonic = _monotonic_clock()
+
+
+###############################################################################
+### class LatencyHistogram                                                  ###
+###  * Latencies of one stage on LATENCY_BUCKETS power of two buckets, so   ###
+###    adding one is an integer bit_length and quantiles are the upper      ###
+###    bound of their bucket (within a factor of 2)                         ###
+###  * Structure:                                                           ###
+###    - self.count                                                         ###
+###    - self.total         // seconds                                      ###
+###    - self.max           // seconds                                      ###
+###    - self.buckets                                                       ###
+###  * Methods:                                                             ###
+###    - add(seconds)                                                       ###
+###    - merge(other), clear()                                              ###
+###    - quantile(q)                // seconds                              ###
+###    - format()                   // count, mean, p50, p99 and max        ###
+###############################################################################
+class LatencyHistogram(object):
+  __slots__ = ('count', 'total', 'max', 'buckets')
+
+  def __init__(self):
+    self.clear()
+
+  def clear(self):
+    self.count = 0
+    self.total = 0.0
+    self.max = 0.0
+    self.buckets = [0] * LATENCY_BUCKETS
+
+  def add(self, seconds):
+    self.count += 1
+    self.total += seconds
+    if seconds > self.max:
+      self.max = seconds
+    self.buckets[min(int(seconds * 1000000).bit_length(), LATENCY_BUCKETS - 1)] += 1
+
+  def merge(self, other):
+    self.count += other.count
+    self.total += other.total
+    self.max = max(self.max, other.max)
+    for i, n in enumerate(other.buckets):
+      self.buckets[i] += n
+
+  def quantile(self, q):
+    rank = q * self.count
+    seen = 0
+    for i, n in enumerate(self.buckets):
+      seen += n
+      if seen >= rank and n:
+        return min((1 << i) / 1000000.0, self.max)
+    return self.max
+
+  def format(self):
+    if not self.count:
+      return '0'
+    return '%d mean %s p50 %s p99 %s max %s' % (self.count, format_latency(self.total / self.count),
+      format_latency(self.quantile(0.5)), format_latency(self.quantile(0.99)), format_latency(self.max))
+
+def format_latency(seconds):
+  if seconds < 0.001:
+    return '%.0fus' % (seconds * 1000000)
+  return '%.2fms' % (seconds * 1000)
+
+
+###############################################################################
+### class Profiler                                                          ###
+###  * Opt-in instrumentation of the collector: stages are functions of the ###
+###    packet path replaced by timed() versions of themselves, so nothing   ###
+###    is measured when the collector is not profiled                       ###
+###  * Counts are kept for the current interval and merged into the         ###
+###    totals by summary(); histograms of stages running on other threads   ###
+###    (the report emitter) may miss a count when both threads add at once  ###
+###  * Kernel drops come from drop sources, functions returning the packets ###
+###    and the drops since their previous call (see packet_statistics in    ###
+###    capture.py)                                                          ###
+###  * Structure:                                                           ###
+###    - self.name                                                          ###
+###    - self.interval      // seconds between two summary lines            ###
+###    - self.stages, self.total_stages  // {stage -> LatencyHistogram}     ###
+###    - self.frames, self.total_frames  // frames handed to the decoder    ###
+###    - self.ingest        // (second, frames) of the last INGEST_SECONDS  ###
+###    - self.switches, self.total_switches  // {switch name -> [hops,      ###
+###                         // seconds]} spent updating the switch          ###
+###    - self.drop_sources  // {name -> function}                           ###
+###    - self.packets, self.drops        // kernel counters since start     ###
+###    - self.dump_requested             // set by the dump signal handler  ###
+###  * Methods:                                                             ###
+###    - __init__ (name, interval)                                          ###
+###    - timed(stage, function, frames)  // frames(*args) is the number of  ###
+###                                 // frames handed to function, if given  ###
+###    - timed_switch(stage, function)   // the same for a Switch method,   ###
+###                                 // also counting the work per switch    ###
+###    - add_drop_source(name, function)                                    ###
+###    - request_dump(signum, frame)     // signal handler                  ###
+###    - poll(now)                  // summary line when due and the dump   ###
+###                                 // when requested, None otherwise       ###
+###    - summary(now), dump(now)                                            ###
+###############################################################################
+class Profiler:
+
+  def __init__(self, name, interval):
+    self.name = name
+    self.interval = interval
+    self.stages = {}
+    self.total_stages = {}
+    self.frames = 0
+    self.total_frames = 0
+    self.second = int(monotonic())
+    self.second_frames = 0
+    self.ingest = deque(maxlen=INGEST_SECONDS)
+    self.switches = {}
+    self.total_switches = {}
+    self.drop_sources = {}
+    self.packets = 0
+    self.drops = 0
+    self.interval_packets = 0
+    self.interval_drops = 0
+    self.start = monotonic()
+    self.last_summary = self.start
+    self.dump_requested = False
+
+  def histogram(self, stage):
+    try:
+      return self.stages[stage]
+    except KeyError:
+      self.stages[stage] = LatencyHistogram()
+      self.total_stages[stage] = LatencyHistogram()
+      return self.stages[stage]
+
+  def timed(self, stage, function, frames=None):
+    histogram = self.histogram(stage)
+    def timed_function(*args, **kwargs):
+      start = monotonic()
+      result = function(*args, **kwargs)
+      end = monotonic()
+      histogram.add(end - start)
+      if frames is not None:
+        self.count_frames(frames(*args), end)
+      return result
+    return timed_function
+
+  def timed_switch(self, stage, function):
+    histogram = self.histogram(stage)
+    switches = self.switches
+    def timed_method(sw, *args, **kwargs):
+      start = monotonic()
+      result = function(sw, *args, **kwargs)
+      elapsed = monotonic() - start
+      histogram.add(elapsed)
+      try:
+        work = switches[sw.name]
+      except KeyError:
+        work = switches[sw.name] = [0, 0.0]
+      work[0] += 1
+      work[1] += elapsed
+      return result
+    return timed_method
+
+  def count_frames(self, n, now):
+    second = int(now)
+    if second != self.second:
+      self.ingest.append((self.second, self.second_frames))
+      self.second = second
+      self.second_frames = 0
+    self.second_frames += n
+    self.frames += n
+
+  def add_drop_source(self, name, function):
+    self.drop_sources[name] = function
+
+  def request_dump(self, signum, frame):
+    self.dump_requested = True
+
+  # reads the drop sources, a source that fails (closed socket) is removed
+  def read_drops(self):
+    for name, function in self.drop_sources.items():
+      try:
+        packets, drops = function()
+      except (EnvironmentError, ValueError):
+        del self.drop_sources[name]
+        continue
+      self.interval_packets += packets
+      self.interval_drops += drops
+
+  def poll(self, now):
+    text = ''
+    if now - self.last_summary >= self.interval:
+      text += self.summary(now)
+    if self.dump_requested:
+      self.dump_requested = False
+      text += self.dump(now)
+    return text or None
+
+  # one line on the interval since the previous summary, then the interval
+  # counts go to the totals
+  def summary(self, now):
+    self.read_drops()
+    elapsed = max(now - self.last_summary, 1e-9)
+    parts = []
+    # sharded workers get hops, not frames
+    if self.frames or self.total_frames:
+      parts.append('%.0f frames/s' % (self.frames / elapsed))
+    for stage in sorted(self.stages):
+      histogram = self.stages[stage]
+      if histogram.count:
+        parts.append('%s %d p50 %s p99 %s' % (stage, histogram.count,
+          format_latency(histogram.quantile(0.5)), format_latency(histogram.quantile(0.99))))
+      self.total_stages[stage].merge(histogram)
+      histogram.clear()
+    if self.drop_sources:
+      parts.append('kernel drops %d of %d' % (self.interval_drops, self.interval_packets))
+    busiest = sorted(self.switches.items(), key=lambda s: -s[1][1])[:SUMMARY_SWITCHES]
+    if busiest:
+      parts.append('busiest ' + ' '.join(['%s %d hops %s' % (name, hops, format_latency(seconds))
+                                          for name, (hops, seconds) in busiest]))
+    for name, (hops, seconds) in self.switches.items():
+      try:
+        work = self.total_switches[name]
+      except KeyError:
+        work = self.total_switches[name] = [0, 0.0]
+      work[0] += hops
+      work[1] += seconds
+    # cleared in place, timed_switch holds the dict
+    self.switches.clear()
+    self.total_frames += self.frames
+    self.frames = 0
+    self.packets += self.interval_packets
+    self.drops += self.interval_drops
+    self.interval_packets = 0
+    self.interval_drops = 0
+    self.last_summary = now
+    return '[profile] %s: %s\n' % (self.name, ', '.join(parts))
+
+  # everything measured since the start, the current interval included
+  def dump(self, now):
+    self.summary(now)
+    lines = ['========================  PROFILE  ========================']
+    lines.append('Profile of %s over %.1f s: %d frames (%.0f frames/s)' % (self.name, now - self.start,
+      self.total_frames, self.total_frames / max(now - self.start, 1e-9)))
+    if self.ingest:
+      lines.append('Frames per second, oldest first: ' + ' '.join(['%d' % n for s, n in self.ingest]))
+    lines.append('Stage latencies:')
+    for stage in sorted(self.total_stages):
+      lines.append('\t%s: %s' % (stage, self.total_stages[stage].format()))
+    if self.drop_sources:
+      lines.append('Kernel: %d packets, %d dropped (%.2f%%)' % (self.packets, self.drops,
+        100.0 * self.drops / max(self.packets, 1)))
+    if self.total_switches:
+      lines.append('Work per switch:')
+    for name, (hops, seconds) in sorted(self.total_switches.items(), key=lambda s: -s[1][1]):
+      lines.append('\t%s: %d hops in %s (%s per hop)' % (name, hops, format_latency(seconds),
+        format_latency(seconds / max(hops, 1))))
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,178 @@
+import json
+import threading
+import time
+from collections import deque
+
+
+# longest time (in seconds) the emitter thread sleeps when it has no reports
+EMITTER_TIMEOUT = 0.1
+# time a lossless emitter waits for room on its queue before checking again
+EMITTER_RETRY = 0.001
+
+
+###############################################################################
+### class CongestionSnapshot                                                ###
+###  * Copy of the state of a switch needed by its congestion report, taken ###
+###    on the packet processing path and never changed afterwards, so it    ###
+###    can be rendered on another thread                                    ###
+###  * Structure:                                                           ###
+###    - self.name                                                          ###
+###    - self.time          // collector time of the snapshot               ###
+###    - self.window        // seconds covered by the sketches              ###
+###    - self.delay, self.queue_ocupacy     // estimations of the switch    ###
+###    - self.top_flows     // [(src, count, error)], None unless the flows ###
+###                         // are tracked on bounded memory                ###
+###    - self.flows         // [(src, init time, packets)] of active flows  ###
+###    - self.delay_sketch, self.queue_sketch  // DDSketch of the window    ###
+###    - self.rules         // [(id, address, prefix size, port, uses,      ###
+###                         // delay DDSketch or None)]                     ###
+###############################################################################
+class CongestionSnapshot(object):
+  __slots__ = ('name', 'time', 'window', 'delay', 'queue_ocupacy', 'top_flows',
+               'flows', 'delay_sketch', 'queue_sketch', 'rules')
+
+  def __init__(self, name, time, window, delay, queue_ocupacy, top_flows, flows,
+               delay_sketch, queue_sketch, rules):
+    self.name = name
+    self.time = time
+    self.window = window
+    self.delay = delay
+    self.queue_ocupacy = queue_ocupacy
+    self.top_flows = top_flows
+    self.flows = flows
+    self.delay_sketch = delay_sketch
+    self.queue_sketch = queue_sketch
+    self.rules = rules
+
+
+# text report, as printed by the collector
+def format_text(snap):
+  lines = ['========================  CONGESTION REPORT  ========================']
+  lines.append('Congestion on switch ' + str(snap.name) + ' caused by the following flows')
+  if snap.top_flows is not None:
+    for src, count, error in snap.top_flows:
+      lines.append('\tFlow from ' + str(src) + ' -> ' + str(count) + ' packets (at least ' + str(count - error) + ') on the last %ds' % (snap.window))
+  for src, init_time, pkts in snap.flows:
+    lines.append('\tFlow from ' + str(src) + ' started ' + '%.2f' % (snap.time - init_time) + ' seconds ago -> ' + str(pkts) + ' packets')
+  lines.append('Delay estimation %.2f' % (float(snap.delay)/1000.0) + 'ms')
+  lines.append('Queue ocupacy estimation: %.0f' % (snap.queue_ocupacy) + ' packets')
+  delay = snap.delay_sketch
+  if delay.count:
+    lines.append('Delay on the last %ds: p50 %.2fms, p99 %.2fms, max %.2fms' % (snap.window,
+      delay.quantile(0.5)/1000.0, delay.quantile(0.99)/1000.0, delay.max/1000.0))
+  queue = snap.queue_sketch
+  if queue.count:
+    lines.append('Queue ocupacy on the last %ds: p50 %.0f, p99 %.0f, max %d packets' % (snap.window,
+      queue.quantile(0.5), queue.quantile(0.99), queue.max))
+  lines.append('The forwarding rules of this switch are:')
+  for rule_id, key_addr, prefix_size, egress_port, uses, delay in snap.rules:
+    line = '\tRule ' + str(rule_id) + ') ' + str(key_addr) + '/' + str(prefix_size) + ' => port ' + str(egress_port) + ' (used ' + str(uses) + ' times)'
+    if delay is not None and delay.count:
+      line += ' delay p50 %.2fms, p99 %.2fms, max %.2fms' % (delay.quantile(0.5)/1000.0, delay.quantile(0.99)/1000.0, delay.max/1000.0)
+    lines.append(line)
+  return '\n'.join(lines) + '\n'
+
+# quantiles of a sketch in milliseconds (values are in microseconds)
+def sketch_ms(sketch):
+  return {'p50' : sketch.quantile(0.5)/1000.0, 'p99' : sketch.quantile(0.99)/1000.0, 'max' : sketch.max/1000.0}
+
+# one JSON object per line, delays in milliseconds
+def format_json(snap):
+  report = {
+    'type' : 'congestion',
+    'switch' : snap.name,
+    'time' : snap.time,
+    'delay_ms' : snap.delay/1000.0,
+    'queue_ocupacy' : snap.queue_ocupacy,
+    'flows' : [{'src' : src, 'age' : snap.time - init_time, 'pkts' : pkts} for src, init_time, pkts in snap.flows],
+    'rules' : []
+  }
+  if snap.top_flows is not None:
+    report['top_flows'] = [{'src' : src, 'pkts' : count, 'min_pkts' : count - error} for src, count, error in snap.top_flows]
+  if snap.delay_sketch.count:
+    report['window_delay_ms'] = sketch_ms(snap.delay_sketch)
+  if snap.queue_sketch.count:
+    report['window_queue'] = {'p50' : snap.queue_sketch.quantile(0.5), 'p99' : snap.queue_sketch.quantile(0.99),
+                              'max' : snap.queue_sketch.max}
+  for rule_id, key_addr, prefix_size, egress_port, uses, delay in snap.rules:
+    rule = {'id' : rule_id, 'match' : '%s/%d' % (key_addr, prefix_size), 'port' : egress_port, 'uses' : uses}
+    if delay is not None and delay.count:
+      rule['delay_ms'] = sketch_ms(delay)
+    report['rules'].append(rule)
+  return json.dumps(report, separators=(',', ':'), sort_keys=True) + '\n'
+
+FORMATS = {'text' : format_text, 'json' : format_json}
+
+
+###############################################################################
+### class ReportEmitter                                                     ###
+###  * Renders snapshots and hands the texts to sink away from the packet   ###
+###    processing path: either on its own thread (start()) or on the stages ###
+###    of an event loop calling run_pending()                               ###
+###  * submit() only appends to a bounded queue: snapshots that do not fit  ###
+###    are dropped and counted, unless the emitter is lossless (replays),   ###
+###    then it waits for room                                               ###
+###  * Structure:                                                           ###
+###    - self.render        // snapshot -> text                             ###
+###    - self.sink          // text -> None                                 ###
+###    - self.queue         // snapshots waiting to be rendered             ###
+###    - self.limit                                                         ###
+###    - self.lossless                                                      ###
+###    - self.dropped                                                       ###
+###    - self.thread        // None when the emitter has no thread          ###
+###  * Methods:                                                             ###
+###    - submit(snapshot)           // returns False if it was dropped      ###
+###    - run_pending(limit)         // renders up to limit snapshots,       ###
+###                                 // returns True while some are left     ###
+###    - start(), close()           // close() renders what is left         ###
+###############################################################################
+class ReportEmitter:
+
+  def __init__(self, render, sink, limit, lossless=False):
+    self.render = render
+    self.sink = sink
+    self.queue = deque()
+    self.limit = limit
+    self.lossless = lossless
+    self.dropped = 0
+    self.thread = None
+    self.running = False
+    self.wakeup = threading.Event()
+
+  def submit(self, snapshot):
+    while len(self.queue) >= self.limit:
+      if not self.lossless or self.thread is None or not self.thread.is_alive():
+        self.dropped += 1
+        return False
+      time.sleep(EMITTER_RETRY)
+    self.queue.append(snapshot)
+    if self.thread is not None:
+      self.wakeup.set()
+    return True
+
+  def run_pending(self, limit=None):
+    done = 0
+    while self.queue and (limit is None or done < limit):
+      self.sink(self.render(self.queue.popleft()))
+      done += 1
+    return len(self.queue) > 0
+
+  def run(self):
+    while self.running:
+      self.wakeup.wait(EMITTER_TIMEOUT)
+      self.wakeup.clear()
+      self.run_pending()
+
+  def start(self):
+    self.running = True
+    self.thread = threading.Thread(target=self.run)
+    self.thread.daemon = True
+    self.thread.start()
+
+  def close(self):
+    if self.thread is not None:
+      self.running = False
+      self.wakeup.set()
+      self.thread.join()
+      self.thread = None
+    self.run_pending()
@@ -0,0 +1,275 @@
+import multiprocessing
+import socket
+import struct
+from array import array
+from collections import deque
+
+
+# Routing works on an adjacency index of the topology:
+#   adjacency : {node name -> [neighbor names, in name order]}
+#   switches  : set of the switch names, only switches forward packets
+# and answers for each pair of switches the neighbor of the source that is
+# the first hop of a shortest path to the destination
+
+
+# BFS from src over switches, returns {dst switch -> first hop from src}, the
+# unreachable switches are left out
+def next_hops(adjacency, switches, src):
+    first = {src : None}
+    queue = deque([src])
+    while queue:
+        current = queue.popleft()
+        hop = first[current]
+        for other in adjacency[current]:
+            if other in switches and other not in first:
+                first[other] = other if hop is None else hop
+                queue.append(other)
+    del first[src]
+    return first
+
+
+# BFS from the switch number src over the switch numbers, neighbors[i] lists
+# the switches linked to switch i (None for removed switches); returns two
+# arrays with the first hop and the number of hops to each switch, -1 for the
+# unreachable ones
+def first_hops(neighbors, src):
+    first = array('i', [-1]) * len(neighbors)
+    dist = array('i', [-1]) * len(neighbors)
+    first[src] = src
+    dist[src] = 0
+    queue = deque([src])
+    while queue:
+        current = queue.popleft()
+        hop = first[current]
+        d = dist[current] + 1
+        for other in neighbors[current]:
+            if first[other] == -1:
+                first[other] = other if current == src else hop
+                dist[other] = d
+                queue.append(other)
+    return first, dist
+
+
+# switch numbers shared with the worker processes, they get them on fork
+_neighbors = None
+
+def _first_hops_of(src):
+    first, dist = first_hops(_neighbors, src)
+    return src, first.tostring(), dist.tostring()
+
+# yields (src, first, dist) of first_hops() for each source, computed by
+# worker processes that send back compact arrays
+def _parallel_first_hops(neighbors, sources, workers):
+    global _neighbors
+    _neighbors = neighbors
+    pool = multiprocessing.Pool(workers)
+    try:
+        chunk = max(1, len(sources) // (workers * 4))
+        for src, first_data, dist_data in pool.imap_unordered(_first_hops_of, sources, chunk):
+            first = array('i')
+            first.fromstring(first_data)
+            dist = array('i')
+            dist.fromstring(dist_data)
+            yield src, first, dist
+    finally:
+        pool.close()
+        pool.join()
+        _neighbors = None
+
+# {src switch -> {dst switch -> first hop}} for every pair of switches, with
+# workers > 1 the BFS of the sources are split between worker processes
+def all_next_hops(adjacency, switches, workers=0):
+    if workers <= 1:
+        return dict((src, next_hops(adjacency, switches, src)) for src in switches)
+    names = sorted(switches)
+    ids = dict((name, i) for i, name in enumerate(names))
+    neighbors = [[ids[other] for other in adjacency[name] if other in ids] for name in names]
+    answer = {}
+    for src, first, dist in _parallel_first_hops(neighbors, range(len(names)), workers):
+        answer[names[src]] = dict((names[dst], names[hop]) for dst, hop in enumerate(first) if hop >= 0 and dst != src)
+    return answer
+
+
+###############################################################################
+### class RouteTable                                                        ###
+###  * Keeps the first hop and the distance from every switch to every      ###
+###    other one, so that after a change on the topology only the sources   ###
+###    whose shortest paths may have changed are computed again             ###
+###  * Switches are numbered on the order they are added, the numbers of    ###
+###    removed switches are not reused                                      ###
+###  * Links are directed, the arc a -> b is used by the BFS from a source  ###
+###    s when dist(s, b) == dist(s, a) + 1, so removing it only affects the ###
+###    sources where that holds and adding it only the sources where        ###
+###    dist(s, b) > dist(s, a) or b was unreachable                         ###
+###  * Structure:                                                           ###
+###    - self.names, self.ids       // switch number <-> switch name        ###
+###    - self.neighbors             // [[switch numbers]] in name order     ###
+###    - self.first, self.dist      // [array] of first_hops() per source   ###
+###    - self.dirty                 // sources to compute again             ###
+###  * Methods:                                                             ###
+###    - add_switch(name), remove_switch(name)                              ###
+###    - add_link(a, b), remove_link(a, b)                                  ###
+###    - recompute(workers)         // returns the names of the sources     ###
+###                                 // that were computed again             ###
+###    - next_hops_of(name)         // {dst switch -> first hop}            ###
+###############################################################################
+class RouteTable(object):
+
+    def __init__(self):
+        self.names = []
+        self.ids = {}
+        self.neighbors = []
+        self.first = []
+        self.dist = []
+        self.dirty = set()
+
+    def add_switch(self, name):
+        if name in self.ids:
+            return
+        self.ids[name] = len(self.names)
+        self.names.append(name)
+        self.neighbors.append([])
+        for first, dist in zip(self.first, self.dist):
+            if first is not None:
+                first.append(-1)
+                dist.append(-1)
+        self.first.append(None)
+        self.dist.append(None)
+        self.dirty.add(self.ids[name])
+
+    def remove_switch(self, name):
+        i = self.ids[name]
+        for j in list(self.neighbors[i]):
+            self.remove_link(name, self.names[j])
+        for j in range(len(self.neighbors)):
+            if self.neighbors[j] is not None and i in self.neighbors[j]:
+                self.remove_link(self.names[j], name)
+        del self.ids[name]
+        self.neighbors[i] = None
+        self.first[i] = None
+        self.dist[i] = None
+        self.dirty.discard(i)
+
+    def add_link(self, a, b):
+        i, j = self.ids[a], self.ids[b]
+        if j in self.neighbors[i]:
+            return
+        # neighbors are kept in name order, so ties between paths of the same
+        # length are broken the same way whatever the order of the changes
+        neighbors = self.neighbors[i]
+        k = 0
+        while k < len(neighbors) and self.names[neighbors[k]] < b:
+            k += 1
+        neighbors.insert(k, j)
+        for s, dist in enumerate(self.dist):
+            if dist is not None and dist[i] >= 0 and (dist[j] < 0 or dist[j] > dist[i]):
+                self.dirty.add(s)
+
+    def remove_link(self, a, b):
+        i, j = self.ids[a], self.ids[b]
+        if j not in self.neighbors[i]:
+            return
+        self.neighbors[i].remove(j)
+        for s, dist in enumerate(self.dist):
+            if dist is not None and dist[i] >= 0 and dist[j] == dist[i] + 1:
+                self.dirty.add(s)
+
+    def recompute(self, workers=0):
+        dirty = sorted(self.dirty)
+        if workers > 1 and len(dirty) > 1:
+            for src, first, dist in _parallel_first_hops(self.neighbors, dirty, workers):
+                self.first[src] = first
+                self.dist[src] = dist
+        else:
+            for src in dirty:
+                self.first[src], self.dist[src] = first_hops(self.neighbors, src)
+        self.dirty = set()
+        return set([self.names[src] for src in dirty])
+
+    def next_hops_of(self, name):
+        src = self.ids[name]
+        names = self.names
+        return dict((names[dst], names[hop]) for dst, hop in enumerate(self.first[src]) if hop >= 0 and dst != src)
+
+
+###############################################################################
+#####################          ROUTE COMPRESSION          #####################
+###############################################################################
+
+# ORTC (Draves et al., Constructing Optimal IP Routing Tables) computes the
+# smallest LPM table forwarding every address exactly as the given routes do.
+# A route is (address, prefix size, next hop), where the next hop is any
+# hashable value and None stands for addresses without route, which the
+# switch handles with the default action of the table
+
+IPV4 = struct.Struct('!I')
+
+def ip_to_int(address):
+    return IPV4.unpack(socket.inet_aton(address))[0]
+
+def int_to_ip(value):
+    return socket.inet_ntoa(IPV4.pack(value))
+
+
+# binary trie node, children are indexed by the next address bit
+class _Node(object):
+    __slots__ = ('children', 'hop', 'hops')
+
+    def __init__(self, hop=None):
+        self.children = None
+        self.hop = hop
+        self.hops = None
+
+# returns the compressed routes as [(address, prefix size, next hop)], entries
+# with next hop None must be installed with the default action, they cut
+# holes in a shorter prefix
+def compress_routes(routes):
+    root = _Node()
+    has_hop = set([root])
+    for address, size, hop in routes:
+        value = ip_to_int(address)
+        node = root
+        for bit in range(size):
+            if node.children is None:
+                node.children = [_Node(), _Node()]
+            node = node.children[(value >> (31 - bit)) & 1]
+        node.hop = hop
+        has_hop.add(node)
+
+    # pass 1: every node gets 0 or 2 children and the leaves the next hop
+    # inherited from the closest route above them
+    # pass 2: from the leaves up, the candidate next hops of each node are
+    # the intersection of the candidates of its children, or their union
+    # when they have none in common
+    stack = [(root, None, 0, False)]
+    while stack:
+        node, inherited, depth, done = stack.pop()
+        hop = node.hop if node in has_hop else inherited
+        if node.children is None:
+            node.hops = frozenset([hop])
+        elif not done:
+            node.hop = hop
+            stack.append((node, inherited, depth, True))
+            for child in node.children:
+                stack.append((child, hop, depth + 1, False))
+        else:
+            left, right = node.children[0].hops, node.children[1].hops
+            node.hops = (left & right) or (left | right)
+
+    # pass 3: from the root down, a node only needs a route when the next hop
+    # inherited from the routes above is not one of its candidates
+    # on the root the inherited next hop is the default action (None)
+    compressed = []
+    stack = [(root, 0, 0, None)]
+    while stack:
+        node, value, depth, inherited = stack.pop()
+        if inherited in node.hops:
+            hop = inherited
+        else:
+            hop = min(node.hops)
+            compressed.append((int_to_ip(value), depth, hop))
+        if node.children is not None:
+            stack.append((node.children[1], value | (1 << (31 - depth)), depth + 1, hop))
+            stack.append((node.children[0], value, depth + 1, hop))
+    return compressed
+
@@ -0,0 +1,183 @@
+import binascii
+import mmap
+import os
+import socket
+import struct
+import sys
+
+
+# file of the rules directory holding the snapshot of every switch
+SNAPSHOT_FILE = 'rules.bin'
+SNAPSHOT_MAGIC = 'MRIR'
+SNAPSHOT_FORMAT = 2
+
+# The snapshot is written by the controller after each change of the tables
+# and read by stat.py, all integers are little endian:
+#   header                       magic, format, number of switches, version
+#   one entry per switch         swid, rule id slots, offset of its records,
+#                                telemetry sample rate (1 in rate reports)
+#   one record per rule id slot  used flag, prefix size, last hop flag,
+#                                address, port, next hop mac
+# so the rule with id i of a switch is at offset + i * RULE.size; slots of
+# ids that are not used have the used flag at 0
+HEADER = struct.Struct('<4sIIQ')
+SWITCH_ENTRY = struct.Struct('<IIII')
+RULE = struct.Struct('<BBBx4sI6s2x')
+
+
+def mac_to_bytes(mac):
+  return binascii.unhexlify(mac.replace(':', ''))
+
+def bytes_to_mac(data):
+  digits = binascii.hexlify(data)
+  return ':'.join([digits[i:i + 2] for i in range(0, len(digits), 2)])
+
+# version of the snapshot at path, 0 if there is none
+def read_version(path):
+  try:
+    with open(path, 'rb') as f:
+      magic, fmt, switches, version = HEADER.unpack(f.read(HEADER.size))
+  except (IOError, OSError, struct.error):
+    return 0
+  if magic != SNAPSHOT_MAGIC:
+    return 0
+  return version
+
+# switches is {swid -> [rule]} with the rule dictionaries of the controller
+# and sample_rates {swid -> rate} (1 when missing), the file is written on a
+# temporary file and renamed over the old one, so readers see either the old
+# or the new snapshot
+def write_snapshot(path, version, switches, sample_rates={}):
+  swids = sorted(switches)
+  offset = HEADER.size + SWITCH_ENTRY.size * len(swids)
+  entries = []
+  records = []
+  for swid in swids:
+    rules = switches[swid]
+    slots = max([r['id'] for r in rules]) + 1 if rules else 0
+    entries.append(SWITCH_ENTRY.pack(swid, slots, offset, sample_rates.get(swid, 1)))
+    table = [RULE.pack(0, 0, 0, '\0' * 4, 0, '\0' * 6)] * slots
+    for r in rules:
+      table[r['id']] = RULE.pack(1, r['match_field'][1], int(r['last_hop']),
+                                 socket.inet_aton(r['match_field'][0]), r['port'],
+                                 mac_to_bytes(r['dstAddr']))
+    records.extend(table)
+    offset += RULE.size * slots
+
+  tmp_path = path + '.tmp'
+  with open(tmp_path, 'wb') as f:
+    f.write(HEADER.pack(SNAPSHOT_MAGIC, SNAPSHOT_FORMAT, len(swids), version))
+    f.write(''.join(entries))
+    f.write(''.join(records))
+    f.flush()
+    os.fsync(f.fileno())
+  os.rename(tmp_path, path)
+
+
+###############################################################################
+### class RuleSnapshot                                                      ###
+###  * Read only view of the rules snapshot written by the controller, the  ###
+###    file is mapped on memory and a rule is found by its position, so     ###
+###    nothing is parsed when a switch is first seen                        ###
+###  * A missing snapshot is seen as empty until the controller writes it   ###
+###  * Structure:                                                           ###
+###    - self.path                                                          ###
+###    - self.data          // mmap of the file                             ###
+###    - self.version                                                       ###
+###    - self.switches      // {swid -> (rule id slots, offset, rate)}      ###
+###    - self.stamp         // (inode, mtime, size) of the mapped file      ###
+###  * Methods:                                                             ###
+###    - reload_if_changed()        // True if a new version was mapped     ###
+###    - slots(swid)                // rule ids of the switch are below it  ###
+###    - rule(swid, rule_id)        // (address, prefix size, port,         ###
+###                                 // last hop, next hop mac) or None      ###
+###    - sample_rate(swid)          // 1 in rate reports of the switch are  ###
+###                                 // cloned, 1 if it is not known         ###
+###############################################################################
+class RuleSnapshot:
+
+  def __init__(self, path):
+    self.path = path
+    self.data = None
+    self.version = 0
+    self.switches = {}
+    self.stamp = None
+    self.load()
+
+  def load(self):
+    try:
+      f = open(self.path, 'rb')
+    except IOError:
+      return
+    try:
+      st = os.fstat(f.fileno())
+      data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    except ValueError:
+      # an empty file can not be mapped
+      raise Exception("Rules snapshot " + self.path + " is truncated")
+    finally:
+      f.close()
+    if len(data) < HEADER.size:
+      data.close()
+      raise Exception("Rules snapshot " + self.path + " is truncated")
+    magic, fmt, num_switches, version = HEADER.unpack_from(data, 0)
+    if magic != SNAPSHOT_MAGIC or fmt != SNAPSHOT_FORMAT:
+      data.close()
+      raise Exception("Rules snapshot " + self.path + " has an unknown format")
+    # every record is checked to be on the file, so rule() can not fail
+    if HEADER.size + num_switches * SWITCH_ENTRY.size > len(data):
+      data.close()
+      raise Exception("Rules snapshot " + self.path + " is truncated")
+    switches = {}
+    for i in range(num_switches):
+      swid, slots, offset, rate = SWITCH_ENTRY.unpack_from(data, HEADER.size + i * SWITCH_ENTRY.size)
+      if offset + slots * RULE.size > len(data):
+        data.close()
+        raise Exception("Rules snapshot " + self.path + " is truncated")
+      switches[swid] = (slots, offset, max(rate, 1))
+    if self.data is not None:
+      self.data.close()
+    self.data = data
+    self.version = version
+    self.switches = switches
+    self.stamp = (st.st_ino, st.st_mtime, st.st_size)
+
+  # costs one stat() when the file did not change; a snapshot that cannot
+  # be mapped (unknown format, truncated) is reported once and the version
+  # mapped before is kept until the file changes again
+  def reload_if_changed(self):
+    try:
+      st = os.stat(self.path)
+    except OSError:
+      return False
+    stamp = (st.st_ino, st.st_mtime, st.st_size)
+    if stamp == self.stamp:
+      return False
+    try:
+      if read_version(self.path) == self.version:
+        self.stamp = stamp
+        return False
+      self.load()
+    except Exception as e:
+      sys.stderr.write('Keeping version %d of the rules snapshot: %s\n' % (self.version, e))
+      self.stamp = stamp
+      return False
+    return True
+
+  def slots(self, swid):
+    return self.switches.get(swid, (0, 0, 1))[0]
+
+  def sample_rate(self, swid):
+    return self.switches.get(swid, (0, 0, 1))[2]
+
+  def rule(self, swid, rule_id):
+    try:
+      slots, offset, rate = self.switches[swid]
+    except KeyError:
+      return None
+    if rule_id >= slots:
+      return None
+    used, prefix_size, last_hop, address, port, mac = RULE.unpack_from(self.data, offset + rule_id * RULE.size)
+    if not used:
+      return None
+    return socket.inet_ntoa(address), prefix_size, port, bool(last_hop), bytes_to_mac(mac)
@@ -0,0 +1,70 @@
+import mmap
+import struct
+
+
+# header of the ring: records written, records read, closed flag
+RING_HDR = struct.Struct('=QQQ')
+WRITTEN = struct.Struct('=Q')
+WRITTEN_OFFSET = 0
+READ = struct.Struct('=Q')
+READ_OFFSET = 8
+CLOSED = struct.Struct('=Q')
+CLOSED_OFFSET = 16
+
+
+###############################################################################
+### class ShmRing                                                           ###
+###  * Single producer, single consumer ring of fixed size records on an    ###
+###    anonymous shared mmap, so it must be created before forking the      ###
+###    process that will read it                                            ###
+###  * The producer only writes the 'written' counter and the consumer only ###
+###    the 'read' counter, so no lock is needed; a record is published by   ###
+###    storing 'written' after the record bytes                             ###
+###  * The producer never blocks: put_many only writes the records that     ###
+###    fit and returns how many they were                                   ###
+###  * Structure:                                                           ###
+###    - self.record        // struct.Struct of a record                    ###
+###    - self.capacity      // number of records                            ###
+###    - self.data          // shared mmap                                  ###
+###  * Methods:                                                             ###
+###    - __init__ (record, capacity)                                        ###
+###    - put_many(records)          // list of tuples, returns how many fit ###
+###    - get_many(max_records)      // list of tuples                       ###
+###    - close()                    // marks that no more records will come ###
+###    - is_closed()                                                        ###
+###############################################################################
+class ShmRing:
+
+  def __init__(self, record, capacity):
+    self.record = record
+    self.capacity = capacity
+    self.data = mmap.mmap(-1, RING_HDR.size + record.size * capacity)
+
+  def put_many(self, records):
+    data = self.data
+    size = self.record.size
+    pack = self.record.pack_into
+    written = WRITTEN.unpack_from(data, WRITTEN_OFFSET)[0]
+    read = READ.unpack_from(data, READ_OFFSET)[0]
+    fit = min(len(records), self.capacity - (written - read))
+    for i in range(fit):
+      pack(data, RING_HDR.size + ((written + i) % self.capacity) * size, *records[i])
+    WRITTEN.pack_into(data, WRITTEN_OFFSET, written + fit)
+    return fit
+
+  def get_many(self, max_records):
+    data = self.data
+    size = self.record.size
+    unpack = self.record.unpack_from
+    written = WRITTEN.unpack_from(data, WRITTEN_OFFSET)[0]
+    read = READ.unpack_from(data, READ_OFFSET)[0]
+    count = min(written - read, max_records)
+    records = [unpack(data, RING_HDR.size + ((read + i) % self.capacity) * size) for i in range(count)]
+    READ.pack_into(data, READ_OFFSET, read + count)
+    return records
+
+  def close(self):
+    CLOSED.pack_into(self.data, CLOSED_OFFSET, 1)
+
+  def is_closed(self):
+    return CLOSED.unpack_from(self.data, CLOSED_OFFSET)[0] == 1
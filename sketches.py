@@ -0,0 +1,309 @@
+import math
+
+
+# relative error of the quantiles estimated by a DDSketch
+SKETCH_ACCURACY = 0.01
+# most buckets kept by a DDSketch, past it the lowest buckets are collapsed
+SKETCH_MAX_BUCKETS = 2048
+
+
+###############################################################################
+### class DDSketch                                                          ###
+###  * Streaming quantile sketch with relative error guarantee (DDSketch):  ###
+###    a value x > 0 is counted on bucket ceil(log_gamma(x)), where         ###
+###    gamma = (1 + accuracy) / (1 - accuracy), so any quantile is returned ###
+###    within accuracy * value of the real one                              ###
+###  * add() is O(1); memory is bounded by max_buckets, collapsing the      ###
+###    lowest buckets into one, which only loses accuracy on low quantiles  ###
+###  * Sketches with the same accuracy are mergeable, merge() adds the      ###
+###    counts of another sketch                                             ###
+###  * Structure:                                                           ###
+###    - self.gamma                                                         ###
+###    - self.bins          // {bucket -> count}                            ###
+###    - self.zero_count    // values <= 0                                  ###
+###    - self.count                                                         ###
+###    - self.max                                                           ###
+###  * Methods:                                                             ###
+###    - add(value)                                                         ###
+###    - merge(other)                                                       ###
+###    - quantile(q)                // 0 <= q <= 1, None if it is empty     ###
+###    - clear()                                                            ###
+###    - encode()                   // plain dict (JSON) of the sketch      ###
+###    - decode(obj)                // static, sketch from encode() output  ###
+###############################################################################
+class DDSketch(object):
+  __slots__ = ('accuracy', 'gamma', 'inv_log_gamma', 'max_buckets', 'bins',
+               'zero_count', 'count', 'max')
+
+  def __init__(self, accuracy=SKETCH_ACCURACY, max_buckets=SKETCH_MAX_BUCKETS):
+    self.accuracy = accuracy
+    self.gamma = (1.0 + accuracy) / (1.0 - accuracy)
+    self.inv_log_gamma = 1.0 / math.log(self.gamma)
+    self.max_buckets = max_buckets
+    self.clear()
+
+  def clear(self):
+    self.bins = {}
+    self.zero_count = 0
+    self.count = 0
+    self.max = 0
+
+  def add(self, value):
+    self.count += 1
+    if value > self.max:
+      self.max = value
+    if value <= 0:
+      self.zero_count += 1
+      return
+    key = int(math.ceil(math.log(value) * self.inv_log_gamma))
+    bins = self.bins
+    try:
+      bins[key] += 1
+    except KeyError:
+      bins[key] = 1
+      if len(bins) > self.max_buckets:
+        self.collapse()
+
+  # folds the lowest buckets into one until the sketch fits max_buckets again
+  def collapse(self):
+    keys = sorted(self.bins)
+    extra = len(keys) - self.max_buckets
+    lowest = keys[extra]
+    for key in keys[:extra]:
+      self.bins[lowest] += self.bins.pop(key)
+
+  def merge(self, other):
+    if other.accuracy != self.accuracy:
+      raise Exception("Only sketches with the same accuracy can be merged")
+    bins = self.bins
+    for key, count in other.bins.items():
+      bins[key] = bins.get(key, 0) + count
+    self.zero_count += other.zero_count
+    self.count += other.count
+    self.max = max(self.max, other.max)
+    if len(bins) > self.max_buckets:
+      self.collapse()
+
+  def quantile(self, q):
+    if self.count == 0:
+      return None
+    rank = q * (self.count - 1)
+    seen = self.zero_count
+    if seen > rank:
+      return 0
+    for key in sorted(self.bins):
+      seen += self.bins[key]
+      if seen > rank:
+        return min(2.0 * self.gamma ** key / (self.gamma + 1.0), self.max)
+    return self.max
+
+  def encode(self):
+    return {
+      'a' : self.accuracy,
+      'b' : [[key, count] for key, count in self.bins.items()],
+      'z' : self.zero_count,
+      'n' : self.count,
+      'm' : self.max
+    }
+
+  @staticmethod
+  def decode(obj, max_buckets=SKETCH_MAX_BUCKETS):
+    sketch = DDSketch(obj['a'], max_buckets)
+    sketch.bins = dict((int(key), count) for key, count in obj['b'])
+    sketch.zero_count = obj['z']
+    sketch.count = obj['n']
+    sketch.max = obj['m']
+    return sketch
+
+
+###############################################################################
+### class WindowedSketch                                                    ###
+###  * Quantiles over a sliding time window: the window is split on slots   ###
+###    sub-windows, each one with its own DDSketch, the oldest one being    ###
+###    cleared and reused when time moves to a new sub-window               ###
+###  * add() is O(1) amortized, merged() merges the sub-windows that are    ###
+###    still inside the window (the window moves in steps of window/slots)  ###
+###  * Structure:                                                           ###
+###    - self.span          // seconds covered by each sub-window           ###
+###    - self.sketches                                                      ###
+###    - self.slot_ids      // sub-window number held by each sketch        ###
+###  * Methods:                                                             ###
+###    - add(value, now)                                                    ###
+###    - add_sketch(sketch, now)    // merges a whole DDSketch at now       ###
+###    - merged(now)                // DDSketch of the last window seconds  ###
+###############################################################################
+class WindowedSketch(object):
+  __slots__ = ('span', 'sketches', 'slot_ids', 'accuracy', 'max_buckets')
+
+  def __init__(self, window, slots, accuracy=SKETCH_ACCURACY, max_buckets=SKETCH_MAX_BUCKETS):
+    self.span = float(window) / slots
+    self.accuracy = accuracy
+    self.max_buckets = max_buckets
+    self.sketches = [DDSketch(accuracy, max_buckets) for i in range(slots)]
+    self.slot_ids = [None] * slots
+
+  def sketch_at(self, now):
+    slot = int(now / self.span)
+    i = slot % len(self.sketches)
+    if self.slot_ids[i] != slot:
+      self.sketches[i].clear()
+      self.slot_ids[i] = slot
+    return self.sketches[i]
+
+  def add(self, value, now):
+    self.sketch_at(now).add(value)
+
+  def add_sketch(self, sketch, now):
+    self.sketch_at(now).merge(sketch)
+
+  def merged(self, now):
+    current = int(now / self.span)
+    result = DDSketch(self.accuracy, self.max_buckets)
+    for slot, sketch in zip(self.slot_ids, self.sketches):
+      if slot is not None and 0 <= current - slot < len(self.sketches):
+        result.merge(sketch)
+    return result
+
+
+###############################################################################
+### class SpaceSaving                                                       ###
+###  * Heavy hitters on bounded memory (Space-Saving): at most capacity     ###
+###    items are monitored, a new item takes the place of one with the      ###
+###    lowest count c and starts at c + 1 with error c                      ###
+###  * For a monitored item count - error <= real count <= count, and any   ###
+###    item with real count > total / capacity is monitored                 ###
+###  * Items are grouped on buckets of equal count so add() is O(1)         ###
+###  * Structure:                                                           ###
+###    - self.capacity                                                      ###
+###    - self.counts        // {item -> count}                              ###
+###    - self.errors        // {item -> error}                              ###
+###    - self.buckets       // {count -> set of items}                      ###
+###    - self.min_count                                                     ###
+###    - self.total         // items added                                  ###
+###  * Methods:                                                             ###
+###    - add(item, weight)                                                  ###
+###    - floor()                    // largest count an unmonitored item    ###
+###                                 // may have                             ###
+###    - top(k)                     // [(item, count, error)] by count      ###
+###    - clear()                                                            ###
+###############################################################################
+class SpaceSaving(object):
+  __slots__ = ('capacity', 'counts', 'errors', 'buckets', 'min_count', 'total')
+
+  def __init__(self, capacity):
+    self.capacity = capacity
+    self.clear()
+
+  def clear(self):
+    self.counts = {}
+    self.errors = {}
+    self.buckets = {}
+    self.min_count = 0
+    self.total = 0
+
+  # weight > 1 counts the item that many times at once (sampled traffic)
+  def add(self, item, weight=1):
+    self.total += weight
+    counts = self.counts
+    buckets = self.buckets
+    try:
+      count = counts[item]
+    except KeyError:
+      if len(counts) < self.capacity:
+        count = 0
+        self.errors[item] = 0
+        self.min_count = min(self.min_count, weight) if counts else weight
+      else:
+        # replaces one of the items with the lowest count
+        count = self.min_count
+        bucket = buckets[count]
+        evicted = bucket.pop()
+        del counts[evicted]
+        del self.errors[evicted]
+        self.errors[item] = count
+        counts[item] = count + weight
+        buckets.setdefault(count + weight, set()).add(item)
+        if not bucket:
+          del buckets[count]
+          self.min_count = count + 1 if weight == 1 else min(buckets)
+        return
+
+    counts[item] = count + weight
+    buckets.setdefault(count + weight, set()).add(item)
+    if count:
+      bucket = buckets[count]
+      bucket.discard(item)
+      if not bucket:
+        del buckets[count]
+        if self.min_count == count:
+          self.min_count = count + 1 if weight == 1 else min(buckets)
+
+  def floor(self):
+    if len(self.counts) < self.capacity:
+      return 0
+    return self.min_count
+
+  def top(self, k):
+    items = sorted(self.counts.items(), key=lambda i: i[1], reverse=True)[:k]
+    return [(item, count, self.errors[item]) for item, count in items]
+
+
+###############################################################################
+### class WindowedSpaceSaving                                               ###
+###  * Heavy hitters of the last window seconds: items are added to the     ###
+###    summary of the current epoch of window seconds, and top() merges it  ###
+###    with the summary of the previous epoch, so it covers between window  ###
+###    and 2 * window seconds                                               ###
+###  * On the merge an item missing from one summary is counted with the    ###
+###    floor() of that summary as both count and error, keeping the bounds  ###
+###    count - error <= real count <= count                                 ###
+###  * Structure:                                                           ###
+###    - self.span                                                          ###
+###    - self.current, self.previous                                        ###
+###    - self.epoch                                                         ###
+###  * Methods:                                                             ###
+###    - add(item, now, weight)                                             ###
+###    - top(k, now)                // [(item, count, error)] by count      ###
+###############################################################################
+class WindowedSpaceSaving(object):
+  __slots__ = ('span', 'current', 'previous', 'epoch')
+
+  def __init__(self, window, capacity):
+    self.span = float(window)
+    self.current = SpaceSaving(capacity)
+    self.previous = SpaceSaving(capacity)
+    self.epoch = None
+
+  def rotate(self, now):
+    epoch = int(now / self.span)
+    if epoch == self.epoch:
+      return
+    if self.epoch is not None and epoch == self.epoch + 1:
+      self.previous, self.current = self.current, self.previous
+    else:
+      self.previous.clear()
+    self.current.clear()
+    self.epoch = epoch
+
+  def add(self, item, now, weight=1):
+    self.rotate(now)
+    self.current.add(item, weight)
+
+  def top(self, k, now):
+    self.rotate(now)
+    merged = []
+    summaries = (self.current, self.previous)
+    floors = [s.floor() for s in summaries]
+    for item in set(self.current.counts) | set(self.previous.counts):
+      count = 0
+      error = 0
+      for summary, floor in zip(summaries, floors):
+        if item in summary.counts:
+          count += summary.counts[item]
+          error += summary.errors[item]
+        else:
+          count += floor
+          error += floor
+      merged.append((item, count, error))
+    merged.sort(key=lambda i: i[1], reverse=True)
+    return merged[:k]
@@ -1,26 +1,176 @@
 import socket
 import argparse
+import errno
+import json
+import select
+import struct
 import time
 
-def receive(port, size, mayprint):
-    udp_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-    orig = ('', port)
+# header written by spammer_UDP_sender.py: flow number, sequence number and
+# send time
+HEADER = struct.Struct('!IQd')
 
-    udp_sock.bind(orig)
-    while True:
-        msg, client = udp_sock.recvfrom(size) 
-        if mayprint:
-            print 'Received message from client ' + str(client) + ':\n' + str(msg) 
-    udp_sock.close()
+# messages read from a socket before looking at the others and at the clock
+BATCH = 256
+# the delay variation histogram counts |D| in microseconds on power of two
+# buckets: bucket 0 is below 1us and bucket i in [2^(i-1), 2^i) us
+HISTOGRAM_BUCKETS = 24
+
+# Statistics of the messages of one flow (source address and flow number of
+# the header). Loss is counted from the sequence numbers: every number up to
+# the highest one received is expected, so a message that arrives late is
+# first counted as lost and then as reordered. The one way delay compares
+# the send time of the header with the receive time, it needs the clocks of
+# both hosts to be synchronized. Jitter is the interarrival jitter of RFC 3550
+# with its per message delay variation D kept on a histogram
+class FlowStats(object):
+    __slots__ = ('name', 'first_seq', 'max_seq', 'received', 'bytes', 'reordered',
+                 'delay_sum', 'delay_min', 'delay_max', 'last_transit', 'jitter',
+                 'histogram', 'reported_received', 'reported_expected')
+
+    def __init__(self, name, seq):
+        self.name = name
+        self.first_seq = seq
+        self.max_seq = seq - 1
+        self.received = 0
+        self.last_transit = None
+        self.jitter = 0.0
+        self.reported_received = 0
+        self.reported_expected = 0
+        self.clear()
+
+    # counters of one report interval
+    def clear(self):
+        self.bytes = 0
+        self.reordered = 0
+        self.delay_sum = 0.0
+        self.delay_min = None
+        self.delay_max = None
+        self.histogram = [0] * HISTOGRAM_BUCKETS
+
+    def add(self, seq, sent, now, size):
+        self.received += 1
+        self.bytes += size
+        if seq > self.max_seq:
+            self.max_seq = seq
+        else:
+            self.reordered += 1
+        transit = now - sent
+        self.delay_sum += transit
+        if self.delay_min is None or transit < self.delay_min:
+            self.delay_min = transit
+        if self.delay_max is None or transit > self.delay_max:
+            self.delay_max = transit
+        if self.last_transit is not None:
+            d = abs(transit - self.last_transit)
+            self.jitter += (d - self.jitter) / 16
+            self.histogram[min(int(d * 1000000).bit_length(), HISTOGRAM_BUCKETS - 1)] += 1
+        self.last_transit = transit
+
+    def report(self, now, interval):
+        received = self.received - self.reported_received
+        expected = (self.max_seq - self.first_seq + 1) - self.reported_expected
+        histogram = list(self.histogram)
+        while histogram and histogram[-1] == 0:
+            histogram.pop()
+        line = {
+            'time' : round(now, 3),
+            'flow' : self.name,
+            'pkts' : received,
+            'bytes' : self.bytes,
+            'bps' : int(self.bytes * 8 / interval),
+            'lost' : expected - received,
+            'reordered' : self.reordered,
+            'total_pkts' : self.received,
+            'total_lost' : self.max_seq - self.first_seq + 1 - self.received,
+            'jitter_ms' : round(self.jitter * 1000, 4),
+            'jitter_hist' : histogram
+        }
+        if received:
+            line['delay_ms'] = [round(self.delay_min * 1000, 4), round(self.delay_sum / received * 1000, 4),
+                                round(self.delay_max * 1000, 4)]
+        self.reported_received = self.received
+        self.reported_expected += expected
+        self.clear()
+        return json.dumps(line, separators=(',', ':'), sort_keys=True)
+
+
+# Messages are read without blocking, BATCH at a time from each socket, from
+# a large socket buffer; the receiver only waits on poll when every socket is
+# empty. Every interval seconds a JSON line is printed for each flow that got
+# messages since the start
+def receive(port, size, mayprint, flows=1, interval=1.0, buffer_size=1 << 24, time_limit=0):
+    socks = []
+    poller = select.poll()
+    for i in range(flows):
+        udp_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        udp_sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, buffer_size)
+        udp_sock.bind(('', port + i))
+        udp_sock.setblocking(0)
+        poller.register(udp_sock.fileno(), select.POLLIN)
+        socks.append(udp_sock)
+    by_fd = dict((s.fileno(), s) for s in socks)
+
+    buf = bytearray(max(size, HEADER.size))
+    stats = {} # (source address, flow number) -> FlowStats
+    init = time.time()
+    last_report = init
+    ready = socks
+    try:
+        while time_limit <= 0 or time.time() - init < time_limit:
+            for udp_sock in ready:
+                for i in xrange(BATCH):
+                    try:
+                        nbytes, client = udp_sock.recvfrom_into(buf)
+                    except socket.error as e:
+                        if e.errno != errno.EAGAIN:
+                            raise
+                        break
+                    now = time.time()
+                    if mayprint:
+                        print 'Received message from client ' + str(client) + ':\n' + str(buf[:nbytes])
+                    if nbytes < HEADER.size:
+                        continue
+                    number, seq, sent = HEADER.unpack_from(buf)
+                    key = (client[0], number)
+                    try:
+                        flow = stats[key]
+                    except KeyError:
+                        flow = stats[key] = FlowStats('%s/%d' % key, seq)
+                    flow.add(seq, sent, now, nbytes)
+
+            now = time.time()
+            if now - last_report >= interval:
+                for key in sorted(stats):
+                    print stats[key].report(now, now - last_report)
+                last_report = now
+            events = poller.poll(max(0, (last_report + interval - now) * 1000))
+            ready = [by_fd[fd] for fd, _ in events]
+    except KeyboardInterrupt:
+        pass
+    now = time.time()
+    if now > last_report:
+        for key in sorted(stats):
+            print stats[key].report(now, now - last_report)
+    for udp_sock in socks:
+        udp_sock.close()
 
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='UDP spammer client')
-    parser.add_argument('-p', '--port', help='Port used by the receiver',
+    parser.add_argument('-p', '--port', help='Port used by the receiver, flow i of the sender arrives on port + i',
                         type=int, action="store", required=True)
-    parser.add_argument('-s', '--size', help='Size of the messages to receive in bytes', 
+    parser.add_argument('-s', '--size', help='Size of the messages to receive in bytes',
                         type=int, action="store", required=True)
     parser.add_argument('-m', '--mayprint', help='determine whether the message should be printed or not (type False or True)',
                         type=bool, action="store", required=False, default=False)
+    parser.add_argument('-f', '--flows', help='Number of ports to receive on, starting at port',
+                        type=int, action="store", required=False, default=1)
+    parser.add_argument('-i', '--interval', help='Seconds between two reports',
+                        type=float, action="store", required=False, default=1.0)
+    parser.add_argument('-b', '--buffer', help='Receive buffer of each socket in bytes',
+                        type=int, action="store", required=False, default=1 << 24)
+    parser.add_argument('-t', '--time', help='Time in seconds to receive, 0 receives until interrupted',
+                        type=float, action="store", required=False, default=0)
     args = parser.parse_args()
-    receive(args.port, args.size, args.mayprint)
\ No newline at end of file
+    receive(args.port, args.size, args.mayprint, args.flows, args.interval, args.buffer, args.time)
@@ -1,7 +1,19 @@
 import socket
 import argparse
+import errno
+import multiprocessing
+import struct
 import time
 
+# Every message starts with this header, read by spammer_UDP_receiver.py:
+# flow number, sequence number of the message on its flow and the time it
+# was sent (seconds since the epoch)
+HEADER = struct.Struct('!IQd')
+
+# A flow saves tokens for at most BATCH messages: after a late wake up it
+# sends up to BATCH messages in a row to catch up, a longer delay is lost
+BATCH = 32
+
 def build_msg(size):
     msg = ''
     for i in range(size):
@@ -9,31 +21,122 @@ def build_msg(size):
 
     return msg
 
-def send(host, port, rate, size, time_limit):
-    udp_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-    dest = (host, port)
+# Flow number i is sent from its own socket to port + i, bound to the source
+# port src_port + i (any port if src_port is 0) and to one of the source
+# addresses, taken in turn
+class Flow(object):
+
+    def __init__(self, number, host, port, src_port, sources, rate, size):
+        self.number = number
+        self.dest = (host, port + number)
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        source = sources[number % len(sources)] if sources else ''
+        self.sock.bind((source, src_port + number if src_port else 0))
+        self.rate = rate
+        self.msg = bytearray(build_msg(size))
+        self.tokens = float(size) # bytes that can be sent right now
+        self.seq = 0
+        self.sent = 0
+        self.failed = 0
+
+    def refill(self, elapsed, size):
+        self.tokens = min(self.tokens + elapsed * self.rate, float(BATCH * size))
 
+    # sends the messages the tokens allow, a full socket buffer ends the batch
+    def send(self, size):
+        while self.tokens >= size:
+            HEADER.pack_into(self.msg, 0, self.number, self.seq, time.time())
+            try:
+                self.sock.sendto(self.msg, self.dest)
+            except socket.error as e:
+                if e.errno not in (errno.ENOBUFS, errno.EAGAIN):
+                    raise
+                self.failed += 1
+                self.tokens = min(self.tokens, float(size))
+                return
+            self.seq += 1
+            self.sent += 1
+            self.tokens -= size
+
+# Token bucket pacing: each flow earns rate bytes per second of wall clock,
+# measured after the sends, so the time spent on sendto and the oversleeping
+# are made up by the next batch instead of lowering the rate
+def send_flows(numbers, host, port, src_port, sources, rate, size, time_limit):
+    flows = [Flow(n, host, port, src_port, sources, rate, size) for n in numbers]
     init = time.time()
-    msg = build_msg(size)
-    while time.time() - init < time_limit:
-        
-        udp_sock.sendto(msg, dest)
-        time.sleep(float(size)/float(rate))
+    last = init
+    while True:
+        now = time.time()
+        if now - init >= time_limit:
+            break
+        for flow in flows:
+            flow.refill(now - last, size)
+            flow.send(size)
+        last = now
+        wait = min([(size - flow.tokens) / flow.rate for flow in flows])
+        if wait > 0:
+            time.sleep(min(wait, init + time_limit - now))
+    elapsed = time.time() - init
+    for flow in flows:
+        flow.sock.close()
+    return elapsed, [(flow.number, flow.sent, flow.failed) for flow in flows]
+
+def send_process(results, *args):
+    results.put(send_flows(*args))
+
+# the rate is split evenly between the flows and the flows between the
+# processes; prints the achieved rate of each flow and of all of them
+def send(host, port, rate, size, time_limit, flows=1, processes=1, src_port=0, sources=None):
+    if size < HEADER.size:
+        raise Exception("Messages must have at least %d bytes" % HEADER.size)
+    if rate <= 0 or flows <= 0:
+        raise Exception("The rate and the number of flows must be positive")
+    flow_rate = float(rate) / flows
+    processes = max(1, min(processes, flows))
+    groups = [range(p, flows, processes) for p in range(processes)]
+    args = (host, port, src_port, sources, flow_rate, size, time_limit)
+    if processes == 1:
+        reports = [send_flows(groups[0], *args)]
+    else:
+        results = multiprocessing.Queue()
+        workers = [multiprocessing.Process(target=send_process, args=(results, group) + args) for group in groups]
+        for w in workers:
+            w.start()
+        reports = [results.get() for w in workers]
+        for w in workers:
+            w.join()
 
-    udp_sock.close()
+    elapsed = max([e for e, _ in reports])
+    stats = sorted([s for _, flow_stats in reports for s in flow_stats])
+    for number, sent, failed in stats:
+        print 'Flow %d -> port %d: %d messages, %.0f bytes/s (%d not sent, socket buffer full)' % (
+            number, port + number, sent, sent * size / elapsed, failed)
+    sent = sum([s for _, s, _ in stats])
+    achieved = sent * size / elapsed
+    print 'Sent %d messages of %d bytes in %.2f s: %.0f bytes/s, %.1f%% of the target %d bytes/s' % (
+        sent, size, elapsed, achieved, 100.0 * achieved / rate, rate)
 
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='UDP spammer client')
     parser.add_argument('-a', '--host', help='IP address of the receiver',
                         type=str, action="store", required=True)
-    parser.add_argument('-p', '--port', help='Port used by the receiver',
+    parser.add_argument('-p', '--port', help='Port used by the receiver, flow i is sent to port + i',
                         type=int, action="store", required=True)
-    parser.add_argument('-r', '--rate', help='Rate to transmit in bytes/s', 
+    parser.add_argument('-r', '--rate', help='Rate to transmit in bytes/s, split between the flows',
                         type=int, action="store", required=True)
-    parser.add_argument('-s', '--size', help='Size of the message to send in bytes', 
+    parser.add_argument('-s', '--size', help='Size of the message to send in bytes',
                         type=int, action="store", required=True)
-    parser.add_argument('-t', '--time', help='Time in seconds to send', 
+    parser.add_argument('-t', '--time', help='Time in seconds to send',
                         type=int, action="store", required=True)
+    parser.add_argument('-f', '--flows', help='Number of flows, each from its own socket',
+                        type=int, action="store", required=False, default=1)
+    parser.add_argument('-P', '--processes', help='Number of processes the flows are split between',
+                        type=int, action="store", required=False, default=1)
+    parser.add_argument('-S', '--src-port', help='Source port of the first flow, flow i is sent from port + i (any port by default)',
+                        type=int, action="store", required=False, default=0)
+    parser.add_argument('-A', '--sources', help='Comma separated local addresses the flows are sent from, in turn',
+                        type=str, action="store", required=False, default=None)
     args = parser.parse_args()
-    send(args.host, args.port, args.rate, args.size, args.time)
\ No newline at end of file
+    send(args.host, args.port, args.rate, args.size, args.time, args.flows, args.processes,
+         args.src_port, args.sources.split(',') if args.sources else None)
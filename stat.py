@@ -1,53 +1,145 @@
 #!/usr/bin/env python
 import sys
+import os
 import struct
 import time
-import ast
 import argparse
+import signal
+import socket
+import multiprocessing
+import Queue
+import zlib
+from array import array
 
-from scapy.all import sniff, sendp, hexdump, get_if_list, get_if_hwaddr
+from scapy.all import sniff, sendp, hexdump, get_if_list, get_if_hwaddr, conf
 from scapy.all import Packet, IPOption
 from scapy.all import PacketListField, ShortField, IntField, LongField, BitField, FieldListField, FieldLenField
 from scapy.all import IP, UDP, Raw
 from scapy.layers.inet import _IPOption_HDR
 
+from mri_decoder import MRI_TYPE, decode_frame, decode_batch
+from capture import RingCapture, PcapReader, packet_statistics
+from timer_wheel import TimerWheel
+from shm_ring import ShmRing
+from event_loop import EventLoop, BoundedQueue, AsyncWriter
+from sketches import DDSketch, WindowedSketch, WindowedSpaceSaving
+from aggregator import Exporter, open_endpoint, decode_partial, MAX_DATAGRAM
+from rule_snapshot import SNAPSHOT_FILE, RuleSnapshot
+from report_emitter import CongestionSnapshot, ReportEmitter, FORMATS
+from metrics_server import MetricsServer
+from history import HistoryWriter
+from profiler import Profiler, monotonic
+
 
 # if a flow dows not generate a packet in the following time (in seconds) it will be set to desactive
 ACTIVE_THRESHOLD = 2 
-# time interval where one verification of active flows will be executed
-VERIFY_TIME = 1
+# resolution (in seconds) of the timer wheel that deactivates flows, a flow is
+# deactivated at most this time after its ACTIVE_THRESHOLD expires
+VERIFY_TIME = 0.1
 # directory where the rules installed on switches are saved
 RULES_DIR = 'rules'
-# minimum time between two congestion reports from the same switch in seconds
+# RuleSnapshot of the rules written by the controller, checked for a new
+# version every RULES_CHECK_TIME seconds
+RULES = None
+RULES_CHECK_TIME = 1
+# minimum time between two congestion reports from the same switch in seconds,
+# a switch congested again before it gets a single report at its end
 CONGESTION_TIME = 1 
+# congestion reports are rendered as text or json lines by a ReportEmitter,
+# off the packet processing path, which keeps at most REPORT_QUEUE_SIZE of
+# them waiting
+REPORT_FORMAT = 'text'
+REPORT_QUEUE_SIZE = 1024
 # thresholds from which a switch will be considered congested
 DELAY_THRESHOLD = 0 # us
 QUEUE_THRESHOLD = 0 # packets on queue
+# sliding window (in seconds) of the delay and queue ocupacy quantiles, and
+# number of sub-windows it moves by
+SKETCH_WINDOW = 10
+SKETCH_SLOTS = 5
+# also keep delay quantiles per egress rule
+RULE_SKETCHES = False
+# when > 0 flows are tracked on bounded memory: only the TOP_FLOWS flows with
+# more packets on the last SKETCH_WINDOW seconds are reported, out of
+# FLOW_COUNTERS flows monitored per switch (Space-Saving). A flow with more
+# than 1/FLOW_COUNTERS of the packets of a switch is always monitored
+TOP_FLOWS = 0
+FLOW_COUNTERS = 64
+# aggregate statistics per path (sequence of switches and rules) and report
+# the PATHS_SHOWN slowest ones every PATH_REPORT_TIME seconds
+PATH_STATS = False
+PATH_REPORT_TIME = 10
+PATHS_SHOWN = 10
+# Exporter sending partial aggregates to an aggregator.py instance every
+# EXPORT_TIME seconds, None when this collector works alone
+EXPORT = None
+EXPORT_TIME = 1
+# [host:]port of the HTTP metrics endpoint, None when it is not served; the
+# MetricsServer gets a new snapshot of the switches every METRICS_TIME seconds
+METRICS_ADDRESS = None
+METRICS = None
+METRICS_TIME = 1
+# directory of the hop history (see history.py), None when it is not kept;
+# HISTORY is the HistoryWriter of this process
+HISTORY_DIR = None
+HISTORY = None
+# endpoint the register reports of the controller (controller.py
+# --aggregate-to) are received on, None when they are not received
+REGISTERS = None
+# Profiler timing the stages of the packet path, None when the collector is
+# not profiled; it writes a summary line every PROFILE_TIME seconds and the
+# whole profile when the process gets PROFILE_SIGNAL
+PROFILER = None
+PROFILE_TIME = 5
+PROFILE_SIGNAL = signal.SIGUSR1
+# identifies this collector on the aggregator
+COLLECTOR_NAME = '%s:%d' % (socket.gethostname(), os.getpid())
+
+# capture timestamp of the packet being processed when it is not processed as
+# it is captured (pcap replay, sharded workers), None otherwise
+PKT_TIME = None
+# held while printing a congestion report when several processes share stdout
+REPORT_LOCK = None
 
 # used while reading packets` traces
 PRIMITIVE_TYPES = (int, float, str, bytes, bool, list, tuple, set, dict, type(None))
 
-#type used to identify mri on ethernet
-MRI_TYPE = 0x6041
+# current time of the collector, the capture time of the packet when it is
+# not processed live
+def now():
+  if PKT_TIME is None:
+    return time.time()
+  return PKT_TIME
+
+# writes a congestion report, replaced by the evented collector so reports
+# never block packet processing
+def print_report(report):
+  if REPORT_LOCK is None:
+    sys.stdout.write(report)
+  else:
+    with REPORT_LOCK:
+      sys.stdout.write(report)
+      sys.stdout.flush()
+
+report_sink = print_report
 
 ###############################################################################
 ### class Rule                                                              ###
 ###  * Represents a rule on the forwarding table of one switch              ###
-###  * Used to store rule information and to keep track of how many times   ###
-###    this rule is used.                                                   ###
+###  * Used to store rule information, how many times the rule is used is   ###
+###    kept by the switch on Switch.rule_uses[rule.id]                      ###
 ###  * Structure:                                                           ###
 ###    - self.id            // identifies the rule on the traces and on the ###
-###                         // file containing this rules                   ###
+###                         // rules snapshot                               ###
 ###    - self.key_addr      // destination address to match this rule       ###
 ###    - self.prefix_size   // prefix_size of the address to match          ###
 ###    - self.egress_port                                                   ###
-###    - self.times_used                                                    ###
 ###  * Methods:                                                             ###
 ###    - __init__ (id, key, pr_size, port)                                  ###
-###    - increment_uses()                                                   ###
 ###############################################################################
 
-class Rule:
+class Rule(object):
+  __slots__ = ('id', 'key_addr', 'prefix_size', 'egress_port')
 
   def __init__(self, id, key, pr_size, port):
     
@@ -55,49 +147,72 @@ class Rule:
     self.key_addr = key
     self.prefix_size = pr_size
     self.egress_port = port
-    self.times_used = 0
-
-  def increment_uses(self):
-    self.times_used += 1
 
 ###############################################################################
-### class Flow                                                              ###
-###  * Represents a flow passing through the switch, a flow here is         ###
+### class FlowTable                                                         ###
+###  * Flows passing through one switch stored by column, a flow here is    ###
 ###    identified by its source address and is used to store info like the  ###
 ###    time where the flow begins and if the flow is active or not, this is ###
 ###    used to determine which flows are competing on the switch            ###
-###  * Also used to keep track of how many packets this flow generated      ###
+###  * Also used to keep track of how many packets each flow generated      ###
+###  * A flow is a row of the table, the columns are arrays indexed by the  ###
+###    row so no object is allocated per flow                               ###
 ###  * Structure:                                                           ###
-###    - self.src           // source host of the flow                      ###
+###    - self.rows          // {source host -> row}                         ###
+###    - self.src           // source host of each row                      ###
 ###    - self.init_time                                                     ###
 ###    - self.num_of_pkts                                                   ###
 ###    - self.last_use                                                      ###
 ###    - self.active                                                        ###
 ###  * Methods:                                                             ###
-###    - __init__ (init_time, src)                                          ###
-###    - increment_pkts()                                                   ###
-###    - verify_active()             // checks if this flow is active by    ###
+###    - row(src)                    // row of src, added if it is new      ###
+###    - increment_pkts(row, weight)                                        ###
+###    - verify_active(row)          // checks if this flow is active by    ###
 ###                                  // comparing the last use time with a  ###
-###                                  // threshold                           ###
+###                                  // threshold, returns if it is active  ###
+###    - deadline(row)               // time where the flow will be set to  ###
+###                                  // desactive if it gets no packets     ###
 ###############################################################################
 
-class Flow:
+class FlowTable(object):
+  __slots__ = ('rows', 'src', 'init_time', 'num_of_pkts', 'last_use', 'active')
+
+  def __init__(self):
+    self.rows = {}
+    self.src = []
+    self.init_time = array('d')
+    self.num_of_pkts = array('L')
+    self.last_use = array('d')
+    self.active = bytearray()
+
+  def __len__(self):
+    return len(self.src)
 
-  def __init__(self, init, src):
-    self.src = src
-    self.init_time = init
-    self.num_of_pkts = 0
-    self.last_use = -1
-    self.active = False
+  def row(self, src):
+    try:
+      return self.rows[src]
+    except KeyError:
+      row = len(self.src)
+      self.rows[src] = row
+      self.src.append(src)
+      self.init_time.append(now())
+      self.num_of_pkts.append(0)
+      self.last_use.append(-1)
+      self.active.append(0)
+      return row
 
-  def increment_pkts(self):
-    self.num_of_pkts += 1
-    self.last_use = time.time()
-    self.active = True
+  def increment_pkts(self, row, weight=1):
+    self.num_of_pkts[row] += weight
+    self.last_use[row] = now()
+    self.active[row] = 1
 
-  def verify_active(self):
-    if (time.time() - self.last_use > ACTIVE_THRESHOLD):
-      self.active = False
+  def verify_active(self, row):
+    if (now() - self.last_use[row] > ACTIVE_THRESHOLD):
+      self.active[row] = 0
+    return self.active[row] == 1
+
+  def deadline(self, row):
+    return self.last_use[row] + ACTIVE_THRESHOLD
 
 
 ###############################################################################
@@ -108,158 +223,562 @@ class Flow:
 ###  * This class is also responsible for printing the congestion reports   ###
 ###  * Structure:                                                           ###
 ###    - self.name                                                          ###
-###    - self.last_delay                                                    ###
-###    - self.last_queue_ocupacy                                            ###
+###    - self.delay                                                         ###
+###    - self.queue_ocupacy                                                 ###
 ###    - self.pkts                                                          ###
-###    - self.flows                                                         ###
+###    - self.flows                   // FlowTable, or WindowedSpaceSaving  ###
+###                                   // of the sources when TOP_FLOWS > 0  ###
+###    - self.active_flows            // rows of the flows active right     ###
+###                                   // now, kept up to date by the        ###
+###                                   // flow_timers wheel                  ###
 ###    - self.rules                                                         ###
+###    - self.rule_uses               // times each rule was used, indexed  ###
+###                                   // by rule id                         ###
 ###    - self.last_congestion_print   // used to implement a time interval  ###
 ###                                   // between congestion reports         ###
+###    - self.report_pending          // congested since the last report    ###
+###    - self.delay_sketch            // quantiles of delay and queue       ###
+###    - self.queue_sketch            // ocupacy on the last SKETCH_WINDOW  ###
+###    - self.rule_delay_sketches     // {rule id -> delay quantiles}, only ###
+###                                   // kept if RULE_SKETCHES              ###
+###    - self.interval_delay          // delay and queue ocupacy since the  ###
+###    - self.interval_queue          // last export, only kept if EXPORT   ###
+###    - self.exported_pkts           // counters at the last export        ###
+###    - self.exported_uses                                                 ###
 ###  * Methods:                                                             ###
 ###    - __init__ (name)                                                    ###
-###    - init_rules()              // reads the switch rules from file      ###
-###    - add_flow(flow)                                                     ###
-###    - income_pkt(src, trace)    // used to update trace information      ###
-###                                // based on a newly received packet      ###
-###    - verify_flows()            // used to verify which flows remain     ###
-###                                // active                                ###
-###    - print_congestion()                                                 ###
+###    - init_rules()              // reads the switch rules from RULES,    ###
+###                                // counters of the rules are kept        ###
+###    - grow_uses(size)           // room for rule ids below size          ###
+###    - income_pkt(src, qdepth, timedelta, rule_id, weight)  // used to    ###
+###                                // update trace information based on a   ###
+###                                // newly received packet, that stands    ###
+###                                // for weight packets when sampled       ###
+###    - income_aggregate(rule_id, pkts, delay_sum, max_qdepth)  // the     ###
+###                                // same from the aggregation registers   ###
+###                                // of a rule, read by the controller     ###
+###    - expire_flow(row)          // called by flow_timers when the flow   ###
+###                                // may have become inactive              ###
+###    - congestion_snapshot()     // CongestionSnapshot for the emitter    ###
+###    - snapshot()                // summary of the switch state sent to   ###
+###                                // the coordinator by sharded workers    ###
+###    - metrics(current)          // switch entry of the metrics snapshot, ###
+###                                // see metrics_server.py                 ###
+###    - partial_aggregate()       // what changed since the last export,   ###
+###                                // see aggregator.py                     ###
 ###############################################################################
-class Switch:
+class Switch(object):
+  __slots__ = ('name', 'delay', 'queue_ocupacy', 'pkts', 'flows', 'active_flows',
+               'rules', 'rule_uses', 'last_congestion_print', 'report_pending', 'alpha',
+               'delay_sketch', 'queue_sketch', 'rule_delay_sketches',
+               'interval_delay', 'interval_queue', 'exported_pkts', 'exported_uses')
 
   def __init__(self, name):
     self.name = name
     self.delay = 0
     self.queue_ocupacy = 0
     self.pkts = 0
-    self.flows = {} # {flow source -> Flow class instance}
+    if TOP_FLOWS > 0:
+      self.flows = WindowedSpaceSaving(SKETCH_WINDOW, FLOW_COUNTERS)
+    else:
+      self.flows = FlowTable()
+    self.active_flows = set()
     self.rules = {} # {rule id     -> Rule class instance}
+    self.rule_uses = array('L')
+    self.exported_uses = array('L')
     self.last_congestion_print = -1
+    self.report_pending = False
     self.init_rules()
     self.alpha = 0.1 # used to estimate the current delay and the current queue
                      # occupation. 
+    self.delay_sketch = WindowedSketch(SKETCH_WINDOW, SKETCH_SLOTS)
+    self.queue_sketch = WindowedSketch(SKETCH_WINDOW, SKETCH_SLOTS)
+    self.rule_delay_sketches = {}
+    self.interval_delay = DDSketch()
+    self.interval_queue = DDSketch()
+    self.exported_pkts = 0
 
   def init_rules(self):
-    global RULES_DIR
-    rules_file = open(RULES_DIR + '/' + self.name)
-    for line in rules_file.readlines():
-      r = ast.literal_eval(line)
-      rule = Rule(r['id'], r['match_field'][0], r['match_field'][1], r['port'])
-      self.rules[r['id']] = rule
-  
-  def add_flow(self, flow):
-    self.flows[flow.src] = flow
+    swid = int(self.name[1:])
+    rules = {}
+    for rule_id in range(RULES.slots(swid)):
+      r = RULES.rule(swid, rule_id)
+      if r is not None:
+        rules[rule_id] = Rule(rule_id, r[0], r[1], r[2])
+    self.rules = rules
+    self.grow_uses(RULES.slots(swid))
 
+  def grow_uses(self, size):
+    if size > len(self.rule_uses):
+      self.exported_uses.extend([0] * (size - len(self.exported_uses)))
+      self.rule_uses.extend([0] * (size - len(self.rule_uses)))
   
-  def income_pkt (self, src, trace):
-    global QUEUE_THRESHOLD, DELAY_THRESHOLD, CONGESTION_TIME
+  def income_pkt (self, src, qdepth, timedelta, rule_id, weight=1):
+    global QUEUE_THRESHOLD, DELAY_THRESHOLD, CONGESTION_TIME, next_report_time, metrics_dirty
+    metrics_dirty = True
+    self.pkts += weight
+    current = now()
+    flows = self.flows
+    if TOP_FLOWS > 0:
+      flows.add(src, current, weight)
+    else:
+      row = flows.row(src)
+      if not flows.active[row]:
+        self.active_flows.add(row)
+        flows.increment_pkts(row, weight)
+        flow_timers.schedule(flows.deadline(row), (self, row))
+      else:
+        flows.increment_pkts(row, weight)
+
     try:
-      flow = self.flows[src]
-      flow.increment_pkts()
-    except KeyError:
-      new_flow = Flow(time.time(), src)
-      new_flow.increment_pkts()
-      self.add_flow(new_flow)
-
-    rule = self.rules[trace.rule_id]
-    rule.increment_uses()
-    if (trace.qdepth > QUEUE_THRESHOLD or trace.timedelta > DELAY_THRESHOLD) and time.time() - self.last_congestion_print > CONGESTION_TIME:
-      self.print_congestion()
-      self.last_congestion_print = time.time()
-
-    self.delay = (1-self.alpha) * self.delay + self.alpha * trace.timedelta  
-    self.queue_ocupacy =  (1-self.alpha) * self.queue_ocupacy + self.alpha * trace.qdepth
+      self.rule_uses[rule_id] += weight
+    except IndexError:
+      # rule installed after the last snapshot this collector read
+      self.grow_uses(rule_id + 1)
+      self.rule_uses[rule_id] += weight
+    self.delay_sketch.add(timedelta, current)
+    self.queue_sketch.add(qdepth, current)
+    if EXPORT is not None:
+      self.interval_delay.add(timedelta)
+      self.interval_queue.add(qdepth)
+    if RULE_SKETCHES:
+      try:
+        self.rule_delay_sketches[rule_id].add(timedelta, current)
+      except KeyError:
+        self.rule_delay_sketches[rule_id] = WindowedSketch(SKETCH_WINDOW, SKETCH_SLOTS)
+        self.rule_delay_sketches[rule_id].add(timedelta, current)
+    if (qdepth > QUEUE_THRESHOLD or timedelta > DELAY_THRESHOLD) and not self.report_pending:
+      self.report_pending = True
+      congested.append(self)
+      next_report_time = min(next_report_time, self.last_congestion_print + CONGESTION_TIME)
+
+    self.delay = (1-self.alpha) * self.delay + self.alpha * timedelta  
+    self.queue_ocupacy =  (1-self.alpha) * self.queue_ocupacy + self.alpha * qdepth
     
-  def verify_flows(self):
-    active_flows = [f for f in self.flows.values() if f.active]
-    for f in active_flows:
-      f.verify_active()
+  # A register report has no source nor per packet values: the delay average
+  # takes pkts steps towards the mean delay of the interval, the queue one
+  # step towards its max qdepth, and each sketch gets a single observation
+  def income_aggregate(self, rule_id, pkts, delay_sum, max_qdepth):
+    global QUEUE_THRESHOLD, DELAY_THRESHOLD, CONGESTION_TIME, next_report_time, metrics_dirty
+    metrics_dirty = True
+    self.pkts += pkts
+    current = now()
+    try:
+      self.rule_uses[rule_id] += pkts
+    except IndexError:
+      self.grow_uses(rule_id + 1)
+      self.rule_uses[rule_id] += pkts
+    timedelta = float(delay_sum) / pkts
+    self.delay_sketch.add(timedelta, current)
+    self.queue_sketch.add(max_qdepth, current)
+    if EXPORT is not None:
+      self.interval_delay.add(timedelta)
+      self.interval_queue.add(max_qdepth)
+    if (max_qdepth > QUEUE_THRESHOLD or timedelta > DELAY_THRESHOLD) and not self.report_pending:
+      self.report_pending = True
+      congested.append(self)
+      next_report_time = min(next_report_time, self.last_congestion_print + CONGESTION_TIME)
+
+    self.delay = timedelta + (1-self.alpha) ** pkts * (self.delay - timedelta)
+    self.queue_ocupacy = (1-self.alpha) * self.queue_ocupacy + self.alpha * max_qdepth
+
+  # flows are only scheduled once while active, when the timer of a flow that
+  # received packets in the meantime expires it is scheduled again
+  def expire_flow(self, row):
+    global metrics_dirty
+    if self.flows.verify_active(row):
+      flow_timers.schedule(self.flows.deadline(row), (self, row))
+    else:
+      self.active_flows.discard(row)
+      metrics_dirty = True
 
   
-  def print_congestion(self):
-    print '========================  CONGESTION REPORT  ========================'
-    print 'Congestion on switch ' + str(self.name) + ' caused by the following flows'
-    active_flows = [f for f in self.flows.values() if f.active]
-    for f in active_flows:
-      print '\tFlow from ' + str(f.src) + ' started ' + '%.2f' % (time.time() - f.init_time) + ' seconds ago -> ' + str(f.num_of_pkts) + ' packets'
-    print 'Delay estimation %.2f' % (float(self.delay)/1000.0) + 'ms'
-    print 'Queue ocupacy estimation: %.0f' % (self.queue_ocupacy) + ' packets'
-    print 'The forwarding rules of this switch are:'
+  # only copies, the report is rendered by the emitter
+  def congestion_snapshot(self, current):
+    flows = self.flows
+    if TOP_FLOWS > 0:
+      top_flows = flows.top(TOP_FLOWS, current)
+      active = []
+    else:
+      top_flows = None
+      active = [(flows.src[f], flows.init_time[f], flows.num_of_pkts[f]) for f in self.active_flows]
+    uses = self.rule_uses
+    rules = []
     for rule in self.rules.values():
-      print '\tRule ' + str(rule.id) + ') ' + str(rule.key_addr) + '/' + str(rule.prefix_size) + ' => port ' + str(rule.egress_port) + ' (used ' + str(rule.times_used) + ' times)'
+      if rule.id in self.rule_delay_sketches:
+        delay = self.rule_delay_sketches[rule.id].merged(current)
+      else:
+        delay = None
+      rules.append((rule.id, rule.key_addr, rule.prefix_size, rule.egress_port, uses[rule.id], delay))
+    return CongestionSnapshot(self.name, current, SKETCH_WINDOW, self.delay, self.queue_ocupacy, top_flows, active,
+                              self.delay_sketch.merged(current), self.queue_sketch.merged(current), rules)
 
+  def snapshot(self):
+    delay = self.delay_sketch.merged(now())
+    return {
+      'name' : self.name,
+      'pkts' : self.pkts,
+      'delay' : self.delay,
+      'delay_p99' : delay.quantile(0.99) or 0,
+      'queue_ocupacy' : self.queue_ocupacy,
+      'active_flows' : len(self.active_flows),
+      'rules' : dict((rule.id, self.rule_uses[rule.id]) for rule in self.rules.values())
+    }
 
+  def metrics(self, current):
+    delay = self.delay_sketch.merged(current)
+    queue = self.queue_sketch.merged(current)
+    flows = self.flows
+    if TOP_FLOWS > 0:
+      flow_list = [(src, count, 1) for src, count, error in flows.top(TOP_FLOWS, current)]
+    else:
+      flow_list = zip(flows.src, flows.num_of_pkts, flows.active)
+    uses = self.rule_uses
+    return {
+      'name' : self.name,
+      'pkts' : self.pkts,
+      'delay' : self.delay,
+      'queue_ocupacy' : self.queue_ocupacy,
+      'active_flows' : len(self.active_flows) if TOP_FLOWS == 0 else len(flow_list),
+      'delay_p50' : delay.quantile(0.5) or 0,
+      'delay_p99' : delay.quantile(0.99) or 0,
+      'queue_p50' : queue.quantile(0.5) or 0,
+      'queue_p99' : queue.quantile(0.99) or 0,
+      'rules' : [(rule.id, '%s/%d' % (rule.key_addr, rule.prefix_size), rule.egress_port, uses[rule.id]) for rule in self.rules.values()],
+      'flows' : flow_list
+    }
 
+  def partial_aggregate(self, swid):
+    uses = self.rule_uses
+    exported = self.exported_uses
+    partial = {
+      'id' : swid,
+      'name' : self.name,
+      'pkts' : self.pkts - self.exported_pkts,
+      'rules' : [[i, uses[i] - exported[i]] for i in range(len(uses)) if uses[i] != exported[i]],
+      'flows' : len(self.active_flows) if TOP_FLOWS == 0 else len(self.flows.current.counts),
+      'delay' : self.interval_delay.encode(),
+      'queue' : self.interval_queue.encode()
+    }
+    self.exported_pkts = self.pkts
+    self.exported_uses = array('L', uses)
+    self.interval_delay.clear()
+    self.interval_queue.clear()
+    return partial
 
-ETHERNET_SIZE = 14
-SWTRACE_SIZE = 16
-MRI_SIZE = 4
-IPV4_SIZE_BEFORE_SRC = 12
 
-def bytes_to_number(pkt, init, size):
-    num = 0
-    for i in range(size):
-      num = num * 256 + pkt[init + i]
-    return num
+###############################################################################
+### class PathTable                                                         ###
+###  * Interns the paths taken by the packets, a path being the sequence of ###
+###    (swid, rule_id) of its hops from the first to the last switch, and   ###
+###    keeps statistics per path                                            ###
+###  * Paths are hash consed: a path is its last hop plus the id of the     ###
+###    path of the previous hops, so interning costs one dict lookup of a   ###
+###    small tuple per hop and common prefixes are stored once              ###
+###  * Statistics are columns indexed by path id                            ###
+###  * Structure:                                                           ###
+###    - self.ids           // {(parent path id, swid, rule_id) -> path id} ###
+###    - self.parent        // parent path id of each path, -1 on the first ###
+###                         // hop                                          ###
+###    - self.hop           // (swid, rule_id) of the last hop of each path ###
+###    - self.pkts                                                          ###
+###    - self.delay_sum     // sum of the end to end delay (sum of the      ###
+###                         // timedelta of every hop) of its packets       ###
+###    - self.max_delay     // largest end to end delay                     ###
+###    - self.hop_delay     // per path, sum of the timedelta of each hop   ###
+###  * Methods:                                                             ###
+###    - intern(hops)               // path id of the hops of a frame       ###
+###    - add(hops, weight)                                                  ###
+###    - hops_of(path)              // [(swid, rule_id)] first hop first    ###
+###    - worst_hop(path)            // (swid, rule_id, mean timedelta)      ###
+###    - slowest(k)                 // ids of the k paths with the highest  ###
+###                                 // mean end to end delay                ###
+###    - format_report(k)                                                   ###
+###############################################################################
+class PathTable(object):
+  __slots__ = ('ids', 'parent', 'hop', 'pkts', 'delay_sum', 'max_delay', 'hop_delay')
 
+  def __init__(self):
+    self.ids = {}
+    self.parent = array('l')
+    self.hop = []
+    self.pkts = array('L')
+    self.delay_sum = array('d')
+    self.max_delay = array('L')
+    self.hop_delay = []
+
+  def __len__(self):
+    return len(self.hop)
+
+  # hops come as on the frame, where the last switch pushed its hop first
+  def intern(self, hops):
+    ids = self.ids
+    path = -1
+    for swid, qdepth, timestamp, timedelta, rule_id in reversed(hops):
+      key = (path, swid, rule_id)
+      try:
+        path = ids[key]
+      except KeyError:
+        ids[key] = len(self.hop)
+        self.parent.append(path)
+        self.hop.append((swid, rule_id))
+        self.pkts.append(0)
+        self.delay_sum.append(0)
+        self.max_delay.append(0)
+        self.hop_delay.append(None)
+        path = ids[key]
+    return path
+
+  def add(self, hops, weight=1):
+    if not hops:
+      return
+    path = self.intern(hops)
+    hop_delay = self.hop_delay[path]
+    if hop_delay is None:
+      hop_delay = self.hop_delay[path] = array('d', [0] * len(hops))
+    total = 0
+    last = len(hops) - 1
+    for i in range(len(hops)):
+      timedelta = hops[last - i][3]
+      hop_delay[i] += timedelta * weight
+      total += timedelta
+    self.pkts[path] += weight
+    self.delay_sum[path] += total * weight
+    if total > self.max_delay[path]:
+      self.max_delay[path] = total
+
+  def hops_of(self, path):
+    hops = []
+    while path != -1:
+      hops.append(self.hop[path])
+      path = self.parent[path]
+    hops.reverse()
+    return hops
+
+  def worst_hop(self, path):
+    hop_delay = self.hop_delay[path]
+    worst = max(range(len(hop_delay)), key=lambda i: hop_delay[i])
+    swid, rule_id = self.hops_of(path)[worst]
+    return swid, rule_id, hop_delay[worst] / self.pkts[path]
+
+  def slowest(self, k):
+    pkts = self.pkts
+    paths = [p for p in range(len(pkts)) if pkts[p]]
+    paths.sort(key=lambda p: self.delay_sum[p] / pkts[p], reverse=True)
+    return paths[:k]
+
+  def format_report(self, k):
+    lines = ['===========================  PATH REPORT  ===========================']
+    for path in self.slowest(k):
+      swid, rule_id, delay = self.worst_hop(path)
+      lines.append(' -> '.join(['s%02d(rule %d)' % hop for hop in self.hops_of(path)]) + ': ' +
+                   str(self.pkts[path]) + ' packets, mean delay %.2fms, max delay %.2fms, worst hop s%02d (%.2fms)' % (
+                     self.delay_sum[path] / self.pkts[path] / 1000.0, self.max_delay[path] / 1000.0, swid, delay / 1000.0))
+    return '\n'.join(lines) + '\n'
 
-def num_of_traces(pkt):
-  return bytes_to_number(pkt, ETHERNET_SIZE, 2)
 
-def get_source(pkt):
-    
-    init_byte = ipv4_start_byte(pkt) + IPV4_SIZE_BEFORE_SRC
-    source = ''
-    for i in range(4):
-      source += str(pkt[init_byte + i])
-      if i < 3:
-        source+='.'
-    return source
- 
-def ipv4_start_byte(pkt):
-  return ETHERNET_SIZE + MRI_SIZE + SWTRACE_SIZE * bytes_to_number(pkt, ETHERNET_SIZE + 2, 2)
-
-
-class Trace:
-  
-  def __init__(self, pkt, i):
-    global ETHERNET_SIZE, SWTRACE_SIZE, MRI_SIZE
-    self.swid = bytes_to_number(pkt, ETHERNET_SIZE + MRI_SIZE + i*SWTRACE_SIZE, 2)
-    self.qdepth = bytes_to_number(pkt, ETHERNET_SIZE + MRI_SIZE + i*SWTRACE_SIZE + 2, 4)
-    self.timestamp = bytes_to_number(pkt, ETHERNET_SIZE + MRI_SIZE + i*SWTRACE_SIZE + 6, 4)
-    self.timedelta = bytes_to_number(pkt, ETHERNET_SIZE + MRI_SIZE + i*SWTRACE_SIZE + 10, 4)
-    self.rule_id = bytes_to_number(pkt, ETHERNET_SIZE + MRI_SIZE + i*SWTRACE_SIZE + 14, 2)
-    
-  
-prev_time = time.time()
 switchs = {} # switch id -> Switch class instance
+paths = PathTable()
+last_path_report = None
+last_export = None
+last_rules_check = None
+last_metrics = None
+metrics_dirty = False # switches changed since the last metrics snapshot
+congested = [] # switches with report_pending
+next_report_time = float('inf') # earliest time one of them can be reported
+flow_timers = TimerWheel(VERIFY_TIME) # (Switch, flow row) by the time the flow becomes inactive
 
-def is_mri_pkt(pkt):
-  ether_type = bytes_to_number(pkt, 12, 2)
-  return ether_type == MRI_TYPE
+def expire_flows():
+    for sw, row in flow_timers.advance(now()):
+      sw.expire_flow(row)
 
-def handle_pkt(pkt):
-    global prev_time
-    pkt_bytes = [ord(b) for b in str(pkt)]
-    if is_mri_pkt(pkt_bytes):
-
-      src = get_source(pkt_bytes)
-      
-      swtraces = [Trace(pkt_bytes, i) for i in range(num_of_traces(pkt_bytes))]
-      
-      if(time.time() - prev_time > VERIFY_TIME):
+def report_paths():
+    global last_path_report
+    if last_path_report is None:
+      last_path_report = now()
+    elif now() - last_path_report > PATH_REPORT_TIME:
+      report_sink(paths.format_report(PATHS_SHOWN))
+      last_path_report = now()
+
+# packets a frame stands for: it was cloned by the switch where the packet
+# left the network (the first hop on the frame), which only clones 1 in its
+# sample rate of the telemetry reports
+def sample_weight(hops):
+    return RULES.sample_rate(hops[0][0]) if hops else 1
+
+# updates the switches crossed by a frame from its decoded hops
+def handle_hops(src, hops):
+    weight = sample_weight(hops)
+    if PATH_STATS:
+      paths.add(hops, weight)
+      report_paths()
+    update_switches(src, hops, weight)
+
+# sends what changed on the switches of this collector since the last export
+def export_aggregates(force=False):
+    global last_export
+    if EXPORT is None:
+      return
+    current = now()
+    if last_export is None:
+      last_export = current
+    elif (force or current - last_export > EXPORT_TIME) and switchs:
+      EXPORT.send(COLLECTOR_NAME, current, current - last_export,
+                  [sw.partial_aggregate(swid) for swid, sw in switchs.items()])
+      last_export = current
+
+# builds a new metrics snapshot and hands it to the metrics server, only when
+# the switches changed since the last one; the window quantiles also move
+# when a slot of the sketches expires, so an unchanged snapshot is built
+# again once per slot
+def publish_metrics():
+    global last_metrics, metrics_dirty
+    if METRICS is None:
+      return
+    current = now()
+    if last_metrics is None or current - last_metrics > METRICS_TIME:
+      if metrics_dirty or last_metrics is None or current - last_metrics > float(SKETCH_WINDOW) / SKETCH_SLOTS:
+        METRICS.publish(current, [switchs[swid].metrics(current) for swid in sorted(switchs)])
+        last_metrics = current
+        metrics_dirty = False
+
+# maps the rules snapshot again when the controller wrote a new version
+def reload_rules():
+    global last_rules_check, metrics_dirty
+    current = now()
+    if last_rules_check is None:
+      last_rules_check = current
+    elif current - last_rules_check > RULES_CHECK_TIME:
+      last_rules_check = current
+      if RULES.reload_if_changed():
+        metrics_dirty = True
         for sw in switchs.values():
-          sw.verify_flows()
-        prev_time = time.time()
+          sw.init_rules()
 
-      for trace in swtraces:
-        try:
-          switchs[trace.swid].income_pkt(src, trace) 
-        except KeyError:
-          switchs[trace.swid] = Switch('s%02d' % (trace.swid))
-          switchs[trace.swid].income_pkt(src, trace)
+# writes the profile summary line when due and the whole profile when it was
+# requested by PROFILE_SIGNAL
+def report_profile():
+    if PROFILER is None:
+      return
+    text = PROFILER.poll(monotonic())
+    if text is not None:
+      report_sink(text)
 
-    
+# replaces the stages of the packet path by timed versions of themselves:
+# decoding, the update of each switch, the expiration of flows, handing the
+# reports to the emitter and rendering them, exports and metrics
+def profile_stages():
+    global decode_frame, decode_batch, expire_flows, emit_reports, export_aggregates, publish_metrics
+    decode_frame = PROFILER.timed('decode', decode_frame, lambda buf: 1)
+    decode_batch = PROFILER.timed('decode', decode_batch, len)
+    Switch.income_pkt = PROFILER.timed_switch('update', Switch.income_pkt)
+    Switch.income_aggregate = PROFILER.timed_switch('update', Switch.income_aggregate)
+    expire_flows = PROFILER.timed('expire', expire_flows)
+    emit_reports = PROFILER.timed('emit', emit_reports)
+    emitter.render = PROFILER.timed('render', emitter.render)
+    export_aggregates = PROFILER.timed('export', export_aggregates)
+    publish_metrics = PROFILER.timed('metrics', publish_metrics)
+    signal.signal(PROFILE_SIGNAL, PROFILER.request_dump)
+
+def render_report(snapshot):
+    return FORMATS[REPORT_FORMAT](snapshot)
+
+emitter = ReportEmitter(render_report, lambda text: report_sink(text), REPORT_QUEUE_SIZE)
+
+# hands to the emitter a snapshot of the congested switches whose last report
+# is older than CONGESTION_TIME, or of all of them with force
+def emit_reports(force=False):
+    global next_report_time
+    current = now()
+    waiting = []
+    next_report_time = float('inf')
+    for sw in congested:
+      due = sw.last_congestion_print + CONGESTION_TIME
+      if force or current > due:
+        emitter.submit(sw.congestion_snapshot(current))
+        sw.last_congestion_print = current
+        sw.report_pending = False
+      else:
+        waiting.append(sw)
+        next_report_time = min(next_report_time, due)
+    congested[:] = waiting
+
+def update_switches(src, hops, weight=1):
+    if HISTORY is not None:
+      HISTORY.add(now(), src, hops, weight)
+    expire_flows()
+    export_aggregates()
+    publish_metrics()
+    reload_rules()
+    report_profile()
+    for swid, qdepth, timestamp, timedelta, rule_id in hops:
+      try:
+        switchs[swid].income_pkt(src, qdepth, timedelta, rule_id, weight)
+      except KeyError:
+        switchs[swid] = Switch('s%02d' % (swid))
+        switchs[swid].income_pkt(src, qdepth, timedelta, rule_id, weight)
+    if congested and now() > next_report_time:
+      emit_reports()
+
+# updates the switches of a register report sent by the controller
+def apply_register_report(report):
+    for entry in report['switches']:
+      swid = entry['id']
+      if swid not in switchs:
+        switchs[swid] = Switch('s%02d' % (swid))
+      for rule_id, pkts, delay_sum, max_qdepth in entry['rules']:
+        if pkts > 0:
+          switchs[swid].income_aggregate(rule_id, pkts, delay_sum, max_qdepth)
+    if congested and now() > next_report_time:
+      emit_reports()
+
+# raw bytes of a captured frame
+def handle_frame(buf):
+    decoded = decode_frame(buf)
+    if decoded is not None:
+      handle_hops(*decoded)
+
+# a list of raw frames decoded in one pass
+def handle_batch(frames):
+    for src, hops in decode_batch(frames).by_frame():
+      handle_hops(src, hops)
+    sys.stdout.flush()
+
+def handle_pkt(pkt):
+    handle_frame(str(pkt))
+    sys.stdout.flush()
+
+# runs the collector over a capture file as fast as it can be read, using the
+# capture timestamps as the collector time
+def replay(path, handle_frame=handle_frame):
+    global PKT_TIME
+    reader = PcapReader(path)
+    frames = 0
+    # a replay does not drop reports, it waits for the emitter
+    emitter.lossless = True
+    emitter.start()
+    start = time.time()
+    try:
+      for ts, buf in reader:
+        PKT_TIME = ts
+        handle_frame(buf)
+        frames += 1
+      emit_reports(force=True)
+    finally:
+      reader.close()
+      emitter.close()
+      if PROFILER is not None:
+        report_sink(PROFILER.dump(monotonic()))
+      if HISTORY is not None:
+        HISTORY.close()
+      PKT_TIME = None
+    elapsed = time.time() - start
+    if PATH_STATS:
+      report_sink(paths.format_report(PATHS_SHOWN))
+    export_aggregates(force=True)
+    print 'Replayed %d frames from %s in %.2f s (%.0f frames/s)' % (frames, path, elapsed, frames / max(elapsed, 1e-9))
+    if reader.skipped:
+      print '%d packet blocks skipped, their interface has no description block' % reader.skipped
     sys.stdout.flush()
 
 
@@ -275,12 +794,347 @@ def get_if():
         exit(1)
     return iface
 
-def main():
-    iface = 'h070-eth0'
+def main(iface, backend, handle_batch=handle_batch, handle_pkt=handle_pkt):
     print "sniffing on %s" % iface
     sys.stdout.flush()
-    sniff(iface = iface,
-          prn = lambda x: handle_pkt(x))
+    emitter.start()
+    try:
+      if backend in ('ring', 'evented'):
+        capture = RingCapture(iface, MRI_TYPE)
+        if PROFILER is not None:
+          PROFILER.add_drop_source('ring', capture.statistics)
+        try:
+          capture.run(handle_batch)
+        finally:
+          capture.close()
+      elif PROFILER is not None:
+        # the socket is opened here to read its kernel drops
+        sock = conf.L2listen(iface = iface)
+        PROFILER.add_drop_source('scapy', lambda: packet_statistics(sock.ins))
+        try:
+          sniff(opened_socket = sock,
+                prn = lambda x: handle_pkt(x))
+        finally:
+          sock.close()
+      else:
+        sniff(iface = iface,
+              prn = lambda x: handle_pkt(x))
+    finally:
+      emitter.close()
+      if PROFILER is not None:
+        report_sink(PROFILER.dump(monotonic()))
+      if HISTORY is not None:
+        HISTORY.close()
+      if emitter.dropped:
+        print '%d congestion reports dropped because the emitter was behind' % emitter.dropped
+
+
+###############################################################################
+#####################          EVENTED COLLECTOR          #####################
+###############################################################################
+
+# frames waiting between the ingest and the state update stages
+EVENT_QUEUE_SIZE = 1 << 16
+# frames decoded and accounted per loop iteration
+EVENT_BATCH = 256
+# bytes of reports waiting to be written to stdout
+EVENT_OUTPUT_SIZE = 1 << 20
+# time in seconds between two status lines of the evented collector
+STATUS_TIME = 5
+
+# runs capture, accounting and output as stages of a single event loop with
+# bounded queues between them: the ring socket is only read when the loop
+# reports it readable, and reports are written to stdout only when it is
+# writable, so a slow terminal or pipe drops reports instead of frames
+def run_evented(iface):
+    global report_sink
+    print "sniffing on %s (evented)" % iface
+    sys.stdout.flush()
+
+    loop = EventLoop()
+    capture = RingCapture(iface, MRI_TYPE)
+    frames = BoundedQueue(EVENT_QUEUE_SIZE)
+    writer = AsyncWriter(loop, sys.stdout.fileno(), EVENT_OUTPUT_SIZE)
+    report_sink = writer.write
+    counters = {'ingested' : 0, 'processed' : 0}
+
+    # ingest stage, the frames are copied out of the ring so its blocks go
+    # back to the kernel right away
+    def on_block(block):
+      counters['ingested'] += frames.put_many([bytes(f) for f in block])
+
+    def ingest():
+      capture.read_blocks(on_block)
+
+    # state update stage
+    def update():
+      batch = frames.get_many(EVENT_BATCH)
+      for src, hops in decode_batch(batch).by_frame():
+        handle_hops(src, hops)
+      counters['processed'] += len(batch)
+      return len(frames) > 0
+
+    # output stage, congested switches are also reported when no frames come
+    def reports():
+      if congested and now() > next_report_time:
+        emit_reports()
+
+    # register reports of the controller, read on the same loop
+    def registers():
+      while True:
+        try:
+          datagram, sender = registers_sock.recvfrom(MAX_DATAGRAM + 4096)
+        except socket.error:
+          return
+        try:
+          apply_register_report(decode_partial(datagram))
+        except (ValueError, zlib.error, KeyError, TypeError):
+          writer.write('[status] discarding a malformed register report\n')
+
+    def status():
+      writer.write('[status] ingested %d frames (%.0f frames/s), processed %d, queue %d/%d (max %d), dropped %d frames, output %d bytes buffered, dropped %d reports\n' % (
+        counters['ingested'], counters['ingested'] / float(STATUS_TIME), counters['processed'],
+        len(frames), frames.limit, frames.high_water, frames.dropped, writer.size, writer.dropped + emitter.dropped))
+      counters['ingested'] = 0
+      counters['processed'] = 0
+
+    loop.add_reader(capture.fileno(), ingest)
+    registers_sock = None
+    if REGISTERS is not None:
+      registers_sock, address = open_endpoint(REGISTERS, bind=True)
+      registers_sock.setblocking(0)
+      loop.add_reader(registers_sock.fileno(), registers)
+    loop.add_task(update)
+    loop.add_task(lambda: emitter.run_pending(EVENT_BATCH))
+    loop.call_every(VERIFY_TIME, expire_flows)
+    loop.call_every(VERIFY_TIME, reports)
+    loop.call_every(STATUS_TIME, status)
+    if PROFILER is not None:
+      PROFILER.add_drop_source('ring', capture.statistics)
+      loop.call_every(VERIFY_TIME, report_profile)
+    try:
+      loop.run()
+    finally:
+      # what is buffered and the reports still pending are written blocking,
+      # as the other collectors do on exit
+      writer.close(drain=True)
+      report_sink = print_report
+      emit_reports(force=True)
+      emitter.run_pending()
+      # last, so the profile also covers the reports rendered above
+      if PROFILER is not None:
+        report_sink(PROFILER.dump(monotonic()))
+      sys.stdout.flush()
+      capture.close()
+      if registers_sock is not None:
+        registers_sock.close()
+      if HISTORY is not None:
+        HISTORY.close()
+
+
+###############################################################################
+#####################          SHARDED COLLECTOR          #####################
+###############################################################################
+
+# hop record sent from the capture process to the workers: capture time,
+# source address, qdepth, timestamp, timedelta, swid, rule_id and the sample
+# weight of its frame
+HOP_RECORD = struct.Struct('=d4sIIIHHI')
+# records on the ring of each worker
+SHARD_RING_SIZE = 1 << 16
+# records moved at once from/to a ring
+SHARD_BATCH = 1024
+# time in seconds between two snapshots of the workers
+SNAPSHOT_TIME = 1
+
+
+###############################################################################
+### class ShardDispatcher                                                   ###
+###  * Runs on the capture process, decodes the frames and sends each hop   ###
+###    to the worker that owns its switch (swid % number of workers) over   ###
+###    the worker ShmRing                                                   ###
+###  * Live captures never wait for the workers, hops that do not fit on a  ###
+###    ring are dropped and counted; replays (lossless) wait instead        ###
+###  * Structure:                                                           ###
+###    - self.rings                                                         ###
+###    - self.pending       // hops not written yet, one list per ring      ###
+###    - self.lossless                                                      ###
+###    - self.dropped                                                       ###
+###  * Methods:                                                             ###
+###    - __init__ (rings, lossless)                                         ###
+###    - handle_frame(buf), handle_batch(frames), handle_pkt(pkt)  // same  ###
+###      interface as the single process collector                          ###
+###    - flush()                                                            ###
+###    - close()                    // flushes and closes every ring        ###
+###############################################################################
+class ShardDispatcher:
+
+  def __init__(self, rings, lossless):
+    self.rings = rings
+    self.pending = [[] for r in rings]
+    self.lossless = lossless
+    self.dropped = 0
+
+  def dispatch(self, src, hops):
+    ts = now()
+    # the weight also needs every hop of the frame
+    reload_rules()
+    report_profile()
+    weight = sample_weight(hops)
+    # paths need every hop of the frame, so they are kept by this process
+    if PATH_STATS:
+      paths.add(hops, weight)
+      report_paths()
+    addr = socket.inet_aton(src)
+    for swid, qdepth, timestamp, timedelta, rule_id in hops:
+      shard = swid % len(self.rings)
+      self.pending[shard].append((ts, addr, qdepth, timestamp, timedelta, swid, rule_id, weight))
+      if len(self.pending[shard]) >= SHARD_BATCH:
+        self.flush_ring(shard)
+
+  def handle_frame(self, buf):
+    decoded = decode_frame(buf)
+    if decoded is not None:
+      self.dispatch(*decoded)
+
+  def handle_batch(self, frames):
+    for src, hops in decode_batch(frames).by_frame():
+      self.dispatch(src, hops)
+    self.flush()
+
+  def handle_pkt(self, pkt):
+    self.handle_frame(str(pkt))
+    self.flush()
+
+  def flush_ring(self, shard):
+    pending = self.pending[shard]
+    fit = self.rings[shard].put_many(pending)
+    while self.lossless and fit < len(pending):
+      time.sleep(0.001)
+      pending = pending[fit:]
+      fit = self.rings[shard].put_many(pending)
+    self.dropped += len(pending) - fit
+    self.pending[shard] = []
+
+  def flush(self):
+    for shard in range(len(self.rings)):
+      if self.pending[shard]:
+        self.flush_ring(shard)
+
+  def close(self):
+    self.flush()
+    for ring in self.rings:
+      ring.close()
+
+
+# worker process: owns the switches whose hops are sent to its ring and runs
+# the same accounting of the single process collector over them
+def shard_worker(index, ring, snapshots, lossless):
+    global PKT_TIME, COLLECTOR_NAME, METRICS, HISTORY
+    # each worker exports the partials of its own switches, serves their
+    # metrics on the port of the metrics address plus its index and keeps
+    # their history on its own store
+    COLLECTOR_NAME = '%s/worker%d' % (COLLECTOR_NAME, index)
+    if PROFILER is not None:
+      PROFILER.name = 'worker%d' % index
+    if METRICS_ADDRESS is not None:
+      METRICS = MetricsServer(METRICS_ADDRESS, index)
+      METRICS.start()
+    if HISTORY_DIR is not None:
+      HISTORY = HistoryWriter(os.path.join(HISTORY_DIR, 'worker%d' % index))
+    emitter.lossless = lossless
+    emitter.start()
+    last_snapshot = time.time()
+    while True:
+      records = ring.get_many(SHARD_BATCH)
+      if not records:
+        if ring.is_closed():
+          # the producer may have written before closing
+          records = ring.get_many(SHARD_BATCH)
+          if not records:
+            break
+        else:
+          time.sleep(0.001)
+
+      for ts, addr, qdepth, timestamp, timedelta, swid, rule_id, weight in records:
+        PKT_TIME = ts
+        update_switches(socket.inet_ntoa(addr), [(swid, qdepth, timestamp, timedelta, rule_id)], weight)
+
+      if time.time() - last_snapshot > SNAPSHOT_TIME:
+        snapshots.put((index, dict((swid, sw.snapshot()) for swid, sw in switchs.items())))
+        last_snapshot = time.time()
+
+    emit_reports(force=True)
+    emitter.close()
+    if PROFILER is not None:
+      report_sink(PROFILER.dump(monotonic()))
+    snapshots.put((index, dict((swid, sw.snapshot()) for swid, sw in switchs.items())))
+    export_aggregates(force=True)
+    if METRICS is not None:
+      METRICS.close()
+    if HISTORY is not None:
+      HISTORY.close()
+    snapshots.put((index, None))
+
+
+# switches are owned by a single worker, so merging is the union of the last
+# snapshot of every worker
+def merge_snapshots(views):
+    merged = {}
+    for view in views.values():
+      merged.update(view)
+    return merged
+
+def print_network_view(merged):
+    print '=========================  NETWORK SNAPSHOT  ========================='
+    for swid in sorted(merged):
+      sw = merged[swid]
+      print '%s: %d packets, delay estimation %.2fms (p99 %.2fms), queue ocupacy estimation %.0f packets, %d active flows' % (sw['name'], sw['pkts'], float(sw['delay'])/1000.0, sw['delay_p99']/1000.0, sw['queue_ocupacy'], sw['active_flows'])
+
+# coordinator process: merges the snapshots of the workers into the view of
+# the whole network and prints it every SNAPSHOT_TIME
+def shard_coordinator(snapshots, workers):
+    views = {} # worker index -> {swid -> snapshot}
+    last_print = time.time()
+    while workers > 0:
+      try:
+        index, view = snapshots.get(timeout=SNAPSHOT_TIME)
+        if view is None:
+          workers -= 1
+        else:
+          views[index] = view
+      except Queue.Empty:
+        pass
+      if time.time() - last_print > SNAPSHOT_TIME or workers == 0:
+        with REPORT_LOCK:
+          print_network_view(merge_snapshots(views))
+          sys.stdout.flush()
+        last_print = time.time()
+
+# partitions the switches over workers processes, this process only captures
+# (or reads the pcap file) and dispatches hops to them
+def run_sharded(workers, iface, backend, pcap):
+    global REPORT_LOCK
+    REPORT_LOCK = multiprocessing.Lock()
+    rings = [ShmRing(HOP_RECORD, SHARD_RING_SIZE) for i in range(workers)]
+    snapshots = multiprocessing.Queue()
+    processes = [multiprocessing.Process(target=shard_worker, args=(i, rings[i], snapshots, pcap is not None)) for i in range(workers)]
+    processes.append(multiprocessing.Process(target=shard_coordinator, args=(snapshots, workers)))
+    for p in processes:
+      p.start()
+
+    dispatcher = ShardDispatcher(rings, lossless=pcap is not None)
+    try:
+      if pcap:
+        replay(pcap, dispatcher.handle_frame)
+      else:
+        main(iface, backend, dispatcher.handle_batch, dispatcher.handle_pkt)
+    finally:
+      dispatcher.close()
+      for p in processes:
+        p.join()
+      if dispatcher.dropped:
+        print '%d hops dropped because the workers were behind' % dispatcher.dropped
 
 
 if __name__ == '__main__':
@@ -289,10 +1143,73 @@ if __name__ == '__main__':
                         type=int, action="store", required=True)
     parser.add_argument('-q', '--queue_oc', help='Queue ocupacy threshold in packets', 
                         type=int, action="store", required=True)
+    parser.add_argument('-i', '--iface', help='Interface where the telemetry clones are received',
+                        type=str, action="store", required=False, default='h070-eth0')
+    parser.add_argument('-b', '--backend', help='Capture backend: scapy (sniff), ring (AF_PACKET mmap ring, Linux only) or evented (ring read from a non-blocking event loop)',
+                        type=str, action="store", required=False, default='scapy',
+                        choices=['scapy', 'ring', 'evented'])
+    parser.add_argument('-p', '--pcap', help='Analyse a pcap/pcapng capture file instead of sniffing',
+                        type=str, action="store", required=False, default=None)
+    parser.add_argument('-r', '--rule-sketches', help='Also report delay quantiles per forwarding rule',
+                        action="store_true", required=False, default=False)
+    parser.add_argument('-k', '--top-flows', help='Track flows on bounded memory and report only the K heaviest ones of each switch',
+                        type=int, action="store", required=False, default=0)
+    parser.add_argument('-m', '--flow-counters', help='Flows monitored per switch with --top-flows (memory per switch), default 4*K',
+                        type=int, action="store", required=False, default=None)
+    parser.add_argument('-P', '--paths', help='Aggregate statistics per path and periodically report the slowest paths',
+                        action="store_true", required=False, default=False)
+    parser.add_argument('-x', '--export', help='Send partial aggregates to an aggregator.py at udp:host:port or unix:/path',
+                        type=str, action="store", required=False, default=None)
+    parser.add_argument('-n', '--name', help='Name of this collector on the aggregator (default host:pid)',
+                        type=str, action="store", required=False, default=None)
+    parser.add_argument('-j', '--report-format', help='Format of the congestion reports: text or json (one object per line)',
+                        type=str, action="store", required=False, default='text',
+                        choices=sorted(FORMATS))
+    parser.add_argument('-M', '--metrics', help='Serve metrics over HTTP on [host:]port, /metrics as Prometheus text and /metrics.json (worker i of --workers on port + i)',
+                        type=str, action="store", required=False, default=None)
+    parser.add_argument('-H', '--history', help='Keep every hop and per second rollups on a columnar store on this directory, queried with history.py',
+                        type=str, action="store", required=False, default=None)
+    parser.add_argument('-R', '--registers', help='Receive the register reports of controller.py --aggregate-to on udp:host:port or unix:/path (evented backend only)',
+                        type=str, action="store", required=False, default=None)
+    parser.add_argument('-T', '--profile', help='Time the stages of the collector and count its kernel drops, printing a summary every PROFILE seconds and the whole profile on SIGUSR1 and on exit',
+                        type=float, action="store", required=False, default=None)
+    parser.add_argument('-w', '--workers', help='Number of worker processes the switches are partitioned over (0 runs everything on this process)',
+                        type=int, action="store", required=False, default=0)
     args = parser.parse_args()
+    if args.registers and (args.backend != 'evented' or args.workers > 0 or args.pcap):
+      parser.error('--registers needs the evented backend, without --workers nor --pcap')
 
     DELAY_THRESHOLD = args.delay * 1000
     QUEUE_THRESHOLD = args.queue_oc
+    RULE_SKETCHES = args.rule_sketches
+    TOP_FLOWS = args.top_flows
+    PATH_STATS = args.paths
+    if args.export:
+      EXPORT = Exporter(args.export)
+    if args.name:
+      COLLECTOR_NAME = args.name
+    FLOW_COUNTERS = args.flow_counters or max(4 * TOP_FLOWS, 1)
+    REPORT_FORMAT = args.report_format
+    METRICS_ADDRESS = args.metrics
+    if METRICS_ADDRESS is not None and args.workers == 0:
+      METRICS = MetricsServer(METRICS_ADDRESS)
+      METRICS.start()
+    HISTORY_DIR = args.history
+    if HISTORY_DIR is not None and args.workers == 0:
+      HISTORY = HistoryWriter(HISTORY_DIR)
+    REGISTERS = args.registers
+    if args.profile is not None:
+      PROFILE_TIME = args.profile
+      PROFILER = Profiler('collector', PROFILE_TIME)
+      profile_stages()
+    RULES = RuleSnapshot(os.path.join(RULES_DIR, SNAPSHOT_FILE))
 
-    main()
+    if args.workers > 0:
+      run_sharded(args.workers, args.iface, args.backend, args.pcap)
+    elif args.pcap:
+      replay(args.pcap)
+    elif args.backend == 'evented':
+      run_evented(args.iface)
+    else:
+      main(args.iface, args.backend)
 
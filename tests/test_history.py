@@ -0,0 +1,72 @@
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+# appended, so stat.py of the repository does not shadow the stat module
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import history
+from history import HistoryWriter, HistoryReader, column_rows, read_column
+
+
+class HistoryWriterTest(unittest.TestCase):
+
+  def setUp(self):
+    self.dir = tempfile.mkdtemp()
+    self.index_block = history.INDEX_BLOCK
+    self.flush_time = history.FLUSH_TIME
+    history.INDEX_BLOCK = 4
+    # rows are only appended by the flushes of the tests
+    history.FLUSH_TIME = 600
+
+  def tearDown(self):
+    history.INDEX_BLOCK = self.index_block
+    history.FLUSH_TIME = self.flush_time
+    shutil.rmtree(self.dir)
+
+  def add(self, writer, times):
+    for t in times:
+      writer.add(t, '10.0.1.1', [(5, 1, 0, 100, 2)])
+
+  def index(self):
+    path = os.path.join(self.dir, 'p0', 'hops.index')
+    return list(read_column(path, 'd', '<f8', 0, column_rows(path, 'd')))
+
+  def times(self):
+    reader = HistoryReader(self.dir)
+    return sorted(reader.scan('hops', 0, 600, ['time'])['time'])
+
+  def test_index(self):
+    writer = HistoryWriter(self.dir)
+    self.add(writer, [1.0 + i for i in range(10)])
+    writer.close()
+    self.assertEqual(self.index(), [1.0, 4.0, 5.0, 8.0])
+    self.assertEqual(self.times(), [1.0 + i for i in range(10)])
+
+  # the collector dies after appending the columns of complete blocks and
+  # before appending their index
+  def test_lost_index_append(self):
+    writer = HistoryWriter(self.dir)
+    self.add(writer, [1.0 + i for i in range(10)])
+    append_column = history.append_column
+    def skip_index(f, values):
+      if not f.name.endswith('hops.index'):
+        append_column(f, values)
+    history.append_column = skip_index
+    try:
+      writer.flush()
+    finally:
+      history.append_column = append_column
+    writer.close_files()
+    self.assertEqual(self.index(), [])
+
+    writer = HistoryWriter(self.dir)
+    self.add(writer, [11.0 + i for i in range(7)])
+    writer.close()
+    self.assertEqual(self.index(), [1.0, 4.0, 5.0, 8.0, 9.0, 12.0, 13.0, 16.0])
+    self.assertEqual(self.times(), [1.0 + i for i in range(17)])
+
+
+if __name__ == '__main__':
+  unittest.main()
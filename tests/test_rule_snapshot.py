@@ -0,0 +1,63 @@
+import os
+import shutil
+import sys
+import tempfile
+import time
+import unittest
+
+# appended, so stat.py of the repository does not shadow the stat module
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from rule_snapshot import SNAPSHOT_FILE, RuleSnapshot, write_snapshot
+
+
+RULES = {
+  5 : [{'id' : 0, 'match_field' : ('10.0.3.0', 24), 'last_hop' : False, 'port' : 1, 'dstAddr' : '00:00:00:03:03:00'},
+       {'id' : 2, 'match_field' : ('10.0.6.0', 24), 'last_hop' : True, 'port' : 3, 'dstAddr' : '00:00:00:06:06:00'}],
+  7 : [{'id' : 0, 'match_field' : ('10.0.1.0', 24), 'last_hop' : False, 'port' : 2, 'dstAddr' : '00:00:00:01:01:00'}],
+}
+
+class RuleSnapshotTest(unittest.TestCase):
+
+  def setUp(self):
+    self.dir = tempfile.mkdtemp()
+    self.path = os.path.join(self.dir, SNAPSHOT_FILE)
+    write_snapshot(self.path, 1, RULES, {7 : 4})
+
+  def tearDown(self):
+    shutil.rmtree(self.dir)
+
+  # replaces the snapshot by its first size bytes, with a new mtime
+  def truncate(self, size):
+    with open(self.path, 'rb') as f:
+      data = f.read()
+    time.sleep(0.01)
+    with open(self.path + '.tmp', 'wb') as f:
+      f.write(data[:size])
+    os.rename(self.path + '.tmp', self.path)
+
+  def test_rules(self):
+    snapshot = RuleSnapshot(self.path)
+    self.assertEqual(snapshot.version, 1)
+    self.assertEqual(snapshot.slots(5), 3)
+    self.assertEqual(snapshot.rule(5, 2), ('10.0.6.0', 24, 3, True, '00:00:00:06:06:00'))
+    self.assertEqual(snapshot.rule(5, 1), None)
+    self.assertEqual(snapshot.sample_rate(7), 4)
+    self.assertEqual(snapshot.sample_rate(5), 1)
+
+  def test_truncated_load(self):
+    for size in (0, 10, 40, os.path.getsize(self.path) - 1):
+      self.truncate(size)
+      self.assertRaises(Exception, RuleSnapshot, self.path)
+      write_snapshot(self.path, 1, RULES)
+
+  def test_truncated_reload_keeps_version(self):
+    snapshot = RuleSnapshot(self.path)
+    write_snapshot(self.path, 2, RULES)
+    self.truncate(os.path.getsize(self.path) - 1)
+    self.assertFalse(snapshot.reload_if_changed())
+    self.assertEqual(snapshot.version, 1)
+    self.assertEqual(snapshot.rule(5, 2), ('10.0.6.0', 24, 3, True, '00:00:00:06:06:00'))
+
+
+if __name__ == '__main__':
+  unittest.main()
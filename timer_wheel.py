@@ -0,0 +1,51 @@
+###############################################################################
+### class TimerWheel                                                        ###
+###  * Hashed timing wheel: a circular array of buckets where each bucket   ###
+###    holds the items whose deadline falls on one tick of time             ###
+###  * schedule() and advance() cost O(1) and O(ticks elapsed + items that  ###
+###    expired), so expiring timers does not depend on how many timers are  ###
+###    pending                                                              ###
+###  * Deadlines beyond the wheel horizon (slots * tick) fire at the        ###
+###    horizon, callers are expected to check the item and schedule it      ###
+###    again when it is not due yet                                         ###
+###  * Structure:                                                           ###
+###    - self.tick          // time covered by a bucket in seconds          ###
+###    - self.buckets                                                       ###
+###    - self.current       // tick number of the next bucket to expire     ###
+###  * Methods:                                                             ###
+###    - __init__ (tick, slots)                                             ###
+###    - schedule(deadline, item)                                           ###
+###    - advance(now)               // returns the items whose tick passed  ###
+###############################################################################
+class TimerWheel:
+
+  def __init__(self, tick, slots=256):
+    self.tick = float(tick)
+    self.buckets = [[] for i in range(slots)]
+    self.current = None
+
+  def schedule(self, deadline, item):
+    slot = int(deadline / self.tick)
+    if self.current is None:
+      self.current = slot
+    # past deadlines fire on the next advance, the far ones at the horizon
+    slot = min(max(slot, self.current), self.current + len(self.buckets) - 1)
+    self.buckets[slot % len(self.buckets)].append(item)
+
+  def advance(self, now):
+    slot = int(now / self.tick)
+    if self.current is None:
+      self.current = slot
+    if slot <= self.current:
+      return []
+
+    expired = []
+    slots = len(self.buckets)
+    # after a gap longer than the horizon every bucket is due once
+    for s in range(self.current, min(slot, self.current + slots)):
+      bucket = self.buckets[s % slots]
+      if bucket:
+        expired.extend(bucket)
+        self.buckets[s % slots] = []
+    self.current = slot
+    return expired